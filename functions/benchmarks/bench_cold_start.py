@@ -0,0 +1,132 @@
+# functions/benchmarks/bench_cold_start.py
+"""
+エンドポイントごとのコールドスタート時間 (main の import から最初のレスポンスまで) を計測するベンチマーク。
+計測ごとに新しい Python プロセスを起動するため、import キャッシュや初期化済みの状態の影響を受けません。
+
+使い方 (functions ディレクトリで実行):
+    firebase emulators:start --only firestore,auth   # 別ターミナル
+    FIRESTORE_EMULATOR_HOST=localhost:8080 FIREBASE_AUTH_EMULATOR_HOST=localhost:9099 \\
+        GCLOUD_PROJECT=demo-bench python benchmarks/bench_cold_start.py --runs 5
+
+--importtime を指定すると、各エンドポイントの1回目の計測で python -X importtime の結果を集計し、
+import に時間のかかっているモジュールの上位を出力します。
+変更前後の比較は、対象コミットをそれぞれチェックアウトして同じコマンドを実行してください。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, FUNCTIONS_DIR)
+
+ENDPOINTS = [
+    "helloWorld",
+    "check_api_key_status",
+    "verify_api_key",
+    "record_api_usage",
+    "generate_or_fetch_api_key",
+]
+
+# 子プロセスで実行するコード。import 開始からの経過時間を JSON で標準出力に書き出す
+CHILD_CODE = """
+import json, sys, time, uuid
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+from bench_record_api_usage import build_request
+endpoint, api_key = sys.argv[1], sys.argv[2]
+headers = {"X-API-KEY": api_key}
+if endpoint == "generate_or_fetch_api_key":
+    headers = {"Authorization": "Bearer invalid-token"}  # トークン検証までの経路 (401) を計測する
+req = build_request(api_key, {"transactionId": f"cold-{uuid.uuid4()}"}, headers=headers)
+res = getattr(main, endpoint)(req)
+responded = time.perf_counter()
+print(json.dumps({
+    "importMs": (imported - started) * 1000,
+    "firstResponseMs": (responded - started) * 1000,
+    "status": res.status_code,
+}))
+"""
+
+
+def run_child(endpoint: str, api_key: str, importtime: bool) -> tuple[dict, str]:
+    """新しいプロセスで1回計測し、(計測結果, 標準エラー出力) を返します。"""
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", CHILD_CODE, endpoint, api_key]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([FUNCTIONS_DIR, BENCHMARKS_DIR]))
+    completed = subprocess.run(command, cwd=FUNCTIONS_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+
+def top_imports(importtime_stderr: str, limit: int) -> list[dict]:
+    """
+    -X importtime の出力から、累積時間の大きいモジュールを返します。
+    他のモジュールから import されたモジュール (インデントあり) も含め、depth にネストの深さ (0 がトップレベル) を返します。
+    """
+    entries = []
+    for line in importtime_stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        if not cumulative_us.strip().isdigit():  # ヘッダー行
+            continue
+        # モジュール名の前には空白1つと、ネスト1段ごとに空白2つが付く
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append({"module": name.strip(), "depth": depth, "cumulativeMs": round(int(cumulative_us) / 1000, 1)})
+    entries.sort(key=lambda entry: entry["cumulativeMs"], reverse=True)
+    return entries[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="エンドポイントごとの計測回数 (プロセス起動回数)")
+    parser.add_argument("--endpoints", nargs="*", default=ENDPOINTS, help="計測するエンドポイント")
+    parser.add_argument("--importtime", action="store_true", help="import に時間のかかるモジュールを出力する")
+    parser.add_argument("--top", type=int, default=15, help="--importtime で出力するモジュール数")
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("FIRESTORE_EMULATOR_HOST is not set. Run against the Firestore emulator.")
+
+    import main as main_module
+    from bench_record_api_usage import seed_api_key
+
+    api_key = seed_api_key(main_module, usage_limit=len(args.endpoints) * args.runs * 2)
+    results = []
+    for endpoint in args.endpoints:
+        samples = []
+        statuses = {}
+        slowest_imports = None
+        for run in range(args.runs):
+            sample, stderr = run_child(endpoint, api_key, importtime=args.importtime and run == 0)
+            if args.importtime and run == 0:
+                slowest_imports = top_imports(stderr, args.top)
+                continue  # -X importtime 自体のオーバーヘッドを含むため計測値には使わない
+            samples.append(sample)
+            statuses[sample["status"]] = statuses.get(sample["status"], 0) + 1
+        if not samples:
+            continue
+        result = {
+            "endpoint": endpoint,
+            "runs": len(samples),
+            "statuses": statuses,
+            "importMedianMs": round(statistics.median(s["importMs"] for s in samples), 1),
+            "firstResponseMedianMs": round(statistics.median(s["firstResponseMs"] for s in samples), 1),
+            "firstResponseMaxMs": round(max(s["firstResponseMs"] for s in samples), 1),
+        }
+        if slowest_imports is not None:
+            result["slowestImports"] = slowest_imports
+        results.append(result)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
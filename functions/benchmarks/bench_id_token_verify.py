@@ -0,0 +1,186 @@
+# functions/benchmarks/bench_id_token_verify.py
+"""
+ID トークン検証 (事前取得した証明書によるローカル検証) をオフラインで計測・確認するベンチマーク。
+ネットワークや Firebase プロジェクトは不要です。
+
+ローカルに証明書エンドポイントの代わりの HTTP サーバーを立て、自己署名証明書で署名したトークンを
+verify_firebase_id_token で検証します。出力する項目:
+  coldVerifyMs:      取得の開始直後 (証明書がまだない状態) の最初の検証が、取得の完了を待って終わるまでの時間
+  verifyP50Ms/P99Ms: 1件あたりの検証時間 (ID トークンキャッシュを通さない)
+  staleServeOk:      エンドポイントが失敗している間も古い証明書で検証できたか
+  rotationOk:        未知の kid のトークンを、バックグラウンドで取り直した証明書を待って1回目の検証で受け付けたか
+  rotationVerifyMs:  その検証 (再取得の待ち時間を含む) にかかった時間
+
+使い方 (functions ディレクトリで実行):
+    python benchmarks/bench_id_token_verify.py --tokens 500
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROJECT_ID = "demo-bench"
+
+
+def generate_signing_key(common_name: str) -> tuple[bytes, str]:
+    """RSA 鍵と自己署名証明書を生成し、(秘密鍵 PEM, 証明書 PEM) を返します。"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .sign(private_key, hashes.SHA256())
+    )
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    return private_pem, certificate.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+
+
+class StandInCertificateServer:
+    """証明書エンドポイントの代わりに kid → 証明書 PEM の JSON を返すローカル HTTP サーバー。"""
+
+    def __init__(self, max_age: int):
+        self.certs: dict[str, str] = {}
+        self.failing = False
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if server.failing:
+                    self.send_error(503)
+                    return
+                body = json.dumps(server.certs).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", f"public, max-age={max_age}, must-revalidate")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}/certs"
+
+
+def mint_id_token(private_pem: bytes, kid: str, uid: str) -> str:
+    """Firebase の ID トークンと同じ形式のトークンを発行します。"""
+    from google.auth import crypt, jwt as google_jwt
+
+    now = int(time.time())
+    signer = crypt.RSASigner.from_string(private_pem, key_id=kid)
+    payload = {
+        "iss": f"https://securetoken.google.com/{PROJECT_ID}",
+        "aud": PROJECT_ID,
+        "sub": uid,
+        "iat": now,
+        "exp": now + 3600,
+        "auth_time": now,
+    }
+    return google_jwt.encode(signer, payload).decode("utf-8")
+
+
+def percentile(sorted_values: list, ratio: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(ratio * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=500, help="検証するトークン数")
+    parser.add_argument("--max-age", type=int, default=3600, help="スタンドインサーバーが返す max-age (秒)")
+    args = parser.parse_args()
+
+    server = StandInCertificateServer(max_age=args.max_age)
+    private_pem, certificate_pem = generate_signing_key("bench-key-1")
+    server.certs = {"bench-key-1": certificate_pem}
+
+    os.environ["ID_TOKEN_CERTS_URL"] = server.url
+    os.environ.pop("FIREBASE_AUTH_EMULATOR_HOST", None)
+    import firebase_admin
+    import firebase_admin.auth
+    import main as main_module
+
+    firebase_admin.initialize_app(options={"projectId": PROJECT_ID})
+    manager = main_module.id_token_cert_manager
+
+    tokens = [mint_id_token(private_pem, "bench-key-1", f"user-{i}") for i in range(args.tokens)]
+
+    # インスタンスの起動 (import 時の事前取得の開始) 直後に最初のリクエストが届いた場合
+    started = time.perf_counter()
+    manager.start()
+    cold_verify_ok = main_module.verify_firebase_id_token(tokens[0])["uid"] == "user-0"
+    cold_verify_ms = (time.perf_counter() - started) * 1000
+
+    latencies_ms = []
+    for token in tokens:
+        started = time.perf_counter()
+        claims = main_module.verify_firebase_id_token(token)
+        latencies_ms.append((time.perf_counter() - started) * 1000)
+        assert claims["uid"] == claims["sub"]
+    latencies_ms.sort()
+
+    # エンドポイントが失敗している間も、取得済みの証明書で検証できること
+    server.failing = True
+    try:
+        manager.refresh()
+    except Exception:
+        pass
+    stale_serve_ok = main_module.verify_firebase_id_token(tokens[0])["uid"] == "user-0"
+
+    # 鍵のローテーション: 未知の kid のトークンは、バックグラウンドで取り直した証明書を待って1回目で検証できること
+    server.failing = False
+    rotated_pem, rotated_certificate_pem = generate_signing_key("bench-key-2")
+    server.certs = {"bench-key-1": certificate_pem, "bench-key-2": rotated_certificate_pem}
+    rotated_token = mint_id_token(rotated_pem, "bench-key-2", "rotated-user")
+    started = time.perf_counter()
+    try:
+        rotation_ok = main_module.verify_firebase_id_token(rotated_token)["uid"] == "rotated-user"
+    except firebase_admin.auth.InvalidIdTokenError:
+        rotation_ok = False
+    rotation_verify_ms = (time.perf_counter() - started) * 1000
+
+    print(json.dumps({
+        "tokens": args.tokens,
+        "coldVerifyOk": cold_verify_ok,
+        "coldVerifyMs": round(cold_verify_ms, 2),
+        "verifyMeanMs": round(statistics.mean(latencies_ms), 3),
+        "verifyP50Ms": round(percentile(latencies_ms, 0.50), 3),
+        "verifyP99Ms": round(percentile(latencies_ms, 0.99), 3),
+        "staleServeOk": stale_serve_ok,
+        "rotationOk": rotation_ok,
+        "rotationVerifyMs": round(rotation_verify_ms, 2),
+        "certificateRequests": server.requests,
+        "managerStats": manager.stats(),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
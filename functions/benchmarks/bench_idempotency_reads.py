@@ -0,0 +1,85 @@
+# functions/benchmarks/bench_idempotency_reads.py
+"""
+record_api_usage が行う2つの独立した読み取り (冪等性レコードとキードキュメント) について、
+読み取り方による往復時間の差を Firestore エミュレータ上で計測するベンチマーク。
+
+  serial:     processedTransactions/{id}.get() の後に apiKeys/{id}.get() (2往復、変更前の方式)
+  concurrent: 2つの get() をスレッドで同時に発行
+  get_all:    db.get_all([...]) で1往復 (record_api_usage の現在の方式)
+
+使い方 (functions ディレクトリで実行):
+    firebase emulators:start --only firestore   # 別ターミナル
+    FIRESTORE_EMULATOR_HOST=localhost:8080 GCLOUD_PROJECT=demo-bench \\
+        python benchmarks/bench_idempotency_reads.py --iterations 300
+
+record_api_usage 全体での差は bench_record_api_usage.py の --cold-cache (キャッシュミス時) で確認できます。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_record_api_usage import percentile, seed_api_key  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=300, help="方式ごとの計測回数")
+    parser.add_argument("--warmup", type=int, default=20, help="計測前のウォームアップ回数")
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("FIRESTORE_EMULATOR_HOST is not set. Run against the Firestore emulator.")
+
+    import main as main_module
+
+    api_key = seed_api_key(main_module, usage_limit=1)
+    db = main_module.db
+    key_doc_ref = db.collection("apiKeys").document(main_module.hash_api_key(api_key))
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def serial(txn_ref):
+        txn_ref.get()
+        key_doc_ref.get()
+
+    def concurrent(txn_ref):
+        futures = [executor.submit(txn_ref.get), executor.submit(key_doc_ref.get)]
+        for future in futures:
+            future.result()
+
+    def get_all(txn_ref):
+        list(db.get_all([txn_ref, key_doc_ref]))
+
+    results = []
+    for name, strategy in (("serial", serial), ("concurrent", concurrent), ("get_all", get_all)):
+        latencies_ms = []
+        for i in range(args.warmup + args.iterations):
+            txn_ref = db.collection("processedTransactions").document(f"bench-{uuid.uuid4()}")
+            started = time.perf_counter()
+            strategy(txn_ref)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if i >= args.warmup:
+                latencies_ms.append(elapsed_ms)
+        latencies_ms.sort()
+        results.append({
+            "strategy": name,
+            "iterations": args.iterations,
+            "meanMs": round(statistics.mean(latencies_ms), 2),
+            "p50Ms": round(percentile(latencies_ms, 0.50), 2),
+            "p95Ms": round(percentile(latencies_ms, 0.95), 2),
+            "p99Ms": round(percentile(latencies_ms, 0.99), 2),
+        })
+    executor.shutdown()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
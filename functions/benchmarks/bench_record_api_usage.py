@@ -0,0 +1,128 @@
+# functions/benchmarks/bench_record_api_usage.py
+"""
+record_api_usage のレイテンシを Firestore エミュレータ上で計測するベンチマーク。
+
+使い方 (functions ディレクトリで実行):
+    firebase emulators:start --only firestore   # 別ターミナル
+    FIRESTORE_EMULATOR_HOST=localhost:8080 GCLOUD_PROJECT=demo-bench \
+        python benchmarks/bench_record_api_usage.py --requests 200 --duplicates 0.2
+
+--concurrency で同時実行数 (インスタンスの concurrency 相当) を指定できます。
+
+変更前後の比較は、対象コミットをそれぞれチェックアウトして同じコマンドを実行し、
+出力される JSON (p50/p95/p99 など) を比べてください。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def build_request(api_key: str, body: dict, headers: dict | None = None):
+    """テスト用の Flask リクエストを生成します。headers を省略した場合は X-API-KEY のみを付けます。"""
+    from werkzeug.test import EnvironBuilder
+    from flask import Request
+
+    builder = EnvironBuilder(
+        method="POST",
+        path="/",
+        headers=headers if headers is not None else {"X-API-KEY": api_key},
+        json=body,
+    )
+    return Request(builder.get_environ())
+
+
+def seed_api_key(main_module, usage_limit: int) -> str:
+    """計測用のAPIキーを (ハッシュIDで) 作成し、キー文字列を返します。"""
+    main_module.ensure_firebase_initialized()
+    api_key = main_module.generate_api_key_string()
+    main_module.db.collection("apiKeys").document(main_module.hash_api_key(api_key)).set({
+        "key": api_key,
+        "user_uid": "bench-user",
+        "isEnabled": True,
+        "usageCount": 0,
+        "usageLimit": usage_limit,
+        "lastReset": main_module.firestore.SERVER_TIMESTAMP,
+        "created_at": main_module.firestore.SERVER_TIMESTAMP,
+        "ownerEmail": "bench@example.com",
+    })
+    return api_key
+
+
+def percentile(sorted_values: list, ratio: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(ratio * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="計測するリクエスト数")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="直前の transactionId を再送する割合 (0-1)")
+    parser.add_argument("--warmup", type=int, default=10, help="計測前のウォームアップ回数")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時に送るリクエスト数")
+    parser.add_argument("--cold-cache", action="store_true",
+                        help="毎回APIキーのキャッシュを破棄し、キーの解決 (と冪等性レコードの先読み) を含めて計測する")
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("FIRESTORE_EMULATOR_HOST is not set. Run against the Firestore emulator.")
+
+    import main as main_module
+
+    api_key = seed_api_key(main_module, usage_limit=(args.requests + args.warmup) * 2)
+    latencies_ms = []
+    statuses = {}
+    results_lock = threading.Lock()
+    transaction_ids = []
+    for i in range(args.warmup + args.requests):
+        if transaction_ids and (i % 100) < args.duplicates * 100:
+            transaction_ids.append(transaction_ids[-1])
+        else:
+            transaction_ids.append(f"bench-{uuid.uuid4()}")
+
+    def send(transaction_id: str, measured: bool):
+        req = build_request(api_key, {"transactionId": transaction_id})
+        if args.cold_cache:
+            main_module.api_key_cache.invalidate(main_module.hash_api_key(api_key))
+        started = time.perf_counter()
+        res = main_module.record_api_usage(req)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if measured:
+            with results_lock:
+                latencies_ms.append(elapsed_ms)
+                statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+
+    for transaction_id in transaction_ids[:args.warmup]:
+        send(transaction_id, measured=False)
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        list(executor.map(lambda transaction_id: send(transaction_id, measured=True), transaction_ids[args.warmup:]))
+    wall_seconds = time.perf_counter() - wall_started
+
+    latencies_ms.sort()
+    print(json.dumps({
+        "endpoint": "record_api_usage",
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "coldCache": args.cold_cache,
+        "duplicates": args.duplicates,
+        "statuses": statuses,
+        "requestsPerSecond": round(args.requests / wall_seconds, 1),
+        "meanMs": round(statistics.mean(latencies_ms), 2),
+        "p50Ms": round(percentile(latencies_ms, 0.50), 2),
+        "p95Ms": round(percentile(latencies_ms, 0.95), 2),
+        "p99Ms": round(percentile(latencies_ms, 0.99), 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# functions/benchmarks/bench_response_encoding.py
+"""
+レスポンスのボディ生成にかかる CPU 時間を計測するマイクロベンチマーク。
+Firestore やエミュレータは不要です (ログ出力は計測から除外します)。
+
+  error_json_dumps:   毎回 json.dumps でエラーボディを生成 (変更前の方式)
+  error_static:       create_error_response (固定メッセージは import 時にエンコード済み)
+  success_json_dumps: 成功レスポンスのペイロードを毎回 json.dumps で生成 (変更前の方式)
+  success_encode:     create_success_response (orjson があれば orjson、なければ標準の json)
+
+JSON と MessagePack (Accept: application/msgpack) の比較として、record_api_usage と
+record_api_usage_batch の成功レスポンスに近いペイロードについて、サーバー側のエンコード時間、
+ボディのバイト数、クライアント側のデコード時間 (json.loads / msgpack.unpackb) も出力します。
+
+使い方 (functions ディレクトリで実行):
+    python benchmarks/bench_response_encoding.py --iterations 100000
+
+orjson の有無による差は、orjson をインストールした環境としていない環境で同じコマンドを実行して比べてください。
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# record_api_usage の成功レスポンスに近いペイロード
+SUCCESS_PAYLOAD = {
+    "message": "API usage recorded successfully.",
+    "transactionId": "bench-00000000-0000-0000-0000-000000000000",
+    "currentUsage": 123,
+    "usageLimit": 1000,
+    "remainingUsage": 877,
+}
+
+
+def build_batch_payload(items: int) -> dict:
+    """record_api_usage_batch の成功レスポンスに近いペイロードを生成します。"""
+    return {
+        "status": "success",
+        "results": [
+            {"transactionId": f"bench-{i:08d}", "status": "recorded", "recordedUsageCount": i + 1}
+            for i in range(items)
+        ],
+        "newEffectiveUsageCount": items,
+        "remainingUsages": 1000 - items,
+    }
+
+
+def measure(function, iterations: int) -> dict:
+    """function を iterations 回呼び出し、1回あたりの平均時間 (マイクロ秒) を返します。"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    elapsed = time.perf_counter() - started
+    return {"iterations": iterations, "meanUs": round(elapsed / iterations * 1_000_000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000, help="方式ごとの呼び出し回数")
+    parser.add_argument("--batch-items", type=int, default=100, help="バッチのペイロードに含める件数")
+    args = parser.parse_args()
+
+    import msgpack
+    import main as main_module
+    from firebase_functions import https_fn
+    from bench_record_api_usage import build_request
+
+    main_module.logger.setLevel(logging.CRITICAL)  # ログ出力のコストを含めない
+
+    def error_json_dumps():
+        return https_fn.Response(json.dumps({"error": "Invalid API key."}), status=401, mimetype="application/json")
+
+    def error_static():
+        return main_module.create_error_response("bench", "Invalid API key.", 401)
+
+    def success_json_dumps():
+        return https_fn.Response(json.dumps(SUCCESS_PAYLOAD), status=200, mimetype="application/json")
+
+    def success_encode():
+        return main_module.create_success_response(SUCCESS_PAYLOAD)
+
+    assert json.loads(error_static().get_data()) == json.loads(error_json_dumps().get_data())
+    assert json.loads(success_encode().get_data()) == SUCCESS_PAYLOAD
+
+    results = {"orjson": main_module.orjson is not None}
+    for name, function in (
+            ("error_json_dumps", error_json_dumps),
+            ("error_static", error_static),
+            ("success_json_dumps", success_json_dumps),
+            ("success_encode", success_encode),
+    ):
+        results[name] = measure(function, args.iterations)
+
+    # JSON と MessagePack の比較 (Accept ヘッダーによるネゴシエーションを含む)
+    requests_by_format = {
+        "json": build_request("", {}, headers={"Accept": "application/json"}),
+        "msgpack": build_request("", {}, headers={"Accept": "application/msgpack"}),
+    }
+    decoders = {"json": json.loads, "msgpack": msgpack.unpackb}
+    for payload_name, payload in (("record", SUCCESS_PAYLOAD), ("batch", build_batch_payload(args.batch_items))):
+        iterations = max(1, args.iterations // max(1, len(payload.get("results", [None]))))
+        for format_name, req in requests_by_format.items():
+            body = main_module.create_success_response(payload, req=req).get_data()
+            decode = decoders[format_name]
+            assert decode(body) == payload
+            results[f"{payload_name}_{format_name}"] = {
+                "bytes": len(body),
+                "encode": measure(lambda: main_module.create_success_response(payload, req=req), iterations),
+                "decode": measure(lambda: decode(body), iterations),
+            }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
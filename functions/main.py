@@ -4,39 +4,400 @@
 import os
 import uuid  # transactionId 生成の候補として (今回は未使用だが一般的に使われる)
 import secrets  # APIキー生成用
+import hashlib  # APIキーのハッシュ化 (ドキュメントID) 用
 from datetime import datetime, timezone, timedelta
 import traceback
 import json
+import base64
+import re
 import logging  # Python標準のロギング
+import logging.handlers
+import queue
+import threading
+import math
+import time
+import random
+import urllib.request
+import atexit
+import contextvars
+import copy
+import functools
+from typing import NamedTuple
 
 # --- Firebase Admin SDK & Cloud Functions ---
-import firebase_admin
-from firebase_admin import initialize_app, firestore, auth, credentials
-from firebase_functions import https_fn, options
+from firebase_admin import initialize_app, get_app, firestore, auth
+from firebase_functions import https_fn, options, scheduler_fn
+from cachetools import TTLCache, TLRUCache
+import msgpack
+
+# --- 任意の依存関係 ---
+try:  # 高速な JSON エンコーダ (未インストールの場合は標準の json を使う)
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- Google Cloud Libraries ---
 from google.cloud.firestore_v1.client import Client as FirestoreClient  # 型ヒント用
 from google.cloud.firestore_v1.document import DocumentReference
 from google.cloud.firestore_v1.transaction import Transaction
 from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
 from google.api_core import exceptions as google_exceptions
+from google.auth import jwt as google_jwt
 
 # === ロガー設定 ===
 # 環境変数 DEBUG_FUNCTIONS が "true" の場合にデバッグレベルのログを出力
 DEBUG_MODE = os.environ.get("DEBUG_FUNCTIONS", "false").lower() == "true"
 log_level = logging.DEBUG if DEBUG_MODE else logging.INFO
-logging.basicConfig(level=log_level, format='%(levelname)s: %(asctime)s: %(message)s')
+# "json" は Cloud Logging が構造化ログ (jsonPayload) として取り込む1行 JSON、"text" は従来の形式
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# true の場合、ログの整形と書き出しをリクエストのスレッドではなくバックグラウンドのスレッドで行う
+LOG_ASYNC_ENABLED = os.environ.get("LOG_ASYNC_ENABLED", "true").lower() == "true"
+LOG_QUEUE_MAX_SIZE = int(os.environ.get("LOG_QUEUE_MAX_SIZE", "10000"))  # 超えた分のログは破棄する
+# イベント種別ごとの INFO 以下のログの出力率 (0-1)。例: {"request": 0.01, "success": 0.01}
+# WARNING 以上のログは常に出力する
+LOG_SAMPLE_RATES: dict = json.loads(os.environ.get("LOG_SAMPLE_RATES", "{}"))
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    ログを1行の JSON として整形します。severity / message は Cloud Logging の特別なフィールドとして扱われます。
+    log_fields() で渡したイベント種別とフィールドも、そのまま JSON のフィールドとして出力します。
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "logger": record.name,
+        }
+        event = getattr(record, "event", None)
+        if event is not None:
+            payload["event"] = event
+            payload.update(getattr(record, "fields", None) or {})
+        sample_rate = getattr(record, "sampleRate", None)
+        if sample_rate is not None:
+            payload["sampleRate"] = sample_rate  # 集計時は 1 / sampleRate 倍して扱う
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class LogSamplingFilter(logging.Filter):
+    """
+    log_fields() でイベント種別が付いた INFO 以下のログを、LOG_SAMPLE_RATES の出力率で間引きます。
+    間引かれたログはメッセージの整形も書き出しも行われません。
+    """
+
+    def __init__(self, sample_rates: dict):
+        super().__init__()
+        self._sample_rates = {event: float(rate) for event, rate in sample_rates.items()}
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self._sample_rates:
+            return True
+        sample_rate = self._sample_rates.get(getattr(record, "event", None), 1.0)
+        if sample_rate >= 1.0:
+            return True
+        if random.random() < sample_rate:
+            record.sampleRate = sample_rate
+            return True
+        self.dropped += 1
+        return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    ログレコードを整形せずにキューへ積み、QueueListener のスレッドで handlers に書き出す QueueHandler。
+    標準の QueueHandler は積む前にリクエストのスレッドでメッセージを整形するため、それを QueueListener の
+    スレッドまで遅らせます。整形までにログの引数が変更されないよう、変更可能な引数 (dict / list / set) は
+    積む前に浅くコピーします (入れ子のオブジェクトはコピーしません)。
+    import 時にスレッドを起動しないよう、QueueListener は最初のログで起動します。stop() の後のログは直接書き出します。
+    キューが一杯の場合は、リクエストを待たせないようにログを破棄して件数を数え、
+    キューに空きができた時点で破棄した件数を WARNING のログとして出力します。
+    """
+
+    def __init__(self, log_queue: queue.Queue, *handlers: logging.Handler):
+        super().__init__(log_queue)
+        self._handlers = handlers
+        self._listener: logging.handlers.QueueListener | None = None
+        self._state_lock = threading.Lock()
+        self._stopped = False
+        self._unreported_drops = 0
+        self.dropped = 0
+
+    _MUTABLE_ARG_TYPES = (dict, list, set)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 引数が1つの dict の場合、LogRecord は args をその dict 自体にする
+        if isinstance(record.args, dict):
+            record.args = copy.copy(record.args)
+        elif record.args and any(isinstance(arg, self._MUTABLE_ARG_TYPES) for arg in record.args):
+            record.args = tuple(
+                copy.copy(arg) if isinstance(arg, self._MUTABLE_ARG_TYPES) else arg for arg in record.args
+            )
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        if self._stopped:
+            self._handle_directly(record)
+            return
+        if self._listener is None:
+            self._start_listener()
+        super().emit(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._state_lock:
+                self.dropped += 1
+                self._unreported_drops += 1
+            return
+        if self._unreported_drops:
+            self._report_drops()
+
+    def stop(self):
+        """キューに残ったログを書き出して QueueListener を止めます (atexit から呼び出します)。"""
+        with self._state_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            listener = self._listener
+        if listener is not None:
+            listener.stop()
+        # 停止の直前に積まれたログと、まだ出力していない破棄件数を書き出す
+        while True:
+            try:
+                self._handle_directly(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        with self._state_lock:
+            unreported, self._unreported_drops = self._unreported_drops, 0
+        if unreported:
+            self._handle_directly(self._build_drop_warning(unreported))
+
+    def _start_listener(self):
+        with self._state_lock:
+            if self._listener is not None or self._stopped:
+                return
+            listener = logging.handlers.QueueListener(self.queue, *self._handlers)
+            listener.start()
+            self._listener = listener
+
+    def _report_drops(self):
+        with self._state_lock:
+            unreported, self._unreported_drops = self._unreported_drops, 0
+        if not unreported:
+            return
+        try:
+            self.queue.put_nowait(self._build_drop_warning(unreported))
+        except queue.Full:
+            with self._state_lock:
+                self._unreported_drops += unreported
+
+    def _build_drop_warning(self, count: int) -> logging.LogRecord:
+        return logging.LogRecord(
+            name=__name__, level=logging.WARNING, pathname=__file__, lineno=0,
+            msg="DeferredQueueHandler: Dropped %s log records because the log queue was full (LOG_QUEUE_MAX_SIZE=%s).",
+            args=(count, self.queue.maxsize), exc_info=None
+        )
+
+    def _handle_directly(self, record: logging.LogRecord):
+        for handler in self._handlers:
+            handler.handle(record)
+
+
+def log_fields(event: str, **fields) -> dict:
+    """
+    logger の extra 引数を生成します。event は LOG_SAMPLE_RATES による間引きの単位 (request / success など)、
+    fields は構造化ログ (LOG_FORMAT=json) に出力するフィールドです。
+    """
+    return {"event": event, "fields": fields}
+
+
+def configure_logging() -> DeferredQueueHandler | None:
+    """ルートロガーにハンドラーを設定し、DeferredQueueHandler を返します (非同期でない場合は None)。"""
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    if not LOG_ASYNC_ENABLED:
+        logging.basicConfig(level=log_level, handlers=[stream_handler])
+        return None
+
+    queue_handler = DeferredQueueHandler(queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE), stream_handler)
+    logging.basicConfig(level=log_level, handlers=[queue_handler])
+    # インスタンス終了時にキューに残ったログを書き出す (atexit は登録の逆順に実行されるため、
+    # 後から登録された終了処理のログはキュー経由で、停止後のログは直接書き出される)
+    atexit.register(queue_handler.stop)
+    return queue_handler
+
+
+log_queue_handler = configure_logging()
 logger = logging.getLogger(__name__)
+log_sampling_filter = LogSamplingFilter(LOG_SAMPLE_RATES)
+logger.addFilter(log_sampling_filter)
 
 
 # === 全体的なオプション設定 ===
-options.set_global_options(region=options.SupportedRegion.ASIA_NORTHEAST1)
+# 1インスタンスで同時に処理するリクエスト数 (gen2)。モジュールはスレッドセーフに書かれているため、
+# 既定で 80 を許可し、インスタンス数を抑えます。concurrency > 1 には cpu >= 1 が必要です。
+
+def parse_functions_cpu(raw_cpu: str) -> int | float | str:
+    """
+    FUNCTIONS_CPU の値を解釈します。"gcf_gen1" はそのまま、数値は小数 (例: "0.5") も受け付け、
+    整数の値 (例: "2" や "2.0") のみ int で返します。不正な値は ValueError を送出します。
+    """
+    raw_cpu = raw_cpu.strip()
+    if raw_cpu == "gcf_gen1":
+        return raw_cpu
+    cpu = float(raw_cpu)
+    if not math.isfinite(cpu) or cpu <= 0:
+        raise ValueError(f"FUNCTIONS_CPU must be a positive number or 'gcf_gen1': {raw_cpu!r}")
+    return int(cpu) if cpu.is_integer() else cpu
+
+
+def resolve_functions_concurrency(concurrency: int, cpu: int | float | str) -> int:
+    """
+    cpu が 1 vCPU 未満の場合は concurrency を 1 に抑えます (1 未満の CPU では 2 以上を指定するとデプロイに失敗するため)。
+    "gcf_gen1" の CPU はメモリ量で決まり、既定のメモリ (256MB) では 1 vCPU 未満のため同様に扱います。
+    """
+    if concurrency > 1 and (cpu == "gcf_gen1" or cpu < 1):
+        logger.warning(
+            "FUNCTIONS_CONCURRENCY=%s requires at least 1 vCPU (FUNCTIONS_CPU=%s); using concurrency 1.",
+            concurrency, cpu
+        )
+        return 1
+    return concurrency
+
+
+FUNCTIONS_CPU = parse_functions_cpu(os.environ.get("FUNCTIONS_CPU", "1"))  # 数値 (vCPU、小数可) または "gcf_gen1"
+FUNCTIONS_CONCURRENCY = resolve_functions_concurrency(int(os.environ.get("FUNCTIONS_CONCURRENCY", "80")), FUNCTIONS_CPU)
+options.set_global_options(
+    region=options.SupportedRegion.ASIA_NORTHEAST1,
+    concurrency=FUNCTIONS_CONCURRENCY,
+    cpu=FUNCTIONS_CPU,
+)
 
 
 # === 定数 ===
 DEFAULT_USAGE_LIMIT = 100
 PROCESSED_TRANSACTION_TTL_DAYS = 1
 API_KEY_PREFIX = "sk_"
+# apiKeys/{sha256(key)} でも apiKeyIndex でも解決できないキーについて、
+# 従来の key フィールドクエリにフォールバックするかどうか (バックフィル完了後は false を推奨)
+API_KEY_LEGACY_QUERY_FALLBACK = os.environ.get("API_KEY_LEGACY_QUERY_FALLBACK", "true").lower() == "true"
+API_KEY_INDEX_BACKFILL_PAGE_SIZE = 300
+
+# === APIキーメタデータキャッシュ設定 (インスタンス内) ===
+# スナップショットリスナーによるプッシュ型の無効化を有効にするかどうか
+API_KEY_CACHE_WATCH_ENABLED = os.environ.get("API_KEY_CACHE_WATCH_ENABLED", "false").lower() == "true"
+API_KEY_CACHE_WATCH_SYNC_SECONDS = float(os.environ.get("API_KEY_CACHE_WATCH_SYNC_SECONDS", "5"))
+API_KEY_CACHE_WATCH_CHUNK_SIZE = 30  # Firestore の "in" フィルタに指定できる値の上限
+API_KEY_CACHE_MAX_SIZE = int(os.environ.get("API_KEY_CACHE_MAX_SIZE", "1024"))
+# 監視が有効でも既定の TTL は短いままとする。第2世代の関数はリクエスト処理外の CPU が絞られるため、
+# アイドル中のインスタンスではリスナーが変更を受け取れず、TTL が唯一の上限になる。
+# TTL を延ばすのは CPU を常に割り当てている (CPU スロットリング無効の) 場合に限る
+API_KEY_CACHE_TTL_SECONDS = float(os.environ.get("API_KEY_CACHE_TTL_SECONDS", "60"))
+API_KEY_CACHE_STATS_LOG_INTERVAL = 1000  # この回数の参照ごとに統計をログ出力
+
+# === 利用回数の分散カウンタ (シャード) 設定 ===
+# キーごとの apiKeys.usageShardCount > プラン別 (apiKeys.plan) > 既定値 の順で決定。1 はシャード無効 (従来方式)
+USAGE_SHARD_COUNT_DEFAULT = int(os.environ.get("USAGE_SHARD_COUNT_DEFAULT", "1"))
+USAGE_SHARD_COUNT_BY_PLAN: dict = json.loads(os.environ.get("USAGE_SHARD_COUNT_BY_PLAN", "{}"))  # 例: {"pro": 10}
+USAGE_SHARD_COUNT_MAX = 100
+# 上限チェック用のシャード合計をインスタンス内で使い回す秒数 (0 で毎回読み取る)。
+# この間に他インスタンスが加算した分は含まれないため、その分だけ上限の超過幅が広がり得る
+USAGE_SHARD_TOTAL_CACHE_SECONDS = float(os.environ.get("USAGE_SHARD_TOTAL_CACHE_SECONDS", "1"))
+USAGE_SHARD_TOTAL_CACHE_MAX_SIZE = 10000
+
+# === 請求期間ごとの利用回数の圧縮 (compact_usage_periods) 設定 ===
+# 現在の期間から遡ってこの月数より古い期間の利用回数を apiKeys/{id}/usageHistory/{YYYY-MM} へ移動する
+USAGE_PERIOD_RETENTION_MONTHS = int(os.environ.get("USAGE_PERIOD_RETENTION_MONTHS", "3"))
+USAGE_COMPACTION_PAGE_SIZE = 200
+USAGE_COMPACTION_MAX_BATCH_WRITES = 400  # WriteBatch の上限 (500) に余裕を持たせる
+
+# === 利用枠のリース設定 (record_api_usage) ===
+# 有効な場合、インスタンスは利用枠をまとめて予約 (リース) し、以降の呼び出しはメモリ上で消費します
+USAGE_LEASE_ENABLED = os.environ.get("USAGE_LEASE_ENABLED", "false").lower() == "true"
+USAGE_LEASE_BLOCK_SIZE = int(os.environ.get("USAGE_LEASE_BLOCK_SIZE", "50"))
+# 同じキーのリースを同時に保持すると想定するインスタンス数。1回のリースは残り枠をこの数で割った量までに抑える
+USAGE_LEASE_EXPECTED_HOLDERS = max(1, int(os.environ.get("USAGE_LEASE_EXPECTED_HOLDERS", "4")))
+USAGE_LEASE_TTL_SECONDS = float(os.environ.get("USAGE_LEASE_TTL_SECONDS", "60"))
+USAGE_LEASE_SWEEP_SECONDS = 5
+# リースの期限後、保持していたインスタンスが差し戻さずに終了したとみなして他のインスタンスが回収するまでの猶予
+USAGE_LEASE_RECLAIM_GRACE_SECONDS = float(os.environ.get("USAGE_LEASE_RECLAIM_GRACE_SECONDS", "300"))
+
+# === 消費単位数 (units) とバッチ記録 (record_api_usage_batch) の設定 ===
+# 1トランザクションの書き込み上限 (500) から、キードキュメントの更新分を差し引いた範囲に収める
+USAGE_BATCH_MAX_ITEMS = 450
+MAX_USAGE_UNITS_PER_ITEM = int(os.environ.get("MAX_USAGE_UNITS_PER_ITEM", "1000"))
+USAGE_UNITS_HEADER = "X-USAGE-UNITS"  # verify_api_key で消費単位数を指定するヘッダー
+
+# === 処理済み transactionId のインスタンス内キャッシュ (record_api_usage のリトライ対策) ===
+RECENT_TRANSACTION_CACHE_MAX_SIZE = int(os.environ.get("RECENT_TRANSACTION_CACHE_MAX_SIZE", "10000"))
+# processedTransactions の TTL (PROCESSED_TRANSACTION_TTL_DAYS) より短くすること
+RECENT_TRANSACTION_CACHE_TTL_SECONDS = float(os.environ.get("RECENT_TRANSACTION_CACHE_TTL_SECONDS", "600"))
+
+# === check_api_key_status の条件付き GET (ETag) とステータスキャッシュ設定 ===
+# Cache-Control の max-age (秒) と、インスタンス内のステータスキャッシュの有効期間を兼ねる。0 でキャッシュしない
+STATUS_CACHE_MAX_AGE_SECONDS = int(os.environ.get("STATUS_CACHE_MAX_AGE_SECONDS", "5"))
+STATUS_CACHE_MAX_SIZE = int(os.environ.get("STATUS_CACHE_MAX_SIZE", "10000"))
+
+# === 無効なAPIキーの早期拒否設定 (ネガティブキャッシュ / Bloom フィルタ) ===
+API_KEY_NEGATIVE_CACHE_MAX_SIZE = int(os.environ.get("API_KEY_NEGATIVE_CACHE_MAX_SIZE", "10000"))
+# 作成直後のキーが他インスタンスで拒否され続けないよう、短めの TTL にする
+API_KEY_NEGATIVE_CACHE_TTL_SECONDS = float(os.environ.get("API_KEY_NEGATIVE_CACHE_TTL_SECONDS", "30"))
+API_KEY_BLOOM_ENABLED = os.environ.get("API_KEY_BLOOM_ENABLED", "false").lower() == "true"
+# 容量と偽陽性率は定期ジョブ (build_api_key_bloom_filter_job) での構築時に使い、各インスタンスは保存されたフィルタの値に従う
+API_KEY_BLOOM_CAPACITY = int(os.environ.get("API_KEY_BLOOM_CAPACITY", "100000"))
+API_KEY_BLOOM_FALSE_POSITIVE_RATE = float(os.environ.get("API_KEY_BLOOM_FALSE_POSITIVE_RATE", "0.001"))
+API_KEY_BLOOM_DOC_ID = "api-key-bloom-filter"  # 構築済みのフィルタを保存する maintenanceJobs のドキュメントID
+API_KEY_BLOOM_MAX_BYTES = 1_000_000  # ドキュメントサイズの上限 (1 MiB) に収めるためのビット配列の上限
+# 新規キーはリスナーで即時に取り込む。この間隔でリスナーの状態確認と監視範囲 (created_at の下限) の更新を行う
+API_KEY_BLOOM_REFRESH_SECONDS = float(os.environ.get("API_KEY_BLOOM_REFRESH_SECONDS", "60"))
+# 保存されたフィルタ (定期ジョブが6時間ごとに再構築) を読み直す間隔。読み取りはインスタンスごとに1ドキュメント
+API_KEY_BLOOM_RELOAD_SECONDS = float(os.environ.get("API_KEY_BLOOM_RELOAD_SECONDS", "3600"))
+# 最後の更新成功からこの回数分の更新間隔が過ぎたフィルタは信用しない (フェイルオープン)
+API_KEY_BLOOM_MAX_STALE_INTERVALS = 5
+
+# === リクエストごとの処理時間の内訳 (Server-Timing) 設定 ===
+# 内訳を計測するリクエストの割合 (0-1)。計測したリクエストは Server-Timing ヘッダーと構造化ログ (event: timing) で報告する
+# 既定では計測しない (計測にはリクエストごとのコストがかかり、内訳はクライアントにも公開されるため、調査時に小さい割合で有効にする)
+SERVER_TIMING_SAMPLE_RATE = float(os.environ.get("SERVER_TIMING_SAMPLE_RATE", "0"))
+
+# === 単一エントリポイント (api) 設定 ===
+# 有効な場合、全エンドポイントをパスで振り分ける関数 api を追加でデプロイします (従来の個別関数もそのまま残ります)
+API_ROUTER_ENABLED = os.environ.get("API_ROUTER_ENABLED", "false").lower() == "true"
+
+# === 検証済み ID トークンのキャッシュ (generate_or_fetch_api_key) 設定 ===
+ID_TOKEN_CACHE_MAX_SIZE = int(os.environ.get("ID_TOKEN_CACHE_MAX_SIZE", "1024"))
+# true の場合、失効 (revoke) とユーザーの無効化も確認する (Auth への問い合わせが発生するため、キャッシュ期間を短くする)
+ID_TOKEN_CHECK_REVOKED = os.environ.get("ID_TOKEN_CHECK_REVOKED", "false").lower() == "true"
+ID_TOKEN_CACHE_REVOKED_TTL_SECONDS = float(os.environ.get("ID_TOKEN_CACHE_REVOKED_TTL_SECONDS", "300"))
+ID_TOKEN_CACHE_EXPIRY_MARGIN_SECONDS = 30  # exp の直前まで使わないよう、この秒数だけ早く失効させる
+
+# === ID トークン検証用の公開鍵証明書の事前取得設定 ===
+ID_TOKEN_CERTS_URL = os.environ.get(
+    "ID_TOKEN_CERTS_URL",
+    "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+)
+ID_TOKEN_CERT_PREFETCH_ENABLED = os.environ.get("ID_TOKEN_CERT_PREFETCH_ENABLED", "true").lower() == "true"
+ID_TOKEN_CERT_REFRESH_AHEAD_SECONDS = float(os.environ.get("ID_TOKEN_CERT_REFRESH_AHEAD_SECONDS", "300"))
+ID_TOKEN_CERT_RETRY_SECONDS = 30  # 更新に失敗した場合の再試行間隔 (その間は古い証明書を使い続ける)
+ID_TOKEN_CERT_DEFAULT_MAX_AGE_SECONDS = 3600  # Cache-Control に max-age がない場合
+ID_TOKEN_CERT_FETCH_TIMEOUT_SECONDS = 10
+# 未知の kid のトークンによる証明書の再取得の最短間隔。不正なトークンを大量に送られても取得はこの間隔に1回まで
+ID_TOKEN_CERT_UNKNOWN_KID_REFRESH_SECONDS = 60
+# 起動直後で証明書がまだない場合と、未知の kid で再取得を依頼した場合に、取得の完了を待つ最大秒数
+ID_TOKEN_CERT_WAIT_SECONDS = float(os.environ.get("ID_TOKEN_CERT_WAIT_SECONDS", "3"))
+# 証明書を import 時に事前取得する関数 (FUNCTION_TARGET)。ID トークンを検証するのは generate_or_fetch_api_key
+# (と、それを含む単一エントリポイント api) のみのため、他の関数のインスタンスでは取得しない
+ID_TOKEN_CERT_PREFETCH_TARGETS = ("generate_or_fetch_api_key", "api")
 
 # === CORS設定値の定義 (generate_or_fetch_api_key 用) ===
 WEB_UI_ALLOWED_ORIGINS_ENV_VAR = os.environ.get(
@@ -53,24 +414,36 @@ generate_api_key_cors_policy = options.CorsOptions(
 
 
 # === Admin SDK 初期化 ===
+# 同時実行数 > 1 のインスタンスでは複数のリクエストが同時に初期化を試みるため、
+# ロックで保護し、初期化処理自体は一度だけ実行されるようにします (ダブルチェックロッキング)。
 _default_app_initialized_flag = False
 db: FirestoreClient | None = None
+_firebase_init_lock = threading.Lock()
 
 
 def ensure_firebase_initialized():
     """
     Firebase Admin SDKとFirestoreクライアントが初期化されていることを確認します。
+    スレッドセーフです。初期化済みの場合はロックを取らずに戻ります。
     """
-    global db, _default_app_initialized_flag
-
-    if db is not None and _default_app_initialized_flag:
-        logger.debug("ensure_firebase_initialized: Firestore client and app already initialized.")
+    if db is not None:
         return
 
+    with _firebase_init_lock:
+        if db is not None:
+            logger.debug("ensure_firebase_initialized: Initialized by another request while waiting for the lock.")
+            return
+        _initialize_firebase_locked()
+
+
+def _initialize_firebase_locked():
+    """ensure_firebase_initialized の本体。_firebase_init_lock を保持した状態で呼び出します。"""
+    global db, _default_app_initialized_flag
+
     if not _default_app_initialized_flag:
         logger.info("ensure_firebase_initialized: Default Firebase app not yet initialized. Attempting initialize_app().")
         try:
-            logger.debug(f"GOOGLE_APPLICATION_CREDENTIALS: {os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')}")
+            logger.debug("GOOGLE_APPLICATION_CREDENTIALS: %s", os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'))
             initialize_app()
             _default_app_initialized_flag = True
             logger.info("ensure_firebase_initialized: initialize_app() successful.")
@@ -79,11 +452,11 @@ def ensure_firebase_initialized():
                 _default_app_initialized_flag = True
                 logger.info("ensure_firebase_initialized: Default Firebase app already existed. Using existing one.")
             else:
-                logger.error(f"ensure_firebase_initialized: ValueError during initialize_app(): {ve}", exc_info=DEBUG_MODE)
+                logger.error("ensure_firebase_initialized: ValueError during initialize_app(): %s", ve, exc_info=DEBUG_MODE)
                 db = None
                 return
         except Exception as admin_init_err:
-            logger.error(f"ensure_firebase_initialized: Exception during initialize_app(): {admin_init_err}", exc_info=DEBUG_MODE)
+            logger.error("ensure_firebase_initialized: Exception during initialize_app(): %s", admin_init_err, exc_info=DEBUG_MODE)
             db = None
             return
     else:
@@ -94,20 +467,111 @@ def ensure_firebase_initialized():
         try:
             temp_db_client = firestore.client()
             if temp_db_client:
-                logger.debug(f"ensure_firebase_initialized: firestore.client() returned object of type: {type(temp_db_client)}")
+                logger.debug("ensure_firebase_initialized: firestore.client() returned object of type: %s", type(temp_db_client))
                 db = temp_db_client
                 logger.info("ensure_firebase_initialized: Firestore client obtained successfully.")
             else:
                 logger.error("ensure_firebase_initialized: firestore.client() returned None.")
                 db = None
         except Exception as db_client_err:
-            logger.error(f"ensure_firebase_initialized: Exception getting Firestore client: {db_client_err}", exc_info=DEBUG_MODE)
+            logger.error("ensure_firebase_initialized: Exception getting Firestore client: %s", db_client_err, exc_info=DEBUG_MODE)
             db = None
 
     if db is None and _default_app_initialized_flag:
         logger.error("ensure_firebase_initialized: Finished, but global db client is None despite app initialization.")
     elif db is not None:
         logger.debug("ensure_firebase_initialized: Finished. Global db client is SET.")
+        start_api_key_cache_watcher()
+        start_api_key_bloom_filter()
+
+
+# === リクエストごとの処理時間の内訳 (Server-Timing) ===
+
+class RequestTimings:
+    """
+    1リクエスト内の処理 (Firestore の読み書きなど) ごとの所要時間。
+    同じ名前の区間 (トランザクションの再試行による読み取りなど) は合計し、回数も数えます。
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: dict[str, list] = {}  # 区間名 → [合計ミリ秒, 回数]
+
+    def add(self, name: str, elapsed_ms: float):
+        span = self.spans.setdefault(name, [0.0, 0])
+        span[0] += elapsed_ms
+        span[1] += 1
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing_header(self, total_ms: float) -> str:
+        """Server-Timing ヘッダーの値を返します (2回以上の区間は desc に回数を付けます)。"""
+        metrics = [
+            f"{name};dur={elapsed_ms:.1f}" + (f';desc="x{count}"' if count > 1 else "")
+            for name, (elapsed_ms, count) in self.spans.items()
+        ]
+        metrics.append(f"total;dur={total_ms:.1f}")
+        return ", ".join(metrics)
+
+
+# 処理中のリクエストの RequestTimings。計測対象外のリクエストでは None
+_request_timings: contextvars.ContextVar[RequestTimings | None] = contextvars.ContextVar("request_timings", default=None)
+
+
+class TimingSpan:
+    """
+    with ブロックの所要時間を、処理中のリクエストの RequestTimings に記録します。
+    計測対象外のリクエスト (や、リクエスト外のバックグラウンド処理) では何もしません。
+    """
+    __slots__ = ("_name", "_timings", "_started")
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __enter__(self):
+        self._timings = _request_timings.get()
+        if self._timings is not None:
+            self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._timings is not None:
+            self._timings.add(self._name, (time.perf_counter() - self._started) * 1000)
+        return False
+
+
+def with_server_timing(handler):
+    """
+    HTTP ハンドラーをラップし、SERVER_TIMING_SAMPLE_RATE の割合のリクエストについて TimingSpan の内訳を計測します。
+    結果はレスポンスの Server-Timing ヘッダーと、構造化ログ (event: timing) に出力します。
+    計測中の別のハンドラーから呼ばれた場合は、呼び出し元の計測に含めます。
+    """
+    @functools.wraps(handler)
+    def wrapper(req: https_fn.Request) -> https_fn.Response:
+        if _request_timings.get() is not None:
+            return handler(req)
+        if SERVER_TIMING_SAMPLE_RATE <= 0 or random.random() >= SERVER_TIMING_SAMPLE_RATE:
+            return handler(req)
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        try:
+            response = handler(req)
+        finally:
+            _request_timings.reset(token)
+        total_ms = timings.total_ms()
+        response.headers["Server-Timing"] = timings.server_timing_header(total_ms)
+        logger.info(
+            "%s: Completed with status %s in %.1f ms.", handler.__name__, response.status_code, total_ms,
+            extra=log_fields(
+                "timing", endpoint=handler.__name__, statusCode=response.status_code, totalMs=round(total_ms, 1),
+                spans={name: {"ms": round(elapsed_ms, 1), "count": count}
+                       for name, (elapsed_ms, count) in timings.spans.items()}
+            )
+        )
+        return response
+
+    return wrapper
 
 
 # === ヘルパー関数 ===
@@ -120,6 +584,1383 @@ def generate_api_key_string() -> str:
     return API_KEY_PREFIX + random_part
 
 
+def hash_api_key(api_key: str) -> str:
+    """
+    APIキー文字列の SHA-256 ハッシュ (16進文字列) を返します。
+    新規キーの apiKeys ドキュメントID、および既存キー用 apiKeyIndex のドキュメントIDとして使用します。
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def write_api_key_index(api_key: str, key_doc_id: str, user_uid: str | None, batch=None) -> bool:
+    """
+    ドキュメントIDがキーのハッシュではない (旧方式で作成された) APIキーについて、
+    apiKeyIndex/{sha256(key)} に apiKeys ドキュメントIDへのポインタを書き込みます。
+    batch が指定された場合はバッチに積むだけでコミットは呼び出し側で行います。
+    書き込み (または書き込み予約) を行った場合は True を返します。
+    """
+    key_hash = hash_api_key(api_key)
+    if key_doc_id == key_hash:
+        return False  # ハッシュIDのドキュメントは直接解決できるため索引は不要
+
+    index_ref = db.collection("apiKeyIndex").document(key_hash)
+    index_data = {
+        "apiKeyDocId": key_doc_id,
+        "user_uid": user_uid,
+        "indexedAt": firestore.SERVER_TIMESTAMP,
+    }
+    if batch is not None:
+        batch.set(index_ref, index_data)
+    else:
+        index_ref.set(index_data)
+    return True
+
+
+def find_api_key_snapshot(api_key: str, prefetch_refs: list | None = None, prefetched: dict | None = None):
+    """
+    APIキー文字列に対応する apiKeys ドキュメントのスナップショットを返します。見つからない場合は None。
+    prefetch_refs を指定すると、それらのドキュメントも最初の get_all で同時に取得し、
+    パスをキーとして prefetched に格納します (キーの解決と独立した読み取りを直列にしないため)。
+
+    解決順序:
+      1. apiKeys/{sha256(key)} と apiKeyIndex/{sha256(key)} を get_all で同時に取得 (1往復)
+         - 前者が存在すればそれを返す (新方式のキー)
+      2. 索引が存在すれば apiKeyDocId のドキュメントを直接取得 (移行済みの既存キー)
+      3. API_KEY_LEGACY_QUERY_FALLBACK が有効な場合のみ key フィールドでクエリし、
+         ヒットした場合は次回以降のために索引を書き込む (遅延バックフィル)
+    いずれの場合も、取得したドキュメントの key フィールドが一致することを確認します。
+    """
+    key_hash = hash_api_key(api_key)
+    keys_collection_ref = db.collection("apiKeys")
+    hashed_key_ref = keys_collection_ref.document(key_hash)
+    index_ref = db.collection("apiKeyIndex").document(key_hash)
+
+    snapshots = {snap.reference.path: snap for snap in db.get_all([hashed_key_ref, index_ref] + list(prefetch_refs or []))}
+    if prefetched is not None:
+        for ref in prefetch_refs or []:
+            prefetched[ref.path] = snapshots.get(ref.path)
+    hashed_key_snap = snapshots.get(hashed_key_ref.path)
+    if hashed_key_snap is not None and hashed_key_snap.exists:
+        if (hashed_key_snap.to_dict() or {}).get("key") == api_key:
+            return hashed_key_snap
+        logger.error("find_api_key_snapshot: Hashed document %s... does not match the presented key.", key_hash[:12])
+        return None
+
+    index_snap = snapshots.get(index_ref.path)
+    if index_snap is not None and index_snap.exists:
+        key_doc_id = (index_snap.to_dict() or {}).get("apiKeyDocId")
+        if key_doc_id:
+            key_doc_snapshot = keys_collection_ref.document(key_doc_id).get()
+            if key_doc_snapshot.exists and (key_doc_snapshot.to_dict() or {}).get("key") == api_key:
+                return key_doc_snapshot
+        logger.warning("find_api_key_snapshot: Stale apiKeyIndex entry %s... (doc %s).", key_hash[:12], key_doc_id)
+
+    if not API_KEY_LEGACY_QUERY_FALLBACK:
+        return None
+
+    query = keys_collection_ref.where(filter=FieldFilter("key", "==", api_key)).limit(1)
+    docs = list(query.stream())
+    if not docs:
+        return None
+
+    key_doc_snapshot = docs[0]
+    try:
+        if write_api_key_index(api_key, key_doc_snapshot.id, (key_doc_snapshot.to_dict() or {}).get("user_uid")):
+            logger.info("find_api_key_snapshot: Lazily indexed legacy key document %s.", key_doc_snapshot.id)
+    except Exception as index_err:
+        # 索引の書き込み失敗はリクエスト自体の失敗にはしない
+        logger.warning("find_api_key_snapshot: Failed to write apiKeyIndex for %s: %s", key_doc_snapshot.id, index_err)
+    return key_doc_snapshot
+
+
+def backfill_api_key_index(page_size: int = API_KEY_INDEX_BACKFILL_PAGE_SIZE) -> dict:
+    """
+    既存の apiKeys 全件を走査し、ハッシュIDを持たないキーの apiKeyIndex を作成します (移行用)。
+    ドキュメントID順のカーソルでページングするため、途中で中断しても再実行で安全に再開できます。
+    処理件数のサマリーを返します。
+    """
+    ensure_firebase_initialized()
+    if db is None:
+        raise RuntimeError("backfill_api_key_index: Firestore client not initialized.")
+
+    summary = {"scanned": 0, "indexed": 0, "skipped": 0}
+    keys_collection_ref = db.collection("apiKeys")
+    last_doc = None
+
+    while True:
+        query = keys_collection_ref.order_by("__name__").limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        page = list(query.stream())
+        if not page:
+            break
+
+        batch = db.batch()
+        for key_doc in page:
+            summary["scanned"] += 1
+            key_data = key_doc.to_dict() or {}
+            api_key_value = key_data.get("key")
+            if api_key_value and write_api_key_index(api_key_value, key_doc.id, key_data.get("user_uid"), batch=batch):
+                summary["indexed"] += 1
+            else:
+                summary["skipped"] += 1
+        batch.commit()
+
+        last_doc = page[-1]
+        logger.info("backfill_api_key_index: Progress %s (last doc: %s)", summary, last_doc.id)
+
+    logger.info("backfill_api_key_index: Finished. %s", summary)
+    return summary
+
+
+class ApiKeyCacheEntry(NamedTuple):
+    """キャッシュに保持する apiKeys ドキュメントのメタデータ (利用回数は含めない)"""
+    doc_id: str
+    is_enabled: bool
+    usage_limit: int
+    user_uid: str | None
+    usage_shard_count: int = 1
+
+
+class _StatsTTLCache(TTLCache):
+    """LRU 追い出しと TTL 失効の件数を数える TTLCache"""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.evictions = 0
+        self.expirations = 0
+
+    def popitem(self):
+        # 容量超過時の LRU 追い出しでのみ呼ばれる
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.expirations += len(expired)
+        return expired
+
+
+class ApiKeyMetadataCache:
+    """
+    APIキー (の SHA-256 ハッシュ) → ApiKeyCacheEntry の LRU + TTL キャッシュ。
+    verify_api_key / check_api_key_status / record_api_usage で共有し、ヒット時はキーの解決を省略します。
+    cachetools のキャッシュはスレッドセーフではないため、ロックで保護します。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = _StatsTTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key_hash: str) -> ApiKeyCacheEntry | None:
+        with self._lock:
+            entry = self._cache.get(key_hash)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            lookups = self.hits + self.misses
+        if lookups % API_KEY_CACHE_STATS_LOG_INTERVAL == 0:
+            log_api_key_cache_stats("periodic")
+        return entry
+
+    def put(self, key_hash: str, entry: ApiKeyCacheEntry):
+        with self._lock:
+            self._cache[key_hash] = entry
+
+    def invalidate(self, key_hash: str):
+        with self._lock:
+            self._cache.pop(key_hash, None)
+
+    def doc_ids(self) -> set[str]:
+        """現在キャッシュされている (失効していない) エントリの apiKeys ドキュメントIDの集合を返します。"""
+        with self._lock:
+            return {entry.doc_id for entry in self._cache.values()}
+
+    def apply_document_change(self, doc_id: str, key_data: dict | None) -> int:
+        """
+        apiKeys ドキュメントの変更をキャッシュに反映します。更新または削除したエントリ数を返します。
+        ドキュメントが削除された場合 (key_data が None) やキー文字列が変わった場合はエントリを削除し、
+        それ以外は isEnabled / usageLimit / user_uid / シャード数を最新の値で置き換えます。
+        キャッシュするメタデータが変わらない変更 (利用回数の加算など) では何もせず、0 を返します。
+        """
+        applied = 0
+        with self._lock:
+            matching = [(key_hash, entry) for key_hash, entry in self._cache.items() if entry.doc_id == doc_id]
+            for key_hash, entry in matching:
+                if key_data is None or hash_api_key(key_data.get("key") or "") != key_hash:
+                    self._cache.pop(key_hash, None)
+                    applied += 1
+                    continue
+                updated_entry = entry._replace(
+                    is_enabled=bool(key_data.get("isEnabled", False)),
+                    usage_limit=key_data.get("usageLimit", DEFAULT_USAGE_LIMIT),
+                    user_uid=key_data.get("user_uid"),
+                    usage_shard_count=get_usage_shard_count(key_data),
+                )
+                if updated_entry != entry:
+                    self._cache[key_hash] = updated_entry
+                    applied += 1
+        return applied
+
+    def stats(self) -> dict:
+        """キャッシュサイズ調整用の統計 (ヒット/ミス/追い出し/失効) を返します。"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self._cache.evictions,
+                "expirations": self._cache.expirations,
+                "size": len(self._cache),
+                "maxsize": self._cache.maxsize,
+                "ttlSeconds": self._cache.ttl,
+            }
+
+
+api_key_cache = ApiKeyMetadataCache(maxsize=API_KEY_CACHE_MAX_SIZE, ttl=API_KEY_CACHE_TTL_SECONDS)
+
+
+def build_api_key_cache_entry(key_doc_snapshot) -> ApiKeyCacheEntry:
+    """apiKeys ドキュメントのスナップショットからキャッシュエントリを作成します。"""
+    key_data = key_doc_snapshot.to_dict() or {}
+    return ApiKeyCacheEntry(
+        doc_id=key_doc_snapshot.id,
+        is_enabled=bool(key_data.get("isEnabled", False)),
+        usage_limit=key_data.get("usageLimit", DEFAULT_USAGE_LIMIT),
+        user_uid=key_data.get("user_uid"),
+        usage_shard_count=get_usage_shard_count(key_data),
+    )
+
+
+def lookup_api_key(api_key: str, prefetch_refs: list | None = None, prefetched: dict | None = None):
+    """
+    APIキーを解決し (ApiKeyCacheEntry, スナップショット) を返します。キーが存在しない場合は (None, None)。
+    キャッシュにヒットした場合は Firestore へのアクセスを行わず、スナップショットは None になります。
+    ミスした場合は find_api_key_snapshot で取得したスナップショットも返すため、
+    呼び出し側は同じドキュメントを再度読み込む必要がありません。
+    prefetch_refs / prefetched は find_api_key_snapshot に渡されます (Firestore を読んだ場合のみ格納されます)。
+    """
+    key_hash = hash_api_key(api_key)
+    entry = api_key_cache.get(key_hash)
+    if entry is not None:
+        return entry, None
+
+    # 最近存在しなかったキー、および Bloom フィルタに含まれないキーは Firestore を読まずに拒否する。
+    # Bloom フィルタによる拒否はネガティブキャッシュに入れない (フィルタに新規キーが取り込まれ次第、受け付けるため)
+    if api_key_negative_cache.contains(key_hash):
+        return None, None
+    if api_key_bloom_filter is not None and api_key_bloom_filter.definitely_absent(key_hash):
+        return None, None
+
+    with TimingSpan("key_lookup"):
+        key_doc_snapshot = find_api_key_snapshot(api_key, prefetch_refs=prefetch_refs, prefetched=prefetched)
+    if key_doc_snapshot is None:
+        api_key_negative_cache.add(key_hash)
+        return None, None
+
+    entry = build_api_key_cache_entry(key_doc_snapshot)
+    api_key_cache.put(key_hash, entry)
+    return entry, key_doc_snapshot
+
+
+def get_api_key_cache_stats() -> dict:
+    """APIキーメタデータキャッシュ・ネガティブキャッシュ・Bloom フィルタ・IDトークンキャッシュなどの統計を返します。"""
+    stats = api_key_cache.stats()
+    stats["negativeCache"] = api_key_negative_cache.stats()
+    stats["recentTransactions"] = recent_transaction_cache.stats()
+    stats["statusResponses"] = api_key_status_cache.stats()
+    stats["idTokens"] = id_token_cache.stats()
+    stats["idTokenCertificates"] = id_token_cert_manager.stats()
+    stats["bloomFilter"] = api_key_bloom_filter.stats() if api_key_bloom_filter is not None else None
+    stats["shardedUsageTotals"] = sharded_usage_total_cache.stats()
+    stats["usageLeases"] = usage_lease_manager.stats() if USAGE_LEASE_ENABLED else None
+    stats["watcher"] = {
+        "appliedChanges": api_key_cache_watcher.applied_changes,
+        "skippedChanges": api_key_cache_watcher.skipped_changes,
+    } if api_key_cache_watcher is not None else None
+    stats["logging"] = {
+        "sampledOut": log_sampling_filter.dropped,
+        "queueDropped": log_queue_handler.dropped if log_queue_handler is not None else 0,
+    }
+    return stats
+
+
+def log_api_key_cache_stats(reason: str):
+    """
+    get_api_key_cache_stats() の結果を構造化ログ (event: cache_stats) に出力します。
+    APIキーの参照 API_KEY_CACHE_STATS_LOG_INTERVAL 回ごと (periodic) と、インスタンスの終了時 (shutdown) に呼ばれます。
+    """
+    stats = get_api_key_cache_stats()
+    logger.info("Cache stats (%s): %s", reason, stats, extra=log_fields("cache_stats", reason=reason, stats=stats))
+
+
+# インスタンスの終了時に、最後の統計を出力する (ログのキューの停止より先に実行される)
+atexit.register(log_api_key_cache_stats, "shutdown")
+
+
+class ApiKeyCacheWatcher:
+    """
+    キャッシュ中の apiKeys ドキュメントを on_snapshot で監視し、変更をキャッシュへ即時反映します。
+    isEnabled の切り替えやキーの削除が TTL を待たずに反映されます。
+    ただし、リクエスト処理外で CPU が絞られている間は反映が遅れるため、TTL は上限として残します。
+
+    バックグラウンドスレッドが API_KEY_CACHE_WATCH_SYNC_SECONDS ごとにキャッシュ中のドキュメントIDと
+    監視対象を突き合わせ、最大30件ずつの "in" クエリ (スロット) に割り当てます。
+    内容が変わったスロットのみリスナーを張り直します。
+    """
+
+    def __init__(self, sync_interval: float, chunk_size: int):
+        self._sync_interval = sync_interval
+        self._chunk_size = chunk_size
+        self._slots: list[dict] = []  # {"doc_ids": set[str], "watch": Watch | None}
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.applied_changes = 0
+        self.skipped_changes = 0  # メタデータが変わらなかった (利用回数のみの) 変更
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="api-key-cache-watcher", daemon=True)
+        self._thread.start()
+        logger.info("ApiKeyCacheWatcher: Started.")
+
+    def stop(self):
+        self._stop_event.set()
+        for slot in self._slots:
+            self._close_slot(slot)
+        self._slots = []
+
+    def _run(self):
+        while not self._stop_event.wait(self._sync_interval):
+            try:
+                self.sync()
+            except Exception as sync_err:
+                # 監視に失敗しても TTL による失効は機能するため、ログのみ出して継続する
+                logger.warning("ApiKeyCacheWatcher: Sync failed: %s", sync_err, exc_info=DEBUG_MODE)
+
+    def sync(self):
+        """キャッシュ中のドキュメントIDに合わせて監視スロットを更新します。"""
+        desired = api_key_cache.doc_ids()
+        watched = set()
+        dirty_slots = []
+
+        for slot in self._slots:
+            stale = slot["doc_ids"] - desired
+            if stale:
+                slot["doc_ids"] -= stale
+                dirty_slots.append(slot)
+            watched |= slot["doc_ids"]
+
+        for doc_id in sorted(desired - watched):
+            slot = next((sl for sl in self._slots if len(sl["doc_ids"]) < self._chunk_size), None)
+            if slot is None:
+                slot = {"doc_ids": set(), "watch": None}
+                self._slots.append(slot)
+            slot["doc_ids"].add(doc_id)
+            if not any(sl is slot for sl in dirty_slots):
+                dirty_slots.append(slot)
+
+        for slot in dirty_slots:
+            self._close_slot(slot)
+            if slot["doc_ids"]:
+                keys_collection_ref = db.collection("apiKeys")
+                doc_refs = [keys_collection_ref.document(doc_id) for doc_id in sorted(slot["doc_ids"])]
+                query = keys_collection_ref.where(filter=FieldFilter(FieldPath.document_id(), "in", doc_refs))
+                slot["watch"] = query.on_snapshot(self._on_snapshot)
+        self._slots = [slot for slot in self._slots if slot["doc_ids"]]
+
+        if dirty_slots:
+            logger.debug("ApiKeyCacheWatcher: Watching %s docs in %s slots.", len(desired), len(self._slots))
+
+    def _close_slot(self, slot: dict):
+        if slot["watch"] is not None:
+            try:
+                slot["watch"].unsubscribe()
+            except Exception as unsubscribe_err:
+                logger.debug("ApiKeyCacheWatcher: unsubscribe failed: %s", unsubscribe_err)
+            slot["watch"] = None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # Firestore のリスナースレッドで呼ばれる。
+        # 監視中のキーへの利用回数の加算 (usage / usageCount / lastReset の変更) もすべて MODIFIED として届くが、
+        # キャッシュするメタデータは変わらないため何もしない (ステータスキャッシュも max-age で失効する)
+        for change in changes:
+            doc_id = change.document.id
+            key_data = None if change.type.name == "REMOVED" else change.document.to_dict()
+            applied = api_key_cache.apply_document_change(doc_id, key_data)
+            if not applied:
+                if change.type.name == "MODIFIED":
+                    self.skipped_changes += 1
+                continue
+            self.applied_changes += applied
+            api_key_status_cache.invalidate_doc(doc_id)
+            if key_data is None or not key_data.get("isEnabled", False):
+                usage_lease_manager.release(doc_id)
+            logger.debug("ApiKeyCacheWatcher: Applied %s for apiKeys/%s to cache.", change.type.name, doc_id)
+
+
+api_key_cache_watcher: ApiKeyCacheWatcher | None = None
+
+
+def start_api_key_cache_watcher():
+    """API_KEY_CACHE_WATCH_ENABLED が有効な場合、キャッシュ監視スレッドを (一度だけ) 開始します。"""
+    global api_key_cache_watcher
+    if not API_KEY_CACHE_WATCH_ENABLED or api_key_cache_watcher is not None:
+        return
+    api_key_cache_watcher = ApiKeyCacheWatcher(
+        sync_interval=API_KEY_CACHE_WATCH_SYNC_SECONDS,
+        chunk_size=API_KEY_CACHE_WATCH_CHUNK_SIZE,
+    )
+    api_key_cache_watcher.start()
+
+
+class ApiKeyNegativeCache:
+    """
+    存在しなかったAPIキーのハッシュを短時間記憶する TTL キャッシュ。
+    キースキャナー等が同じ無効キーを繰り返し送ってきても、Firestore へのクエリは TTL ごとに1回で済みます。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = _StatsTTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def contains(self, key_hash: str) -> bool:
+        with self._lock:
+            if key_hash in self._cache:
+                self.hits += 1
+                return True
+            return False
+
+    def add(self, key_hash: str):
+        with self._lock:
+            self._cache[key_hash] = True
+
+    def discard(self, key_hash: str):
+        with self._lock:
+            self._cache.pop(key_hash, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "size": len(self._cache),
+                "maxsize": self._cache.maxsize,
+                "evictions": self._cache.evictions,
+                "ttlSeconds": self._cache.ttl,
+            }
+
+
+api_key_negative_cache = ApiKeyNegativeCache(
+    maxsize=API_KEY_NEGATIVE_CACHE_MAX_SIZE, ttl=API_KEY_NEGATIVE_CACHE_TTL_SECONDS
+)
+
+
+class ApiKeyBloomFilter:
+    """
+    有効なAPIキーのハッシュ集合を表す Bloom フィルタ。
+    "含まれない" と判定されたキーは確実に存在しないため、Firestore を読まずに拒否できます。
+    容量 (capacity) と偽陽性率 (false_positive_rate) からビット数とハッシュ関数の数を決定します。
+    ビット位置は SHA-256 ハッシュ (hash_api_key の結果) からのダブルハッシングで求めます。
+
+    apiKeys 全件からの構築は定期ジョブ (build_api_key_bloom_filter) が1回だけ行い、
+    maintenanceJobs/{API_KEY_BLOOM_DOC_ID} に保存します。各インスタンスのバックグラウンドスレッドは
+    そのドキュメントを読み込み (API_KEY_BLOOM_RELOAD_SECONDS ごとに読み直し)、以降は created_at が
+    取り込み済みの最大値 (ウォーターマーク) より新しいキーを on_snapshot で監視して即時に追加します。
+    このため、インスタンスの起動ごとにコレクション全体を読み取ることはありません。
+    監視対象のキーへの利用回数の書き込みもリスナーに届くため、API_KEY_BLOOM_REFRESH_SECONDS ごとに
+    ウォーターマークを進めてリスナーを張り直し、監視範囲を直近に作成されたキーに限ります。
+    保存されたフィルタがまだない場合や、リスナーが停止していて差分の取り込みも長時間成功していない場合は
+    判定に使わず、通常の検索にフォールバックします (フェイルオープン)。
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = max(1, capacity)
+        self.false_positive_rate = false_positive_rate
+        self.num_bits = max(8, math.ceil(-self.capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.ready = False
+        self.last_refreshed_at = 0.0  # time.monotonic()
+        self.rejections = 0
+        self._created_at_watermark = None
+        self._watch = None
+        self._watch_watermark = None  # 現在のリスナーの監視範囲の下限
+        self._loaded_built_at = None  # 読み込み済みの保存フィルタの構築日時
+        self._thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+
+    def _positions(self, key_hash: str):
+        h1 = int(key_hash[:16], 16)
+        h2 = int(key_hash[16:32], 16) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key_hash: str):
+        with self._lock:
+            self._add_unlocked(key_hash)
+            self.count += 1
+
+    def add_key_data(self, key_data: dict) -> bool:
+        """apiKeys ドキュメントのデータ (key と created_at) を取り込みます。キーを追加した場合は True を返します。"""
+        added = False
+        with self._lock:
+            if key_data.get("key"):
+                self._add_unlocked(hash_api_key(key_data["key"]))
+                self.count += 1
+                added = True
+            created_at = key_data.get("created_at")
+            if isinstance(created_at, datetime) and (
+                    self._created_at_watermark is None or created_at > self._created_at_watermark):
+                self._created_at_watermark = created_at
+        return added
+
+    def _add_unlocked(self, key_hash: str):
+        for pos in self._positions(key_hash):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, key_hash: str) -> bool:
+        # 保存されたフィルタの読み込みでビット配列とサイズが同時に置き換わるため、ロックを取って読む
+        with self._lock:
+            bits = self._bits
+            return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key_hash))
+
+    def definitely_absent(self, key_hash: str) -> bool:
+        """フィルタが利用可能で、かつキーが確実に存在しない場合に True を返します。"""
+        if not self.ready:
+            return False
+        if time.monotonic() - self.last_refreshed_at > API_KEY_BLOOM_REFRESH_SECONDS * API_KEY_BLOOM_MAX_STALE_INTERVALS:
+            return False
+        if self.might_contain(key_hash):
+            return False
+        self.rejections += 1
+        return True
+
+    def to_document(self) -> dict:
+        """保存用のドキュメントデータを返します。"""
+        with self._lock:
+            return {
+                "type": "apiKeyBloomFilter",
+                "bits": bytes(self._bits),
+                "numBits": self.num_bits,
+                "numHashes": self.num_hashes,
+                "capacity": self.capacity,
+                "falsePositiveRate": self.false_positive_rate,
+                "count": self.count,
+                "createdAtWatermark": self._created_at_watermark,
+                "builtAt": firestore.SERVER_TIMESTAMP,
+            }
+
+    def load_document(self, data: dict):
+        """to_document で保存したフィルタを読み込み、判定に使える状態にします (サイズなどは保存時の値に従います)。"""
+        bits = bytearray(data["bits"])
+        num_bits = int(data["numBits"])
+        if len(bits) != (num_bits + 7) // 8:
+            raise ValueError(f"Stored Bloom filter has {len(bits)} bytes for {num_bits} bits.")
+        with self._lock:
+            self._bits = bits
+            self.num_bits = num_bits
+            self.num_hashes = int(data["numHashes"])
+            self.capacity = int(data.get("capacity") or self.capacity)
+            self.false_positive_rate = float(data.get("falsePositiveRate") or self.false_positive_rate)
+            self.count = int(data.get("count") or 0)
+            self._created_at_watermark = data.get("createdAtWatermark")
+            self._loaded_built_at = data.get("builtAt")
+            self.ready = True
+            self.last_refreshed_at = time.monotonic()
+
+    def load(self) -> bool:
+        """保存されたフィルタを読み込みます。前回から更新されていた場合のみ置き換え、True を返します。"""
+        snapshot = db.collection("maintenanceJobs").document(API_KEY_BLOOM_DOC_ID).get()
+        if not snapshot.exists:
+            logger.warning(
+                "ApiKeyBloomFilter: No stored filter yet; run build_api_key_bloom_filter. Lookups fall back to Firestore."
+            )
+            return False
+        data = snapshot.to_dict() or {}
+        if self.ready and data.get("builtAt") == self._loaded_built_at:
+            return False
+        self.load_document(data)
+        logger.info("ApiKeyBloomFilter: Loaded stored filter with %s keys (built at %s).", self.count, data.get("builtAt"))
+        return True
+
+    def refresh_incremental(self):
+        """前回取り込み以降に作成されたキーのみを追加します。"""
+        query = db.collection("apiKeys").select(["key", "created_at"])
+        if self._created_at_watermark is not None:
+            query = query.where(filter=FieldFilter("created_at", ">", self._created_at_watermark))
+        added = 0
+        for key_doc in query.order_by("created_at").stream():
+            if self.add_key_data(key_doc.to_dict() or {}):
+                added += 1
+        self.last_refreshed_at = time.monotonic()
+        if added:
+            logger.info("ApiKeyBloomFilter: Added %s new keys (total %s).", added, self.count)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # Firestore のリスナースレッドで呼ばれる。既存キーへの書き込み (MODIFIED) は無視する
+        added = 0
+        for change in changes:
+            if change.type.name == "ADDED" and self.add_key_data(change.document.to_dict() or {}):
+                added += 1
+        self.last_refreshed_at = time.monotonic()
+        if added:
+            logger.info("ApiKeyBloomFilter: Added %s new keys from listener (total %s).", added, self.count)
+
+    def _listener_active(self) -> bool:
+        return self._watch is not None and self._watch.is_active
+
+    def _restart_listener(self):
+        """現在のウォーターマークより新しいキーを監視するリスナーを張り直します。"""
+        watermark = self._created_at_watermark
+        query = db.collection("apiKeys")
+        if watermark is not None:
+            query = query.where(filter=FieldFilter("created_at", ">", watermark))
+        previous_watch = self._watch
+        # 先に新しいリスナーを張ることで、張り替え中に作成されたキーも初回スナップショットで取り込む
+        self._watch = query.on_snapshot(self._on_snapshot)
+        self._watch_watermark = watermark
+        if previous_watch is not None:
+            try:
+                previous_watch.unsubscribe()
+            except Exception as unsubscribe_err:
+                logger.debug("ApiKeyBloomFilter: unsubscribe failed: %s", unsubscribe_err)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="api-key-bloom-filter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_load = None
+        while not self._stop_event.is_set():
+            try:
+                if last_load is None or time.monotonic() - last_load >= API_KEY_BLOOM_RELOAD_SECONDS:
+                    if self.load() or (self.ready and not self._listener_active()):
+                        self._restart_listener()
+                    # 保存されたフィルタがまだない場合は、次の確認間隔で再度読み込みを試みる
+                    last_load = time.monotonic() if self.ready else None
+                elif not self._listener_active():
+                    # リスナーが停止している間の取りこぼしをクエリで取り込んでから張り直す
+                    logger.warning("ApiKeyBloomFilter: Listener is not active; refreshing by query.")
+                    self.refresh_incremental()
+                    self._restart_listener()
+                else:
+                    self.last_refreshed_at = time.monotonic()
+                    if self._created_at_watermark != self._watch_watermark:
+                        self._restart_listener()
+            except Exception as refresh_err:
+                logger.warning("ApiKeyBloomFilter: Refresh failed: %s", refresh_err, exc_info=DEBUG_MODE)
+            self._stop_event.wait(API_KEY_BLOOM_REFRESH_SECONDS)
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "count": self.count,
+            "capacity": self.capacity,
+            "falsePositiveRate": self.false_positive_rate,
+            "numBits": self.num_bits,
+            "numHashes": self.num_hashes,
+            "memoryBytes": len(self._bits),
+            "rejections": self.rejections,
+        }
+
+
+api_key_bloom_filter: ApiKeyBloomFilter | None = None
+
+
+def start_api_key_bloom_filter():
+    """API_KEY_BLOOM_ENABLED が有効な場合、保存された Bloom フィルタの読み込み・更新スレッドを (一度だけ) 開始します。"""
+    global api_key_bloom_filter
+    if not API_KEY_BLOOM_ENABLED or api_key_bloom_filter is not None:
+        return
+    bloom_filter = ApiKeyBloomFilter(
+        capacity=API_KEY_BLOOM_CAPACITY,
+        false_positive_rate=API_KEY_BLOOM_FALSE_POSITIVE_RATE,
+    )
+    bloom_filter.start()
+    logger.info("start_api_key_bloom_filter: Started.")
+    api_key_bloom_filter = bloom_filter
+
+
+def build_api_key_bloom_filter(
+        capacity: int = API_KEY_BLOOM_CAPACITY,
+        false_positive_rate: float = API_KEY_BLOOM_FALSE_POSITIVE_RATE
+) -> dict:
+    """
+    apiKeys 全件 (key と created_at のみ) から Bloom フィルタを構築し、maintenanceJobs/{API_KEY_BLOOM_DOC_ID} に
+    保存します (定期ジョブ)。削除されたキーの除去と、容量・偽陽性率の変更もこの再構築で反映されます。
+    サマリーを返します。
+    """
+    ensure_firebase_initialized()
+    if db is None:
+        raise RuntimeError("build_api_key_bloom_filter: Firestore client not initialized.")
+
+    started = time.monotonic()
+    bloom_filter = ApiKeyBloomFilter(capacity=capacity, false_positive_rate=false_positive_rate)
+    if len(bloom_filter._bits) > API_KEY_BLOOM_MAX_BYTES:
+        raise ValueError(
+            f"build_api_key_bloom_filter: {len(bloom_filter._bits)} bytes exceed {API_KEY_BLOOM_MAX_BYTES}; "
+            "lower API_KEY_BLOOM_CAPACITY or raise API_KEY_BLOOM_FALSE_POSITIVE_RATE."
+        )
+    for key_doc in db.collection("apiKeys").select(["key", "created_at"]).stream():
+        bloom_filter.add_key_data(key_doc.to_dict() or {})
+    db.collection("maintenanceJobs").document(API_KEY_BLOOM_DOC_ID).set(bloom_filter.to_document())
+
+    if bloom_filter.count > bloom_filter.capacity:
+        logger.warning(
+            "build_api_key_bloom_filter: %s keys exceed capacity %s; false positive rate will be higher than configured.",
+            bloom_filter.count, bloom_filter.capacity
+        )
+    summary = bloom_filter.stats()
+    summary["elapsedSeconds"] = round(time.monotonic() - started, 2)
+    logger.info("build_api_key_bloom_filter: Finished. %s", summary)
+    return summary
+
+
+def register_new_api_key(api_key: str):
+    """
+    このインスタンスで作成したキーを、ネガティブキャッシュと Bloom フィルタに即座に反映します。
+    (他インスタンスへは Bloom フィルタのリスナーとネガティブキャッシュの TTL で反映されます)
+    """
+    key_hash = hash_api_key(api_key)
+    api_key_negative_cache.discard(key_hash)
+    if api_key_bloom_filter is not None:
+        api_key_bloom_filter.add(key_hash)
+
+
+# === 利用回数の分散カウンタ (シャード) ===
+# シャードモードのキーは、利用回数を apiKeys/{id}/usageShards/{0..N-1} に分散して記録します。
+# 各シャードは {"counts": {"YYYY-MM": n, ...}} という請求期間ごとのマップを持ち、
+# 加算は読み取りなしの merge 書き込み (Increment) で行うため、トランザクションの競合が発生しません。
+# 上限チェックは全シャードの合計で行いますが、トランザクション外で行うため、
+# 同時実行数に応じてわずかに上限を超える可能性がある (ソフトリミット) ことに注意してください。
+# レスポンスには isApproximate: true を含め、利用回数と上限の判定が概算であることを呼び出し側に示します。
+# 全シャードの読み取り (キードキュメント + N 件) を呼び出しごとに行わないよう、合計は
+# USAGE_SHARD_TOTAL_CACHE_SECONDS の間インスタンス内で使い回し、このインスタンスでの加算分のみ足し込みます。
+
+def current_billing_period(now_utc: datetime | None = None) -> str:
+    """現在 (または now_utc) の請求期間キー 'YYYY-MM' (UTC) を返します。"""
+    now_utc = now_utc or datetime.now(timezone.utc)
+    return f"{now_utc.year:04d}-{now_utc.month:02d}"
+
+
+def billing_period_start(period: str) -> datetime:
+    """請求期間キー 'YYYY-MM' の開始日時 (UTC) を返します。"""
+    year, month = period.split("-")
+    return datetime(int(year), int(month), 1, tzinfo=timezone.utc)
+
+
+def shift_billing_period(period: str, months: int) -> str:
+    """請求期間キーを months か月ずらしたキーを返します (負の値で過去)。"""
+    year, month = period.split("-")
+    index = int(year) * 12 + (int(month) - 1) + months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def usage_field_path(period: str) -> str:
+    """apiKeys ドキュメントの usage マップ内の、指定期間のフィールドパスを返します。"""
+    # 'YYYY-MM' は数字で始まり '-' を含むため、バッククォートでエスケープする必要がある
+    return FieldPath("usage", period).to_api_repr()
+
+
+def get_period_usage(key_data: dict, period: str) -> int:
+    """
+    apiKeys ドキュメントのデータから、指定期間の利用回数を返します。
+    usage マップに期間キーがない場合は、旧形式の usageCount/lastReset が同じ期間のものならその値を使います。
+    """
+    usage_by_period = key_data.get("usage") or {}
+    if period in usage_by_period:
+        return usage_by_period[period]
+    if _billing_period_of(key_data.get("lastReset")) == period:
+        return key_data.get("usageCount", 0)
+    return 0
+
+
+def build_period_usage_increment(key_data: dict, period: str, units: int) -> dict:
+    """
+    指定期間の利用回数に units を加算する update 用データを返します。
+    期間キーは現在時刻だけで決まるため、月替わりのリセット書き込みは不要です。
+    旧形式のキーで同じ期間の usageCount が残っている場合は、その値を引き継いで加算します。
+    """
+    carried_over = 0
+    if period not in (key_data.get("usage") or {}):
+        carried_over = get_period_usage(key_data, period)
+    return {usage_field_path(period): firestore.Increment(units + carried_over)}
+
+
+def get_usage_shard_count(key_data: dict) -> int:
+    """apiKeys ドキュメントのデータから利用回数のシャード数を決定します (1 はシャード無効)。"""
+    shard_count = key_data.get("usageShardCount")
+    if shard_count is None:
+        shard_count = USAGE_SHARD_COUNT_BY_PLAN.get(key_data.get("plan"), USAGE_SHARD_COUNT_DEFAULT)
+    try:
+        return min(max(1, int(shard_count)), USAGE_SHARD_COUNT_MAX)
+    except (TypeError, ValueError):
+        return 1
+
+
+def read_sharded_usage(key_doc_ref: DocumentReference, period: str, key_data: dict | None = None) -> int:
+    """
+    指定期間の利用回数 (キードキュメントの usage.{period} と全シャードの合計) を返します。
+    期間の途中でシャードモードに切り替えたキーでは、切り替え前の利用回数がキードキュメントに残っているため、
+    それを起点として加算します。key_data を省略した場合はキードキュメントを読み取ります。
+    シャード数を減らした場合に備え、番号ではなくサブコレクション全体を1回のクエリで読み取ります。
+    """
+    with TimingSpan("shard_read"):
+        if key_data is None:
+            key_snapshot = key_doc_ref.get()
+            key_data = (key_snapshot.to_dict() or {}) if key_snapshot.exists else {}
+        total = get_period_usage(key_data, period)
+        for shard_doc in key_doc_ref.collection("usageShards").stream():
+            total += ((shard_doc.to_dict() or {}).get("counts") or {}).get(period, 0)
+    return total
+
+
+class ShardedUsageTotalCache:
+    """
+    (apiKeys ドキュメントID, 請求期間) → シャードの合計利用回数 の短期 TTL キャッシュ。スレッドセーフです。
+    このインスタンスでの加算分は値を直接書き換えて反映します (代入し直すと有効期限が延び、
+    他インスタンスの加算を取り込むための読み直しが遅れるため)。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = _StatsTTLCache(maxsize=maxsize, ttl=max(ttl, 0.001))
+        self._lock = threading.Lock()
+        self.enabled = ttl > 0
+        self.hits = 0
+
+    def get(self, doc_id: str, period: str) -> int | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            cached = self._cache.get((doc_id, period))
+            if cached is None:
+                return None
+            self.hits += 1
+            return cached[0]
+
+    def put(self, doc_id: str, period: str, total: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._cache[(doc_id, period)] = [total]
+
+    def add(self, doc_id: str, period: str, units: int):
+        """キャッシュ中の合計に、このインスタンスで加算した units を足し込みます (有効期限は変えません)。"""
+        with self._lock:
+            cached = self._cache.get((doc_id, period))
+            if cached is not None:
+                cached[0] += units
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "size": len(self._cache), "ttlSeconds": self._cache.ttl if self.enabled else 0}
+
+
+sharded_usage_total_cache = ShardedUsageTotalCache(
+    maxsize=USAGE_SHARD_TOTAL_CACHE_MAX_SIZE, ttl=USAGE_SHARD_TOTAL_CACHE_SECONDS
+)
+
+
+def get_sharded_usage_total(key_doc_ref: DocumentReference, period: str) -> int:
+    """
+    上限チェック用の指定期間の利用回数を返します。USAGE_SHARD_TOTAL_CACHE_SECONDS 以内に読み取った合計があれば
+    それ (とこのインスタンスでの加算分) を返し、なければ read_sharded_usage で読み取ります。
+    """
+    total = sharded_usage_total_cache.get(key_doc_ref.id, period)
+    if total is None:
+        total = read_sharded_usage(key_doc_ref, period)
+        sharded_usage_total_cache.put(key_doc_ref.id, period, total)
+    return total
+
+
+def record_sharded_usage(
+        key_doc_ref: DocumentReference,
+        shard_count: int,
+        usage_limit: int,
+        units: int = 1,
+        processed_txn_ref: DocumentReference | None = None,
+        processed_txn_data: dict | None = None
+) -> dict:
+    """
+    シャードモードで利用回数を加算します。
+    全シャードの合計 (get_sharded_usage_total) で上限をチェックしたうえで、ランダムに選んだ1シャードに加算します。
+    processed_txn_ref が指定された場合は、冪等性レコードを同じバッチで create するため、
+    同じ transactionId が既に記録済みならバッチ全体が失敗し (AlreadyExists)、二重加算は起こりません。
+    戻り値: {"limit_exceeded": bool, "final_usage_count": int | None, "usage_limit": int}
+    """
+    period = current_billing_period()
+    current_usage = get_sharded_usage_total(key_doc_ref, period)
+    if current_usage + units > usage_limit:
+        return {"limit_exceeded": True, "final_usage_count": None, "usage_limit": usage_limit}
+
+    shard_ref = key_doc_ref.collection("usageShards").document(str(random.randrange(shard_count)))
+    batch = db.batch()
+    batch.set(shard_ref, {"counts": {period: firestore.Increment(units)}}, merge=True)
+    final_usage_count = current_usage + units  # 他シャードへの同時加算は含まない概算値
+    if processed_txn_ref is not None:
+        batch.create(processed_txn_ref, dict(processed_txn_data or {}, recordedUsageCount=final_usage_count))
+    with TimingSpan("shard_write"):
+        batch.commit()
+    sharded_usage_total_cache.add(key_doc_ref.id, period, units)
+    return {"limit_exceeded": False, "final_usage_count": final_usage_count, "usage_limit": usage_limit}
+
+
+# === 古い請求期間の圧縮 ===
+# 利用回数は apiKeys.usage.{YYYY-MM} (シャードモードでは usageShards/*.counts.{YYYY-MM}) に期間ごとに
+# 記録されるため、放置するとマップが毎月大きくなります。保持期間を過ぎた期間の値は
+# apiKeys/{id}/usageHistory/{YYYY-MM} へ移動し、元のフィールドは削除します。
+# 移動 (Increment) と削除は同じバッチでコミットするため、途中で失敗しても再実行で二重計上は起こりません。
+
+def _compact_period_map(
+        batch_state: dict,
+        doc_ref: DocumentReference,
+        key_doc_ref: DocumentReference,
+        map_field: str,
+        period_counts: dict,
+        cutoff_period: str
+) -> int:
+    """period_counts のうち cutoff_period より古い期間を usageHistory へ移動する書き込みをバッチに追加します。"""
+    old_periods = [period for period in period_counts if period < cutoff_period]
+    for period in old_periods:
+        if batch_state["writes"] + 2 > USAGE_COMPACTION_MAX_BATCH_WRITES:
+            batch_state["batch"].commit()
+            batch_state["batch"] = db.batch()
+            batch_state["writes"] = 0
+        history_ref = key_doc_ref.collection("usageHistory").document(period)
+        batch_state["batch"].set(history_ref, {
+            "period": period,
+            "count": firestore.Increment(period_counts[period] or 0),
+            "compactedAt": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        batch_state["batch"].update(doc_ref, {FieldPath(map_field, period).to_api_repr(): firestore.DELETE_FIELD})
+        batch_state["writes"] += 2
+    return len(old_periods)
+
+
+def compact_old_usage_periods(
+        retention_months: int = USAGE_PERIOD_RETENTION_MONTHS,
+        page_size: int = USAGE_COMPACTION_PAGE_SIZE
+) -> dict:
+    """
+    保持期間を過ぎた請求期間の利用回数を usageHistory サブコレクションへ移動します。
+    apiKeys と usageShards (コレクショングループ) をドキュメントID順のカーソルでページングします。
+    処理件数のサマリーを返します。
+    """
+    ensure_firebase_initialized()
+    if db is None:
+        raise RuntimeError("compact_old_usage_periods: Firestore client not initialized.")
+
+    cutoff_period = shift_billing_period(current_billing_period(), -retention_months)
+    summary = {"cutoffPeriod": cutoff_period, "keysScanned": 0, "shardsScanned": 0, "periodsCompacted": 0}
+    batch_state = {"batch": db.batch(), "writes": 0}
+
+    sources = (
+        ("keysScanned", "usage", db.collection("apiKeys").select(["usage"])),
+        ("shardsScanned", "counts", db.collection_group("usageShards").select(["counts"])),
+    )
+    for counter_name, map_field, base_query in sources:
+        last_doc = None
+        while True:
+            query = base_query.order_by("__name__").limit(page_size)
+            if last_doc is not None:
+                query = query.start_after(last_doc)
+            page = list(query.stream())
+            if not page:
+                break
+
+            for doc in page:
+                summary[counter_name] += 1
+                period_counts = (doc.to_dict() or {}).get(map_field) or {}
+                # シャードの場合は親の apiKeys ドキュメントの usageHistory にまとめる
+                key_doc_ref = doc.reference if map_field == "usage" else doc.reference.parent.parent
+                summary["periodsCompacted"] += _compact_period_map(
+                    batch_state, doc.reference, key_doc_ref, map_field, period_counts, cutoff_period
+                )
+
+            last_doc = page[-1]
+            logger.info("compact_old_usage_periods: Progress %s (last doc: %s)", summary, last_doc.reference.path)
+
+    if batch_state["writes"]:
+        batch_state["batch"].commit()
+    logger.info("compact_old_usage_periods: Finished. %s", summary)
+    return summary
+
+
+# === 利用枠のリース ===
+# 高頻度のキーについて、1回ごとの apiKeys トランザクションを避けるための仕組みです。
+# リース取得時にトランザクションで現在の期間の利用回数 (usage.{YYYY-MM}) を先に加算し、その枠を
+# インスタンス内で消費します。枠を使い切るか期限切れになると、未使用分をリースを取得した期間の利用回数から
+# 差し戻します。このため利用回数は未使用のリース分だけ一時的に多く見えますが、usageLimit を超えて
+# 利用されることはありません。
+# 1回のリースは USAGE_LEASE_BLOCK_SIZE と「残り枠 / USAGE_LEASE_EXPECTED_HOLDERS」の小さい方に抑えるため、
+# 残り枠が少なくなるほどリースは小さくなり、1つのインスタンスが残り枠を抱え込むことはありません。
+# 残り枠が少なくリースを作れない場合は、呼び出しごとのトランザクションにフォールバックします。
+# transactionId ごとの冪等性は、呼び出しごとの processedTransactions の create (既存なら失敗) で保証します。
+#
+# 失われたリース: インスタンスが差し戻し前に終了すると (SIGTERM では atexit が実行されないことがあり、
+# クラッシュ時は実行されない)、未使用分が期間の利用回数に残ります。これに備え、リースはキードキュメントの
+# usageLeases.{leaseId} に {units, period, expiresAt} として記録し、リース内で記録した processedTransactions には
+# leaseId を付けます。期限 (USAGE_LEASE_TTL_SECONDS + USAGE_LEASE_RECLAIM_GRACE_SECONDS) を過ぎても残っている
+# リースは、次にそのキーのリースを取得しようとしたインスタンスが、leaseId の付いた processedTransactions の units の
+# 合計を使用分として未使用分を差し戻します (回収)。差し戻しと回収はどちらも usageLeases のエントリが残っている
+# 場合にのみトランザクションで行うため、二重に差し戻されることはありません。
+
+def _billing_period_of(timestamp: datetime | None) -> str | None:
+    """Firestore のタイムスタンプが属する請求期間キーを返します。"""
+    if timestamp is None:
+        return None
+    timestamp_utc = timestamp.replace(tzinfo=timezone.utc) if timestamp.tzinfo is None else timestamp.astimezone(timezone.utc)
+    return current_billing_period(timestamp_utc)
+
+
+def usage_lease_field_path(lease_id: str) -> str:
+    """apiKeys ドキュメントの usageLeases マップ内の、指定リースのフィールドパスを返します。"""
+    return FieldPath("usageLeases", lease_id).to_api_repr()
+
+
+class UsageLease:
+    """1つの apiKeys ドキュメントについてインスタンスが保持している利用枠"""
+
+    def __init__(self, doc_id: str, lease_id: str, period: str, granted: int, base_usage_count: int, usage_limit: int):
+        self.doc_id = doc_id
+        self.lease_id = lease_id
+        self.period = period
+        self.granted = granted
+        self.used = 0
+        # リース取得直前の Firestore 上の期間の利用回数 (他のインスタンスが予約中の分を含み、このリースは含まない)
+        self.base_usage_count = base_usage_count
+        self.usage_limit = usage_limit
+        self.expires_at = time.monotonic() + USAGE_LEASE_TTL_SECONDS
+
+    @property
+    def remaining(self) -> int:
+        return self.granted - self.used
+
+    @property
+    def effective_usage_count(self) -> int:
+        """レスポンスで返す利用回数。取得時点の利用回数に、このリースで実際に消費した分を足したものです。"""
+        return self.base_usage_count + self.used
+
+    def is_usable(self, units: int) -> bool:
+        return (
+            self.remaining >= units
+            and time.monotonic() < self.expires_at
+            and self.period == current_billing_period()
+        )
+
+
+def _find_expired_usage_leases(key_data: dict, now: datetime) -> list[str]:
+    """キードキュメントの usageLeases のうち、回収期限を過ぎたリースの ID を返します。"""
+    return [
+        lease_id for lease_id, lease_entry in (key_data.get("usageLeases") or {}).items()
+        if isinstance(lease_entry, dict) and lease_entry.get("expiresAt") is not None and lease_entry["expiresAt"] <= now
+    ]
+
+
+@firestore.transactional
+def _acquire_usage_lease_in_transaction(transaction_obj: Transaction, doc_ref: DocumentReference, units: int) -> dict:
+    snapshot = doc_ref.get(transaction=transaction_obj)
+    if not snapshot.exists:
+        raise google_exceptions.NotFound(f"API key document {doc_ref.id} disappeared during lease acquisition.")
+    current_data = snapshot.to_dict() or {}
+    if not current_data.get("isEnabled", False):
+        return {"disabled": True}
+
+    now = datetime.now(timezone.utc)
+    expired_lease_ids = _find_expired_usage_leases(current_data, now)
+    usage_limit: int = current_data.get("usageLimit", DEFAULT_USAGE_LIMIT)
+    period = current_billing_period()
+    usage_count = get_period_usage(current_data, period)
+
+    # 残り枠を想定インスタンス数で分け合う。1回分に満たない場合はリースせず、呼び出し側でトランザクションに切り替える
+    granted = min(USAGE_LEASE_BLOCK_SIZE, (usage_limit - usage_count) // USAGE_LEASE_EXPECTED_HOLDERS)
+    if granted < units:
+        return {"not_granted": True, "expired_lease_ids": expired_lease_ids}
+
+    lease_id = uuid.uuid4().hex
+    updates = build_period_usage_increment(current_data, period, granted)
+    updates[usage_lease_field_path(lease_id)] = {
+        "units": granted,
+        "period": period,
+        "expiresAt": now + timedelta(seconds=USAGE_LEASE_TTL_SECONDS + USAGE_LEASE_RECLAIM_GRACE_SECONDS),
+    }
+    transaction_obj.update(doc_ref, updates)
+    return {
+        "granted": granted,
+        "lease_id": lease_id,
+        "base_usage_count": usage_count,
+        "usage_limit": usage_limit,
+        "period": period,
+        "expired_lease_ids": expired_lease_ids,
+    }
+
+
+@firestore.transactional
+def _settle_usage_lease_in_transaction(
+        transaction_obj: Transaction, doc_ref: DocumentReference, lease_id: str, used: int
+) -> int | None:
+    """
+    リースのエントリを削除し、未使用分 (units - used) を期間の利用回数から差し戻します。
+    エントリが既にない (差し戻し済み・回収済み、またはキーが削除された) 場合は何もせず None を返します。
+    戻り値: 差し戻した単位数
+    """
+    snapshot = doc_ref.get(transaction=transaction_obj)
+    if not snapshot.exists:
+        return None
+    lease_entry = ((snapshot.to_dict() or {}).get("usageLeases") or {}).get(lease_id)
+    if not isinstance(lease_entry, dict):
+        return None
+    unused = max(0, int(lease_entry.get("units", 0)) - used)
+    updates = {usage_lease_field_path(lease_id): firestore.DELETE_FIELD}
+    if unused > 0:
+        updates[usage_field_path(lease_entry["period"])] = firestore.Increment(-unused)
+    transaction_obj.update(doc_ref, updates)
+    return unused
+
+
+def _return_usage_lease(doc_ref: DocumentReference, lease: UsageLease) -> int | None:
+    """
+    リースの未使用分を、リースを取得した期間の利用回数から差し戻します。
+    使い切ったリースは差し戻す分がないため、読み取りなしでエントリの削除のみを行います。
+    """
+    if lease.remaining <= 0:
+        try:
+            doc_ref.update({usage_lease_field_path(lease.lease_id): firestore.DELETE_FIELD})
+        except google_exceptions.NotFound:
+            pass  # キーが削除されている場合は削除するエントリがない
+        return 0
+    return _settle_usage_lease_in_transaction(db.transaction(), doc_ref, lease.lease_id, lease.used)
+
+
+def _count_usage_lease_units(lease_id: str) -> int:
+    """leaseId の付いた processedTransactions の units の合計 (失われたリースで実際に消費された分) を返します。"""
+    query = db.collection("processedTransactions").where(filter=FieldFilter("leaseId", "==", lease_id))
+    aggregation_results = query.sum("units", alias="used").get()
+    for result_group in aggregation_results:
+        for result in result_group:
+            if result.alias == "used" and result.value is not None:
+                return int(result.value)
+    return 0
+
+
+def reclaim_usage_lease(doc_ref: DocumentReference, lease_id: str) -> int | None:
+    """
+    回収期限を過ぎたリース (保持していたインスタンスが差し戻さずに終了したもの) の未使用分を差し戻します。
+    戻り値: 差し戻した単位数。既に差し戻し・回収済みの場合は None
+    """
+    used = _count_usage_lease_units(lease_id)
+    return _settle_usage_lease_in_transaction(db.transaction(), doc_ref, lease_id, used)
+
+
+class UsageLeaseManager:
+    """インスタンス内の利用枠リースを管理します。スレッドセーフです。"""
+
+    def __init__(self):
+        self._leases: dict[str, UsageLease] = {}
+        # リースを取得できなかったキー → 再試行しない期限 (time.monotonic())。その間は取得のトランザクションを省く
+        self._no_lease_until: dict[str, float] = {}
+        # 回収待ちの失われたリース (apiKeys ドキュメントID, leaseId)。リクエスト処理外のスイーパーで回収する
+        self._pending_reclaims: set[tuple[str, str]] = set()
+        self._lock = threading.Lock()
+        self._doc_locks: dict[str, threading.Lock] = {}
+        self._sweeper: threading.Thread | None = None
+        self._stop_event = threading.Event()
+        self.reclaimed_leases = 0
+
+    def _doc_lock(self, doc_id: str) -> threading.Lock:
+        with self._lock:
+            return self._doc_locks.setdefault(doc_id, threading.Lock())
+
+    def consume(self, doc_ref: DocumentReference, units: int = 1) -> dict:
+        """
+        リースから units を消費します。リースがない・足りない・期限切れの場合は新しいリースを取得します。
+        残り枠が少なくリースを取得できなかった場合は consumed=False, disabled=False を返すため、
+        呼び出し側は通常のトランザクションで記録してください (上限の判定もトランザクションで行います)。
+        取得できなかったキーは、USAGE_LEASE_SWEEP_SECONDS 秒間は取得を試みずに同じ結果を返します。
+        effective_usage_count はリース取得直前の期間の利用回数に、このリースで消費した分を足したものです。
+        戻り値: {"consumed": bool, "disabled": bool, "lease_id": str, "effective_usage_count": int, "usage_limit": int}
+        """
+        self._ensure_sweeper()
+        with self._doc_lock(doc_ref.id):
+            lease = self._leases.get(doc_ref.id)
+            if lease is None or not lease.is_usable(units):
+                if lease is not None:
+                    self._release_locked(lease)
+                if time.monotonic() < self._no_lease_until.get(doc_ref.id, 0.0):
+                    return {"consumed": False, "disabled": False}
+                with TimingSpan("lease_acquire"):
+                    acquired = _acquire_usage_lease_in_transaction(db.transaction(), doc_ref, units)
+                if acquired.get("disabled"):
+                    return {"consumed": False, "disabled": True}
+                self._schedule_reclaims(doc_ref.id, acquired.get("expired_lease_ids") or [])
+                if acquired.get("not_granted"):
+                    self._no_lease_until[doc_ref.id] = time.monotonic() + USAGE_LEASE_SWEEP_SECONDS
+                    return {"consumed": False, "disabled": False}
+                self._no_lease_until.pop(doc_ref.id, None)
+                lease = UsageLease(
+                    doc_id=doc_ref.id,
+                    lease_id=acquired["lease_id"],
+                    period=acquired["period"],
+                    granted=acquired["granted"],
+                    base_usage_count=acquired["base_usage_count"],
+                    usage_limit=acquired["usage_limit"],
+                )
+                self._leases[doc_ref.id] = lease
+                logger.info("UsageLeaseManager: Acquired lease of %s units for %s.", lease.granted, doc_ref.id)
+            lease.used += units
+            return {
+                "consumed": True,
+                "disabled": False,
+                "lease_id": lease.lease_id,
+                "effective_usage_count": lease.effective_usage_count,
+                "usage_limit": lease.usage_limit,
+            }
+
+    def refund(self, doc_id: str, units: int = 1):
+        """消費を取り消します (冪等性レコードの作成に失敗した場合など)。"""
+        with self._doc_lock(doc_id):
+            lease = self._leases.get(doc_id)
+            if lease is not None:
+                lease.used = max(0, lease.used - units)
+
+    def release(self, doc_id: str):
+        """指定キーのリースを解放し、未使用分を差し戻します (キーの無効化・削除時など)。"""
+        with self._doc_lock(doc_id):
+            lease = self._leases.get(doc_id)
+            if lease is not None:
+                self._release_locked(lease)
+
+    def _release_locked(self, lease: UsageLease):
+        self._leases.pop(lease.doc_id, None)
+        try:
+            doc_ref = db.collection("apiKeys").document(lease.doc_id)
+            returned = _return_usage_lease(doc_ref, lease)
+            if returned:
+                logger.info("UsageLeaseManager: Returned %s unused units for %s.", returned, lease.doc_id)
+        except Exception as return_err:
+            # 差し戻しに失敗しても上限超過は起こらない (エントリが残るため、回収期限後に別のインスタンスが回収する)
+            logger.error("UsageLeaseManager: Failed to return lease %s for %s: %s", lease.lease_id, lease.doc_id, return_err)
+
+    def _schedule_reclaims(self, doc_id: str, lease_ids: list[str]):
+        # このインスタンスのリースは回収期限より前 (USAGE_LEASE_TTL_SECONDS) に差し戻すため、ここには含まれない
+        with self._lock:
+            self._pending_reclaims.update((doc_id, lease_id) for lease_id in lease_ids)
+
+    def reclaim_pending(self):
+        """回収待ちの失われたリースを回収します。失敗したものは次回のスイープで再試行します。"""
+        with self._lock:
+            pending = list(self._pending_reclaims)
+        for doc_id, lease_id in pending:
+            try:
+                returned = reclaim_usage_lease(db.collection("apiKeys").document(doc_id), lease_id)
+            except Exception as reclaim_err:
+                logger.warning("UsageLeaseManager: Failed to reclaim lease %s for %s: %s", lease_id, doc_id, reclaim_err)
+                continue
+            with self._lock:
+                self._pending_reclaims.discard((doc_id, lease_id))
+            if returned is not None:
+                self.reclaimed_leases += 1
+                logger.warning("UsageLeaseManager: Reclaimed lost lease %s for %s (%s units returned).", lease_id, doc_id, returned)
+
+    def release_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired_doc_ids = [doc_id for doc_id, lease in self._leases.items() if lease.expires_at <= now]
+        for doc_id in expired_doc_ids:
+            with self._doc_lock(doc_id):
+                lease = self._leases.get(doc_id)
+                if lease is not None and lease.expires_at <= now:
+                    self._release_locked(lease)
+
+    def release_all(self):
+        """
+        インスタンス終了時に全リースの未使用分を差し戻します。
+        atexit から呼び出しますが、実行されずに終了した場合も回収期限後に他のインスタンスが回収します。
+        """
+        self._stop_event.set()
+        with self._lock:
+            doc_ids = list(self._leases.keys())
+        for doc_id in doc_ids:
+            self.release(doc_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "activeLeases": len(self._leases),
+                "pendingReclaims": len(self._pending_reclaims),
+                "reclaimedLeases": self.reclaimed_leases,
+            }
+
+    def _ensure_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep, name="usage-lease-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _sweep(self):
+        while not self._stop_event.wait(USAGE_LEASE_SWEEP_SECONDS):
+            try:
+                self.release_expired()
+                self.reclaim_pending()
+            except Exception as sweep_err:
+                logger.warning("UsageLeaseManager: Sweep failed: %s", sweep_err, exc_info=DEBUG_MODE)
+
+
+usage_lease_manager = UsageLeaseManager()
+atexit.register(usage_lease_manager.release_all)
+
+
+def encode_json(data) -> bytes:
+    """
+    レスポンス用に JSON をエンコードします。orjson がインストールされていればそれを使い、
+    なければ (または orjson が扱えない値の場合は) 標準の json にフォールバックします。
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:  # orjson.JSONEncodeError は TypeError のサブクラス
+            pass
+    return json.dumps(data).encode("utf-8")
+
+
+# 固定のエラーメッセージ。エラーレスポンスの大半 (不正なキーなどによる 4xx) はこのいずれかのため、
+# ボディを import 時に一度だけエンコードしておき、リクエストごとのエンコードを省きます。
+STATIC_ERROR_MESSAGES = (
+    "Server configuration error.",
+    "API key missing.",
+    "Invalid API key.",
+    "API key disabled.",
+    "Usage limit exceeded.",
+    "Missing or invalid transactionId.",
+    "transactionId cannot be empty.",
+    "Invalid request body format.",
+    "Failed to update usage: API key may have been deleted.",
+    "Failed to update usage count due to a server error.",
+    "Internal server error during usage update processing.",
+    "A transient database error occurred. Please try again.",
+    "Internal Server Error.",
+    "Not Found.",
+    "Unauthorized: Missing or invalid token.",
+    "Unauthorized: Invalid token.",
+    "Token verification is temporarily unavailable. Please try again.",
+)
+STATIC_ERROR_BODIES: dict[str, bytes] = {
+    message: encode_json({"error": message}) for message in STATIC_ERROR_MESSAGES
+}
+
+
 def create_error_response(
         internal_message: str,
         public_message: str,
@@ -127,30 +1968,482 @@ def create_error_response(
         log_exception: bool = False
 ) -> https_fn.Response:
     """エラーレスポンスJSONを生成するヘルパー関数"""
-    logger.error(f"Error: {internal_message}" + (f" - Status: {status_code}" if status_code else ""))
+    logger.error("Error: %s - Status: %s", internal_message, status_code, extra=log_fields("error", statusCode=status_code))
     if log_exception and DEBUG_MODE:
         traceback.print_exc()
 
-    error_payload = {"error": public_message}
+    response_body = STATIC_ERROR_BODIES.get(public_message)
+    if response_body is None:
+        response_body = encode_json({"error": public_message})
     return https_fn.Response(
-        json.dumps(error_payload),
+        response_body,
         status=status_code,
         mimetype="application/json"
     )
 
 
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def negotiate_response_mimetype(req: https_fn.Request | None) -> str:
+    """
+    Accept ヘッダーから、JSON レスポンスの代わりに MessagePack を返すかを判定します。
+    msgpack を明示したリクエストのみ application/msgpack を返し、それ以外 (ヘッダーなし・*/* を含む) は JSON です。
+    """
+    accept = req.headers.get("Accept") if req is not None else None
+    if not accept or "msgpack" not in accept:  # 大半のリクエストは Accept を解析せずに判定する
+        return "application/json"
+    best_match = req.accept_mimetypes.best_match(("application/json",) + MSGPACK_MIMETYPES)
+    return MSGPACK_MIMETYPES[0] if best_match in MSGPACK_MIMETYPES else "application/json"
+
+
 def create_success_response(
         data: dict | str,
         status_code: int = 200,
-        content_type: str = "application/json"
+        content_type: str = "application/json",
+        req: https_fn.Request | None = None
 ) -> https_fn.Response:
-    """成功レスポンスJSONまたはプレーンテキストを生成するヘルパー関数"""
-    response_body = json.dumps(data) if content_type == "application/json" else data
-    return https_fn.Response(
+    """
+    成功レスポンスJSONまたはプレーンテキストを生成するヘルパー関数。
+    req を渡した場合は Accept ヘッダーに応じて JSON の代わりに MessagePack で返します。
+    """
+    if content_type == "application/json" and req is not None:
+        content_type = negotiate_response_mimetype(req)
+        if content_type != "application/json":
+            response = https_fn.Response(msgpack.packb(data), status=status_code, mimetype=content_type)
+            response.headers["Vary"] = "Accept"
+            return response
+    response_body = encode_json(data) if content_type == "application/json" else data
+    response = https_fn.Response(
         response_body,
         status=status_code,
         mimetype=content_type
     )
+    if req is not None:
+        response.headers["Vary"] = "Accept"
+    return response
+
+
+class RecentTransactionCache:
+    """
+    このインスタンスでコミット済み (または処理済みと確認済み) の transactionId と
+    recordedUsageCount を記憶する LRU + TTL キャッシュ。
+    タイムアウト後のリトライで同じ transactionId が短時間に繰り返し届いた場合に、
+    Firestore を読まずに "記録済み" と応答します。
+    コミット済みの冪等性レコードは変更されないため、インスタンス間で結果が食い違うことはありません。
+    キーは (APIキーのハッシュ, transactionId) とし、別のキーからの同一IDには Firestore で判定します。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = _StatsTTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, key_hash: str, transaction_id: str) -> dict | None:
+        with self._lock:
+            processed_data = self._cache.get((key_hash, transaction_id))
+            if processed_data is not None:
+                self.hits += 1
+            return processed_data
+
+    def put(self, key_hash: str, transaction_id: str, recorded_usage_count):
+        with self._lock:
+            self._cache[(key_hash, transaction_id)] = {"recordedUsageCount": recorded_usage_count}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "size": len(self._cache), "maxsize": self._cache.maxsize}
+
+
+recent_transaction_cache = RecentTransactionCache(
+    maxsize=RECENT_TRANSACTION_CACHE_MAX_SIZE, ttl=RECENT_TRANSACTION_CACHE_TTL_SECONDS
+)
+
+
+class ApiKeyStatusCache:
+    """
+    APIキー (の SHA-256 ハッシュ) → (ドキュメントID, ETag, check_api_key_status のレスポンス) の LRU + TTL キャッシュ。
+    ヒット時は Firestore を読まずに応答します。TTL は Cache-Control の max-age と同じにするため、
+    クライアントのキャッシュより古い内容を返すことはありません。
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = _StatsTTLCache(maxsize=maxsize, ttl=max(ttl, 1))
+        self._lock = threading.Lock()
+        self.enabled = ttl > 0
+        self.hits = 0
+
+    def get(self, key_hash: str) -> tuple[str, str, dict] | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            cached = self._cache.get(key_hash)
+            if cached is not None:
+                self.hits += 1
+            return cached
+
+    def put(self, key_hash: str, doc_id: str, etag: str, response_data: dict):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._cache[key_hash] = (doc_id, etag, response_data)
+
+    def invalidate_doc(self, doc_id: str):
+        """ドキュメントIDに対応するエントリを削除します (キーの無効化・削除の即時反映用)。"""
+        with self._lock:
+            for key_hash in [key_hash for key_hash, cached in self._cache.items() if cached[0] == doc_id]:
+                self._cache.pop(key_hash, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "size": len(self._cache), "maxsize": self._cache.maxsize}
+
+
+api_key_status_cache = ApiKeyStatusCache(maxsize=STATUS_CACHE_MAX_SIZE, ttl=STATUS_CACHE_MAX_AGE_SECONDS)
+
+
+def build_status_etag(doc_id: str, update_time, response_data: dict) -> str:
+    """
+    キードキュメントの更新日時と利用状況から ETag (引用符付き) を生成します。
+    シャードモードではキードキュメントが更新されないため、利用回数・上限・期間も含めます。
+    """
+    source = "|".join([
+        doc_id,
+        update_time.isoformat() if update_time is not None else "",
+        str(response_data["usageCount"]),
+        str(response_data["usageLimit"]),
+        response_data["lastReset"],
+    ])
+    return '"' + hashlib.sha256(source.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def create_status_response(req: https_fn.Request, etag: str, response_data: dict) -> https_fn.Response:
+    """
+    check_api_key_status のレスポンスを生成します。If-None-Match が ETag と一致する場合は
+    ボディなしの 304 を返します。レスポンスはAPIキーごとに異なるため、共有キャッシュには保存させません。
+    """
+    if negotiate_response_mimetype(req) != "application/json":
+        etag = etag[:-1] + '-msgpack"'  # 表現 (JSON / MessagePack) ごとに異なる ETag にする
+    if req.if_none_match.contains_weak(etag.strip('"')):
+        response = https_fn.Response(status=304)
+    else:
+        response = create_success_response(data=response_data, req=req)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = f"private, max-age={STATUS_CACHE_MAX_AGE_SECONDS}"
+    response.headers["Vary"] = "X-API-KEY, Accept"
+    return response
+
+
+def parse_cache_control_max_age(cache_control: str | None) -> float:
+    """Cache-Control ヘッダーの max-age (秒) を返します。ない場合は ID_TOKEN_CERT_DEFAULT_MAX_AGE_SECONDS。"""
+    match = re.search(r"max-age=(\d+)", cache_control or "")
+    return float(match.group(1)) if match else float(ID_TOKEN_CERT_DEFAULT_MAX_AGE_SECONDS)
+
+
+class IdTokenCertificateManager:
+    """
+    ID トークンの署名検証に使う Google の公開鍵証明書 (kid → PEM) を管理します。
+    バックグラウンドスレッドが起動時に取得し、Cache-Control の max-age が切れる
+    ID_TOKEN_CERT_REFRESH_AHEAD_SECONDS 前に更新します。更新に失敗した場合は古い証明書を使い続け
+    (stale-while-revalidate)、ID_TOKEN_CERT_RETRY_SECONDS ごとに再試行します。
+    未知の kid のトークンが届いた場合 (鍵のローテーション直後など) も、取得はバックグラウンドスレッドで行い、
+    リクエストのスレッドは wait_for_certs / wait_for_refresh で完了を (時間を区切って) 待つだけです。
+    """
+
+    def __init__(self, url: str):
+        self._url = url
+        self._certs: dict[str, str] = {}
+        self._expires_at = 0.0  # time.time() 基準
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._attempt_finished = threading.Condition(self._lock)  # バックグラウンドスレッドの取得が終わるたびに通知
+        self._attempts_started = 0
+        self._attempts_finished = 0
+        self._requested_attempt = 0  # request_refresh() の依頼を反映する取得の番号
+        self._thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()  # 次の定期更新を待たずに取得させる
+        self._last_requested_at = float("-inf")  # time.monotonic() 基準
+        self.refreshes = 0
+        self.failures = 0
+        self.requested_refreshes = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="id-token-cert-refresher", daemon=True)
+        self._thread.start()
+        logger.info("IdTokenCertificateManager: Started (url: %s).", self._url)
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def request_refresh(self) -> bool:
+        """
+        未知の kid を受け取ったときに、バックグラウンドスレッドに証明書の取得を依頼します (待ちません)。
+        依頼は ID_TOKEN_CERT_UNKNOWN_KID_REFRESH_SECONDS に1回までで、依頼した場合は True を返します。
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_requested_at < ID_TOKEN_CERT_UNKNOWN_KID_REFRESH_SECONDS:
+                return False
+            self._last_requested_at = now
+            self._requested_attempt = self._attempts_started + 1  # 依頼の後に始まる取得
+            self.requested_refreshes += 1
+        self._wake_event.set()
+        self.start()
+        return True
+
+    def wait_for_certs(self, timeout: float) -> dict[str, str]:
+        """証明書がまだない場合、最初の取得が終わるまで最大 timeout 秒待ち、その時点の証明書を返します。"""
+        with self._attempt_finished:
+            self._attempt_finished.wait_for(lambda: self._certs or self._attempts_finished > 0, timeout)
+            return self._certs
+
+    def wait_for_refresh(self, timeout: float) -> dict[str, str]:
+        """
+        request_refresh() で依頼した取得が終わるまで最大 timeout 秒待ち、その時点の証明書を返します。
+        依頼済みの取得がすでに終わっている場合は待ちません。
+        """
+        with self._attempt_finished:
+            self._attempt_finished.wait_for(lambda: self._attempts_finished >= self._requested_attempt, timeout)
+            return self._certs
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._lock:
+                self._attempts_started += 1
+                attempt = self._attempts_started
+            try:
+                self.refresh()
+                wait_seconds = max(
+                    ID_TOKEN_CERT_RETRY_SECONDS,
+                    self._expires_at - time.time() - ID_TOKEN_CERT_REFRESH_AHEAD_SECONDS
+                )
+            except Exception as refresh_err:
+                self.failures += 1
+                # 取得済みの証明書があればそれを使い続ける
+                logger.warning("IdTokenCertificateManager: Refresh failed, serving stale certificates: %s", refresh_err)
+                wait_seconds = ID_TOKEN_CERT_RETRY_SECONDS
+            with self._attempt_finished:
+                self._attempts_finished = attempt
+                self._attempt_finished.notify_all()
+            self._wake_event.wait(wait_seconds)
+            self._wake_event.clear()
+
+    def refresh(self):
+        """証明書を取得して置き換えます。同時に呼ばれた場合も取得は1回ずつ行います。"""
+        with self._refresh_lock:
+            with urllib.request.urlopen(self._url, timeout=ID_TOKEN_CERT_FETCH_TIMEOUT_SECONDS) as response:
+                certs = json.loads(response.read().decode("utf-8"))
+                max_age = parse_cache_control_max_age(response.headers.get("Cache-Control"))
+            if not isinstance(certs, dict) or not certs:
+                raise ValueError(f"Unexpected certificate response from {self._url}.")
+            with self._lock:
+                self._certs = certs
+                self._expires_at = time.time() + max_age
+                self.refreshes += 1
+        logger.info("IdTokenCertificateManager: Loaded %s certificates (max-age %.0fs).", len(certs), max_age)
+
+    def certs(self) -> dict[str, str]:
+        """現在の証明書を返します (期限切れでも更新に成功するまでは古いものを返します)。"""
+        with self._lock:
+            return self._certs
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "certificates": len(self._certs),
+                "stale": bool(self._certs) and time.time() >= self._expires_at,
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "requestedRefreshes": self.requested_refreshes,
+            }
+
+
+id_token_cert_manager = IdTokenCertificateManager(ID_TOKEN_CERTS_URL)
+
+
+def start_id_token_cert_manager():
+    """
+    ID_TOKEN_CERT_PREFETCH_ENABLED が有効で、このインスタンスの関数 (FUNCTION_TARGET) が
+    ID_TOKEN_CERT_PREFETCH_TARGETS のいずれかの場合、証明書の事前取得・更新スレッドを (一度だけ) 開始します。
+    """
+    if ID_TOKEN_CERT_PREFETCH_ENABLED and os.environ.get("FUNCTION_TARGET") in ID_TOKEN_CERT_PREFETCH_TARGETS:
+        id_token_cert_manager.start()
+
+
+# 最初のリクエストを待たずに、インスタンスの起動 (import) と同時に取得を始める
+start_id_token_cert_manager()
+
+
+def _decode_jwt_header(id_token: str) -> dict:
+    """JWT のヘッダーを (署名を検証せずに) 返します。"""
+    header_segment = id_token.split(".", 1)[0]
+    return json.loads(base64.urlsafe_b64decode(header_segment + "=" * (-len(header_segment) % 4)))
+
+
+def verify_firebase_id_token(id_token: str, check_revoked: bool = False) -> dict:
+    """
+    Firebase の ID トークンを、事前取得済みの証明書を使ってローカルで検証し、クレームを返します。
+    検証内容 (署名・aud・iss・exp・sub) と送出する例外は firebase_admin.auth.verify_id_token と同じです。
+    Auth エミュレータの使用時と、ID_TOKEN_CERT_PREFETCH_ENABLED が無効な場合は auth.verify_id_token に委譲します。
+    証明書をまだ取得できていない場合 (起動直後) は、取得の完了を ID_TOKEN_CERT_WAIT_SECONDS まで待ち、
+    取得できなければ auth.CertificateFetchError を送出します。
+    未知の kid のトークン (鍵のローテーション直後など) は、証明書の再取得を依頼して ID_TOKEN_CERT_WAIT_SECONDS まで待ち、
+    取り直した証明書で1回だけ再確認します。
+    """
+    if os.environ.get("FIREBASE_AUTH_EMULATOR_HOST") or not ID_TOKEN_CERT_PREFETCH_ENABLED:
+        return auth.verify_id_token(id_token, check_revoked=check_revoked)
+
+    certs = id_token_cert_manager.certs()
+    if not certs:
+        id_token_cert_manager.start()  # FUNCTION_TARGET で事前取得していない場合 (ローカル実行など)
+        certs = id_token_cert_manager.wait_for_certs(ID_TOKEN_CERT_WAIT_SECONDS)
+        if not certs:
+            raise auth.CertificateFetchError("ID token certificates are not available yet.", cause=None)
+
+    project_id = get_app().project_id
+    try:
+        header = _decode_jwt_header(id_token)
+        if header.get("alg") != "RS256":
+            raise ValueError(f"Unexpected token algorithm: {header.get('alg')}")
+        if header.get("kid") not in certs:
+            if id_token_cert_manager.request_refresh():
+                logger.info("verify_firebase_id_token: Unknown kid %s; requested a certificate refresh.", header.get("kid"))
+            certs = id_token_cert_manager.wait_for_refresh(ID_TOKEN_CERT_WAIT_SECONDS)
+            if header.get("kid") not in certs:
+                raise ValueError(f"Unknown token key id: {header.get('kid')}")
+        claims = google_jwt.decode(id_token, certs=certs, audience=project_id)
+        if claims.get("iss") != f"https://securetoken.google.com/{project_id}":
+            raise ValueError(f"Unexpected token issuer: {claims.get('iss')}")
+        subject = claims.get("sub")
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise ValueError("Token has an invalid subject (sub) claim.")
+    except ValueError as token_error:
+        if "expired" in str(token_error).lower():
+            raise auth.ExpiredIdTokenError(f"Token expired: {token_error}", cause=token_error)
+        raise auth.InvalidIdTokenError(f"Invalid ID token: {token_error}", cause=token_error)
+
+    claims["uid"] = subject
+    if check_revoked:
+        user = auth.get_user(subject)
+        if user.disabled:
+            raise auth.UserDisabledError("The user record is disabled.")
+        if claims.get("iat", 0) * 1000 < (user.tokens_valid_after_timestamp or 0):
+            raise auth.RevokedIdTokenError("The Firebase ID token has been revoked.")
+    return claims
+
+
+class IdTokenCache:
+    """
+    ID トークン (の SHA-256) → 検証済みのクレーム を記憶する TLRU キャッシュ。
+    ダッシュボードは同じトークンで何度も generate_or_fetch_api_key を呼ぶため、
+    署名検証と JWT の解析をトークンの有効期限 (exp) まで省略します。
+    エントリごとの失効時刻は min(exp - マージン, 現在 + max_ttl) です。スレッドセーフです。
+    """
+
+    def __init__(self, maxsize: int):
+        self._cache = TLRUCache(maxsize=maxsize, ttu=lambda _key, value, _now: value[1], timer=time.time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _cache_key(id_token: str) -> str:
+        return hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+
+    def get(self, id_token: str) -> dict | None:
+        with self._lock:
+            cached = self._cache.get(self._cache_key(id_token))
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return cached[0]
+
+    def put(self, id_token: str, claims: dict, max_ttl: float | None = None):
+        now = time.time()
+        expires_at = claims.get("exp", now) - ID_TOKEN_CACHE_EXPIRY_MARGIN_SECONDS
+        if max_ttl is not None:
+            expires_at = min(expires_at, now + max_ttl)
+        if expires_at <= now:
+            return
+        with self._lock:
+            self._cache[self._cache_key(id_token)] = (claims, expires_at)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache), "maxsize": self._cache.maxsize}
+
+
+id_token_cache = IdTokenCache(maxsize=ID_TOKEN_CACHE_MAX_SIZE)
+
+
+def verify_id_token_cached(id_token: str) -> dict:
+    """
+    ID トークンを検証してクレームを返します。検証済みのトークンはキャッシュから返します。
+    検証に失敗した場合は firebase_admin.auth の例外をそのまま送出します (失敗はキャッシュしません)。
+    ID_TOKEN_CHECK_REVOKED が有効な場合は失効も確認し、キャッシュ期間を ID_TOKEN_CACHE_REVOKED_TTL_SECONDS までにします。
+    """
+    claims = id_token_cache.get(id_token)
+    if claims is not None:
+        return claims
+
+    claims = verify_firebase_id_token(id_token, check_revoked=ID_TOKEN_CHECK_REVOKED)
+    id_token_cache.put(id_token, claims, max_ttl=ID_TOKEN_CACHE_REVOKED_TTL_SECONDS if ID_TOKEN_CHECK_REVOKED else None)
+    return claims
+
+
+def parse_usage_units(raw_units) -> int:
+    """
+    1回の呼び出しで消費する単位数 (units) を検証して返します。省略時 (None) は 1。
+    1〜MAX_USAGE_UNITS_PER_ITEM の整数 (ヘッダー由来の数字文字列を含む) 以外は ValueError を送出します。
+    """
+    if raw_units is None:
+        return 1
+    if isinstance(raw_units, str) and raw_units.strip().isdigit():
+        raw_units = int(raw_units.strip())
+    if isinstance(raw_units, bool) or not isinstance(raw_units, int) or not 1 <= raw_units <= MAX_USAGE_UNITS_PER_ITEM:
+        raise ValueError(f"units must be an integer between 1 and {MAX_USAGE_UNITS_PER_ITEM}.")
+    return raw_units
+
+
+def build_processed_transaction_data(
+        api_key_short_log: str,
+        key_doc_id: str,
+        recorded_usage_count: int | None,
+        billing_period: str | None = None,
+        units: int = 1,
+        lease_id: str | None = None
+) -> dict:
+    """
+    processedTransactions に保存する冪等性レコードを生成します。
+    リースから消費した場合は leaseId を記録します (失われたリースの回収時に使用分を数えるため)。
+    """
+    data = {
+        "processedAt": firestore.SERVER_TIMESTAMP,
+        "apiKeyIdentifier": api_key_short_log,
+        "recordedUsageCount": recorded_usage_count,
+        "units": units,
+        "apiKeyDocId": key_doc_id,
+        "billingPeriod": billing_period or current_billing_period(),
+        "expiresAt": datetime.now(timezone.utc) + timedelta(days=PROCESSED_TRANSACTION_TTL_DAYS)
+    }
+    if lease_id is not None:
+        data["leaseId"] = lease_id
+    return data
+
+
+def create_already_recorded_response(processed_data: dict, req: https_fn.Request | None = None) -> https_fn.Response:
+    """処理済みの transactionId に対する成功レスポンスを生成します。"""
+    return create_success_response(data={
+        "status": "success",
+        "message": "Usage already recorded for this transactionId.",
+        "recordedUsageCount": processed_data.get("recordedUsageCount", "N/A")
+    }, req=req)
 
 
 # === Cloud Functions ===
@@ -176,7 +2469,7 @@ def helloWorld(req: https_fn.Request) -> https_fn.Response:
         })
         logger.info("helloWorld: Firestore write successful.")
     except Exception as e:
-        logger.error(f"helloWorld: Firestore write failed: {e}", exc_info=DEBUG_MODE)
+        logger.error("helloWorld: Firestore write failed: %s", e, exc_info=DEBUG_MODE)
     return create_success_response(
         data="Hello from Firebase in helloWorld! Firestore pinged.",
         content_type="text/plain"
@@ -184,6 +2477,7 @@ def helloWorld(req: https_fn.Request) -> https_fn.Response:
 
 
 @https_fn.on_request()
+@with_server_timing
 def verify_api_key(req: https_fn.Request) -> https_fn.Response:
     """
     【既存アプリ用】APIキーを検証し、利用回数をチェック・カウントアップする。
@@ -199,7 +2493,6 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
             status_code=500
         )
 
-    logger.info("verify_api_key: Received request (for existing apps).")
     api_key = req.headers.get("X-API-KEY")
 
     if not api_key:
@@ -210,47 +2503,69 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
             status_code=401
         )
 
+    try:
+        units = parse_usage_units(req.headers.get(USAGE_UNITS_HEADER))
+    except ValueError as units_error:
+        return create_error_response(
+            internal_message=f"verify_api_key: Invalid {USAGE_UNITS_HEADER} header: {units_error}",
+            public_message=str(units_error),
+            status_code=400
+        )
+
     api_key_short_log = api_key[:len(API_KEY_PREFIX) + 3] + "..." if len(api_key) > (len(API_KEY_PREFIX) + 3) else api_key
-    logger.info(f"verify_api_key: Attempting to verify and increment for key {api_key_short_log}")
+    logger.info(
+        "verify_api_key: Attempting to verify and increment by %s for key %s", units, api_key_short_log,
+        extra=log_fields("request", endpoint="verify_api_key", units=units)
+    )
 
     try:
-        keys_collection_ref = db.collection("apiKeys")
-        query = keys_collection_ref.where(filter=FieldFilter("key", "==", api_key)).limit(1)
-        docs = list(query.stream())
+        key_entry, _ = lookup_api_key(api_key)
 
-        if not docs:
-            logger.warning(f"verify_api_key: API key not found: {api_key_short_log}")
+        if key_entry is None:
+            logger.warning("verify_api_key: API key not found: %s", api_key_short_log)
             return create_error_response(
                 internal_message=f"API key not found: {api_key_short_log}",
                 public_message="Invalid API key.",
                 status_code=403
             )
 
-        key_doc_snapshot = docs[0]
-        key_doc_ref: DocumentReference = key_doc_snapshot.reference
-        key_data: dict = key_doc_snapshot.to_dict()
-        if key_data is None:
-            logger.error(f"verify_api_key: Document {key_doc_snapshot.id} has no data for key {api_key_short_log}.")
-            return create_error_response(
-                internal_message=f"Document {key_doc_snapshot.id} has no data for key {api_key_short_log}.",
-                public_message="API key data corrupted.",
-                status_code=500
-            )
-        doc_id = key_doc_snapshot.id
+        doc_id = key_entry.doc_id
+        key_doc_ref: DocumentReference = db.collection("apiKeys").document(doc_id)
 
-        if not key_data.get("isEnabled", False):
-            logger.warning(f"verify_api_key: API key is disabled: {api_key_short_log} (Doc ID: {doc_id})")
+        if not key_entry.is_enabled:
+            logger.warning("verify_api_key: API key is disabled: %s (Doc ID: %s)", api_key_short_log, doc_id)
             return create_error_response(
                 internal_message=f"API key disabled: {api_key_short_log}",
                 public_message="API key disabled.",
                 status_code=403
             )
 
+        if key_entry.usage_shard_count > 1:
+            # シャードモード: キードキュメントへのトランザクションを行わず、分散カウンタに加算する
+            sharded_result = record_sharded_usage(
+                key_doc_ref, key_entry.usage_shard_count, key_entry.usage_limit, units=units
+            )
+            if sharded_result["limit_exceeded"]:
+                return create_error_response(
+                    internal_message=f"Usage limit exceeded for key {api_key_short_log} (sharded).",
+                    public_message="Usage limit exceeded.",
+                    status_code=429
+                )
+            owner_uid = key_entry.user_uid or "unknown"
+            logger.info(
+                "verify_api_key: Success, sharded usage incremented for key %s.", api_key_short_log,
+                extra=log_fields("success", endpoint="verify_api_key", ownerUid=owner_uid, sharded=True)
+            )
+            return create_success_response(
+                data={"message": f"API key verified and usage recorded for user {owner_uid}", "isApproximate": True}
+            )
+
         firestore_transaction: Transaction = db.transaction()
         transaction_result_container = {
             "updated": False,
             "limit_exceeded": False,
-            "owner_uid": key_data.get("user_uid", "unknown")
+            "disabled": False,
+            "owner_uid": key_entry.user_uid or "unknown"
         }
 
         @firestore.transactional
@@ -259,7 +2574,8 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
             doc_ref_in_transaction: DocumentReference,
             result_container: dict
         ):
-            snapshot = doc_ref_in_transaction.get(transaction=transaction_obj)
+            with TimingSpan("txn_read"):
+                snapshot = doc_ref_in_transaction.get(transaction=transaction_obj)
             if not snapshot.exists:
                 raise google_exceptions.NotFound(
                     f"API key document {doc_ref_in_transaction.id} disappeared during transaction."
@@ -269,57 +2585,40 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
             if current_data is None:
                 raise ValueError(f"Document {snapshot.id} data is unexpectedly None in transaction.")
 
-            usage_count: int = current_data.get("usageCount", 0)
+            # キャッシュ上は有効でも、実データで無効化されていれば拒否する
+            if not current_data.get("isEnabled", False):
+                result_container["disabled"] = True
+                return
+
             usage_limit: int = current_data.get("usageLimit", DEFAULT_USAGE_LIMIT)
-            last_reset_timestamp: datetime | None = current_data.get("lastReset")
-
-            now_utc = datetime.now(timezone.utc)
-            needs_reset = False
-            if last_reset_timestamp:
-                last_reset_dt_utc = last_reset_timestamp.replace(tzinfo=timezone.utc) \
-                    if last_reset_timestamp.tzinfo is None \
-                    else last_reset_timestamp.astimezone(timezone.utc)
-
-                is_new_billing_month = (
-                    last_reset_dt_utc.year < now_utc.year or
-                    (last_reset_dt_utc.year == now_utc.year and last_reset_dt_utc.month < now_utc.month)
-                )
-                if is_new_billing_month:
-                    needs_reset = True
-
-            if needs_reset:
-                logger.info(f"verify_api_key (transaction): Resetting usage for {doc_ref_in_transaction.id}")
-                # リセットして、今回の使用分(1)をカウントする
-                update_data = {
-                    "usageCount": 1,
-                    "lastReset": firestore.SERVER_TIMESTAMP
-                }
-                transaction_obj.update(doc_ref_in_transaction, update_data)
-                result_container["updated"] = True
-                logger.info(f"verify_api_key (transaction): Usage count reset and set to 1 for {doc_ref_in_transaction.id}.")
-            else:  # 月替わりリセットが不要な場合
-                if usage_count >= usage_limit:
-                    logger.warning(
-                        f"verify_api_key (transaction): Usage limit exceeded for {doc_ref_in_transaction.id}. "
-                        f"Count: {usage_count}, Limit: {usage_limit}"
-                    )
-                    result_container["limit_exceeded"] = True
-                    return
+            period = current_billing_period()
+            usage_count = get_period_usage(current_data, period)
 
-                # 既存のカウントをインクリメント
-                update_data = {"usageCount": firestore.Increment(1)}
-                transaction_obj.update(doc_ref_in_transaction, update_data)
-                result_container["updated"] = True
-                logger.info(
-                    f"verify_api_key (transaction): Usage count incremented for {doc_ref_in_transaction.id}. "
-                    f"New count will be {usage_count + 1}"
+            if usage_count + units > usage_limit:
+                logger.warning(
+                    "verify_api_key (transaction): Usage limit exceeded for %s. Period: %s, Count: %s, Units: %s, Limit: %s",
+                    doc_ref_in_transaction.id, period, usage_count, units, usage_limit
                 )
+                result_container["limit_exceeded"] = True
+                return
 
-        try:
-            check_and_update_usage_in_transaction(
-                firestore_transaction, key_doc_ref, transaction_result_container
+            # 現在の期間の利用回数をインクリメント (月替わりのリセット書き込みは不要)
+            transaction_obj.update(
+                doc_ref_in_transaction, build_period_usage_increment(current_data, period, units)
             )
+            result_container["updated"] = True
+            logger.debug(
+                "verify_api_key (transaction): Usage count incremented for %s. Period: %s, New count will be %s",
+                doc_ref_in_transaction.id, period, usage_count + units
+            )
+
+        try:
+            with TimingSpan("txn"):
+                check_and_update_usage_in_transaction(
+                    firestore_transaction, key_doc_ref, transaction_result_container
+                )
         except google_exceptions.NotFound as doc_missing_err:
+            api_key_cache.invalidate(hash_api_key(api_key))
             return create_error_response(
                 internal_message=f"verify_api_key: Transaction aborted, key {api_key_short_log} disappeared: {doc_missing_err}",
                 public_message="Failed to update usage: API key may have been deleted.",
@@ -334,6 +2633,15 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
                 log_exception=True
             )
 
+        if transaction_result_container["disabled"]:
+            api_key_cache.invalidate(hash_api_key(api_key))
+            logger.warning("verify_api_key: API key is disabled: %s (Doc ID: %s)", api_key_short_log, doc_id)
+            return create_error_response(
+                internal_message=f"API key disabled: {api_key_short_log}",
+                public_message="API key disabled.",
+                status_code=403
+            )
+
         if transaction_result_container["limit_exceeded"]:
             return create_error_response(
                 internal_message=f"Usage limit exceeded for key {api_key_short_log}.",
@@ -343,8 +2651,8 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
 
         if transaction_result_container["updated"]:
             logger.info(
-                f"verify_api_key: Success, usage incremented for key {api_key_short_log}. "
-                f"Owner UID: {transaction_result_container['owner_uid']}"
+                "verify_api_key: Success, usage incremented for key %s.", api_key_short_log,
+                extra=log_fields("success", endpoint="verify_api_key", ownerUid=transaction_result_container["owner_uid"])
             )
             return create_success_response(
                 data={"message": f"API key verified and usage recorded for user {transaction_result_container['owner_uid']}"}
@@ -352,8 +2660,8 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
         else:
             # このパスはロジック修正により到達しにくくなったはずだが、念のため残す
             logger.error(
-                f"verify_api_key: Transaction for {api_key_short_log} finished unexpectedly "
-                "(not updated, not limit exceeded)."
+                "verify_api_key: Transaction for %s finished unexpectedly (not updated, not limit exceeded).",
+                api_key_short_log
             )
             return create_error_response(
                 internal_message=f"verify_api_key: Transaction for key {api_key_short_log} finished unexpectedly.",
@@ -378,6 +2686,7 @@ def verify_api_key(req: https_fn.Request) -> https_fn.Response:
 
 
 @https_fn.on_request()
+@with_server_timing
 def check_api_key_status(req: https_fn.Request) -> https_fn.Response:
     """
     APIキーの有効性、利用状況（残り回数など）を返します。
@@ -391,7 +2700,6 @@ def check_api_key_status(req: https_fn.Request) -> https_fn.Response:
             status_code=500
         )
 
-    logger.info("check_api_key_status: Received request.")
     api_key = req.headers.get("X-API-KEY")
 
     if not api_key:
@@ -403,63 +2711,65 @@ def check_api_key_status(req: https_fn.Request) -> https_fn.Response:
         )
 
     api_key_short_log = api_key[:len(API_KEY_PREFIX) + 3] + "..." if len(api_key) > (len(API_KEY_PREFIX) + 3) else api_key
-    logger.info(f"check_api_key_status: Verifying key starting with {api_key_short_log}")
+    logger.info(
+        "check_api_key_status: Verifying key starting with %s", api_key_short_log,
+        extra=log_fields("request", endpoint="check_api_key_status")
+    )
 
     try:
-        keys_collection_ref = db.collection("apiKeys")
-        query = keys_collection_ref.where(filter=FieldFilter("key", "==", api_key)).limit(1)
-        docs = list(query.stream())
+        key_hash = hash_api_key(api_key)
+        cached_status = api_key_status_cache.get(key_hash)
+        if cached_status is not None:
+            # max-age 以内に取得した利用状況をそのまま返す (Firestore は読まない)
+            _, etag, response_data = cached_status
+            logger.info(
+                "check_api_key_status: Served cached status for %s.", api_key_short_log,
+                extra=log_fields("success", endpoint="check_api_key_status", cached=True, **response_data)
+            )
+            return create_status_response(req, etag, response_data)
+
+        key_entry, key_doc_snapshot = lookup_api_key(api_key)
 
-        if not docs:
-            logger.warning(f"check_api_key_status: API key not found or invalid: {api_key_short_log}")
+        if key_entry is not None and key_doc_snapshot is None and key_entry.is_enabled:
+            # キャッシュヒット: キーの解決は省略し、利用状況のみドキュメントIDで直接取得する
+            with TimingSpan("key_read"):
+                key_doc_snapshot = db.collection("apiKeys").document(key_entry.doc_id).get()
+            if key_doc_snapshot.exists:
+                api_key_cache.put(key_hash, build_api_key_cache_entry(key_doc_snapshot))
+            else:
+                api_key_cache.invalidate(key_hash)
+                key_entry = None
+
+        if key_entry is None:
+            logger.warning("check_api_key_status: API key not found or invalid: %s", api_key_short_log)
             return create_error_response(
                 internal_message=f"API key not found: {api_key_short_log}",
                 public_message="Invalid API key.",
                 status_code=403
             )
 
-        key_doc_snapshot = docs[0]
-        key_data: dict | None = key_doc_snapshot.to_dict()
-        if key_data is None:
-            logger.error(f"check_api_key_status: Document {key_doc_snapshot.id} has no data for key {api_key_short_log}.")
-            return create_error_response(
-                internal_message=f"Document {key_doc_snapshot.id} has no data for key {api_key_short_log}.",
-                public_message="API key data corrupted.",
-                status_code=500
-            )
-        doc_id = key_doc_snapshot.id
-        logger.info(f"check_api_key_status: Found key document {doc_id} for {api_key_short_log}")
+        doc_id = key_entry.doc_id
+        key_data: dict = (key_doc_snapshot.to_dict() or {}) if key_doc_snapshot is not None else {}
+        logger.debug("check_api_key_status: Found key document %s for %s", doc_id, api_key_short_log)
 
-        if not key_data.get("isEnabled", False):
-            logger.warning(f"check_api_key_status: API key is disabled: {api_key_short_log} (Doc ID: {doc_id})")
+        if not key_data.get("isEnabled", key_entry.is_enabled):
+            logger.warning("check_api_key_status: API key is disabled: %s (Doc ID: %s)", api_key_short_log, doc_id)
             return create_error_response(
                 internal_message=f"API key disabled: {api_key_short_log}",
                 public_message="API key disabled.",
                 status_code=403
             )
 
-        usage_count: int = key_data.get("usageCount", 0)
-        usage_limit: int = key_data.get("usageLimit", DEFAULT_USAGE_LIMIT)
-        last_reset_timestamp: datetime | None = key_data.get("lastReset")
-
-        now_utc = datetime.now(timezone.utc)
-        effective_usage_count = usage_count
-
-        if last_reset_timestamp:
-            last_reset_dt_utc = last_reset_timestamp.replace(tzinfo=timezone.utc) \
-                if last_reset_timestamp.tzinfo is None \
-                else last_reset_timestamp.astimezone(timezone.utc)
+        usage_limit: int = key_data.get("usageLimit", DEFAULT_USAGE_LIMIT)
+        period = current_billing_period()
 
-            is_new_billing_month = (
-                last_reset_dt_utc.year < now_utc.year or
-                (last_reset_dt_utc.year == now_utc.year and last_reset_dt_utc.month < now_utc.month)
-            )
-            if is_new_billing_month:
-                effective_usage_count = 0
-                logger.info(
-                    f"check_api_key_status: Key {api_key_short_log} is due for a monthly reset. "
-                    "Effective count is 0 for this check."
-                )
+        if get_usage_shard_count(key_data) > 1:
+            # シャードモード: 利用回数は請求期間ごとに分散カウンタへ記録されている
+            effective_usage_count = read_sharded_usage(db.collection("apiKeys").document(doc_id), period, key_data)
+        else:
+            effective_usage_count = get_period_usage(key_data, period)
+        # 利用回数は請求期間ごとに記録しているため、最後のリセット日時は現在の期間の開始日時になる
+        last_reset_timestamp = billing_period_start(period)
 
         remaining_usages = usage_limit - effective_usage_count
         is_limit_reached = remaining_usages <= 0
@@ -471,10 +2781,15 @@ def check_api_key_status(req: https_fn.Request) -> https_fn.Response:
             "usageLimit": usage_limit,
             "remainingUsages": max(0, remaining_usages),
             "isLimitReached": is_limit_reached,
-            "lastReset": (last_reset_timestamp.isoformat() if last_reset_timestamp else None),
+            "lastReset": last_reset_timestamp.isoformat(),
         }
-        logger.info(f"check_api_key_status: Success for {api_key_short_log}. Status: {response_data}")
-        return create_success_response(data=response_data)
+        etag = build_status_etag(doc_id, key_doc_snapshot.update_time, response_data)
+        api_key_status_cache.put(key_hash, doc_id, etag, response_data)
+        logger.info(
+            "check_api_key_status: Success for %s.", api_key_short_log,
+            extra=log_fields("success", endpoint="check_api_key_status", cached=False, **response_data)
+        )
+        return create_status_response(req, etag, response_data)
 
     except google_exceptions.RetryError as e:
         return create_error_response(
@@ -492,7 +2807,77 @@ def check_api_key_status(req: https_fn.Request) -> https_fn.Response:
         )
 
 
+@firestore.transactional
+def _record_usage_in_transaction(
+        transaction_obj: Transaction,
+        doc_ref: DocumentReference,
+        txn_ref: DocumentReference,
+        units: int,
+        api_key_short_log: str,
+        result_container: dict
+):
+    """
+    record_api_usage のトランザクション本体。冪等性レコードとキードキュメントを1往復で読み取り、
+    未処理かつ上限の範囲内であれば、現在の期間の利用回数の加算と冪等性レコードの作成を1回でコミットします。
+    結果 (記録済み・無効・上限超過・加算後の利用回数) は result_container に格納します。
+    """
+    # 冪等性レコードとキードキュメントを1往復でまとめて読み取る
+    with TimingSpan("txn_read"):
+        snapshots = {snap.reference.path: snap for snap in transaction_obj.get_all([txn_ref, doc_ref])}
+    txn_snapshot = snapshots.get(txn_ref.path)
+    if txn_snapshot is not None and txn_snapshot.exists:
+        result_container["already_processed_data"] = txn_snapshot.to_dict() or {}
+        return
+
+    snapshot = snapshots.get(doc_ref.path)
+    if snapshot is None or not snapshot.exists:
+        raise google_exceptions.NotFound(
+            f"API key document {doc_ref.id} disappeared during transaction."
+        )
+
+    current_data = snapshot.to_dict()
+    if current_data is None:
+        raise ValueError(f"Document {snapshot.id} data is unexpectedly None in transaction.")
+
+    # キャッシュ上は有効でも、実データで無効化されていれば拒否する
+    if not current_data.get("isEnabled", False):
+        result_container["disabled_in_txn"] = True
+        return
+
+    usage_limit: int = current_data.get("usageLimit", DEFAULT_USAGE_LIMIT)
+    result_container["usage_limit"] = usage_limit
+    period = current_billing_period()
+    usage_count = get_period_usage(current_data, period)
+
+    if usage_count + units > usage_limit:
+        logger.warning(
+            "record_api_usage (transaction): Usage limit exceeded for %s. Period: %s, Count: %s, Units: %s, Limit: %s",
+            doc_ref.id, period, usage_count, units, usage_limit
+        )
+        result_container["limit_exceeded_in_txn"] = True
+        return
+
+    # 現在の期間の利用回数をインクリメント (月替わりのリセット書き込みは不要)
+    transaction_obj.update(doc_ref, build_period_usage_increment(current_data, period, units))
+
+    result_container["final_usage_count"] = usage_count + units
+    logger.debug(
+        "record_api_usage (transaction): Usage count incremented for %s. Period: %s, New effective count: %s",
+        doc_ref.id, period, result_container['final_usage_count']
+    )
+
+    # 冪等性レコードを同じトランザクションで作成する (コミットは1回)
+    transaction_obj.create(txn_ref, build_processed_transaction_data(
+        api_key_short_log,
+        doc_ref.id,
+        result_container["final_usage_count"],
+        billing_period=period,
+        units=units
+    ))
+
+
 @https_fn.on_request()
+@with_server_timing
 def record_api_usage(req: https_fn.Request) -> https_fn.Response:
     """
     APIキーを検証し、利用回数をインクリメントします。冪等性対応済み。
@@ -505,7 +2890,6 @@ def record_api_usage(req: https_fn.Request) -> https_fn.Response:
             status_code=500
         )
 
-    logger.info("record_api_usage: Received request.")
     api_key = req.headers.get("X-API-KEY")
 
     if not api_key:
@@ -533,6 +2917,15 @@ def record_api_usage(req: https_fn.Request) -> https_fn.Response:
                 public_message="transactionId cannot be empty.",
                 status_code=400
             )
+        try:
+            units = parse_usage_units(request_body.get("units"))
+        except ValueError as units_error:
+            logger.warning("record_api_usage: Invalid units provided: %s", units_error)
+            return create_error_response(
+                internal_message=f"Invalid units provided: {units_error}",
+                public_message=str(units_error),
+                status_code=400
+            )
     except Exception as body_parse_error:
         return create_error_response(
             internal_message=f"record_api_usage: Error parsing request body: {body_parse_error}",
@@ -542,130 +2935,173 @@ def record_api_usage(req: https_fn.Request) -> https_fn.Response:
         )
 
     api_key_short_log = api_key[:len(API_KEY_PREFIX) + 3] + "..." if len(api_key) > (len(API_KEY_PREFIX) + 3) else api_key
-    logger.info(f"record_api_usage: Attempting for key {api_key_short_log}, transactionId: {transaction_id}")
+    logger.info(
+        "record_api_usage: Attempting for key %s, transactionId: %s", api_key_short_log, transaction_id,
+        extra=log_fields("request", endpoint="record_api_usage", transactionId=transaction_id, units=units)
+    )
 
     try:
-        processed_txn_ref = db.collection("processedTransactions").document(transaction_id)
-        processed_txn_doc = processed_txn_ref.get()
+        # 直近このインスタンスで記録済みの transactionId (リトライ) は Firestore を読まずに応答する
+        key_hash = hash_api_key(api_key)
+        recent_processed_data = recent_transaction_cache.get(key_hash, transaction_id)
+        if recent_processed_data is not None:
+            logger.info(
+                "record_api_usage: Transaction ID %s already processed (instance cache).", transaction_id,
+                extra=log_fields("already_recorded", endpoint="record_api_usage", transactionId=transaction_id)
+            )
+            return create_already_recorded_response(recent_processed_data, req)
 
-        if processed_txn_doc.exists:
-            logger.info(f"record_api_usage: Transaction ID {transaction_id} already processed.")
-            processed_data = processed_txn_doc.to_dict()
-            if processed_data is None:
-                processed_data = {}
-            return create_success_response(data={
-                "status": "success",
-                "message": "Usage already recorded for this transactionId.",
-                "recordedUsageCount": processed_data.get("recordedUsageCount", "N/A")
-            })
+        # 冪等性レコードの存在確認は、利用回数を加算するトランザクション内の読み取りで行う。
+        # キャッシュミスでキーを Firestore から解決する場合は、同じ get_all で冪等性レコードも先読みする
+        processed_txn_ref = db.collection("processedTransactions").document(transaction_id)
+        prefetched = {}
 
-        keys_collection_ref = db.collection("apiKeys")
-        query = keys_collection_ref.where(filter=FieldFilter("key", "==", api_key)).limit(1)
-        key_docs = list(query.stream())
+        key_entry, _ = lookup_api_key(api_key, prefetch_refs=[processed_txn_ref], prefetched=prefetched)
 
-        if not key_docs:
-            logger.warning(f"record_api_usage: API key not found: {api_key_short_log}")
+        if key_entry is None:
+            logger.warning("record_api_usage: API key not found: %s", api_key_short_log)
             return create_error_response(
                 internal_message=f"API key not found: {api_key_short_log}",
                 public_message="Invalid API key.",
                 status_code=403
             )
 
-        key_doc_snapshot = key_docs[0]
-        key_doc_ref: DocumentReference = key_doc_snapshot.reference
-        key_data_outside_txn: dict | None = key_doc_snapshot.to_dict()
-        if key_data_outside_txn is None:
-            logger.error(f"record_api_usage: API key document {key_doc_snapshot.id} has no data (outside txn).")
-            return create_error_response(
-                internal_message=f"API key document {key_doc_snapshot.id} has no data (outside txn).",
-                public_message="API key data corrupted.",
-                status_code=500
+        prefetched_txn_snapshot = prefetched.get(processed_txn_ref.path)
+        if prefetched_txn_snapshot is not None and prefetched_txn_snapshot.exists:
+            logger.info(
+                "record_api_usage: Transaction ID %s already processed (prefetched).", transaction_id,
+                extra=log_fields("already_recorded", endpoint="record_api_usage", transactionId=transaction_id)
             )
+            processed_data = prefetched_txn_snapshot.to_dict() or {}
+            recent_transaction_cache.put(key_hash, transaction_id, processed_data.get("recordedUsageCount", "N/A"))
+            return create_already_recorded_response(processed_data, req)
+
+        key_doc_ref: DocumentReference = db.collection("apiKeys").document(key_entry.doc_id)
 
-        if not key_data_outside_txn.get("isEnabled", False):
-            logger.warning(f"record_api_usage: API key is disabled: {api_key_short_log}")
+        if not key_entry.is_enabled:
+            logger.warning("record_api_usage: API key is disabled: %s", api_key_short_log)
             return create_error_response(
                 internal_message=f"API key disabled: {api_key_short_log}",
                 public_message="API key disabled.",
                 status_code=403
             )
 
-        firestore_transaction: Transaction = db.transaction()
-        transaction_result_container = {
-            "final_usage_count": None,
-            "limit_exceeded_in_txn": False,
-            "was_reset_in_txn": False
-        }
-
-        @firestore.transactional
-        def update_usage_in_transaction_logic(
-            transaction_obj: Transaction,
-            doc_ref: DocumentReference,
-            result_container: dict
-        ):
-            snapshot = doc_ref.get(transaction=transaction_obj)
-            if not snapshot.exists:
-                raise google_exceptions.NotFound(
-                    f"API key document {doc_ref.id} disappeared during transaction."
+        if key_entry.usage_shard_count > 1:
+            # シャードモード: 分散カウンタへの加算と冪等性レコードの作成を1つのバッチで行う
+            try:
+                sharded_result = record_sharded_usage(
+                    key_doc_ref,
+                    key_entry.usage_shard_count,
+                    key_entry.usage_limit,
+                    units=units,
+                    processed_txn_ref=processed_txn_ref,
+                    processed_txn_data=build_processed_transaction_data(
+                        api_key_short_log, key_doc_ref.id, None, units=units
+                    )
                 )
-
-            current_data = snapshot.to_dict()
-            if current_data is None:
-                raise ValueError(f"Document {snapshot.id} data is unexpectedly None in transaction.")
-
-            usage_count: int = current_data.get("usageCount", 0)
-            usage_limit: int = current_data.get("usageLimit", DEFAULT_USAGE_LIMIT)
-            last_reset_timestamp: datetime | None = current_data.get("lastReset")
-
-            now_utc = datetime.now(timezone.utc)
-            needs_reset = False
-            if last_reset_timestamp:
-                last_reset_dt_utc = last_reset_timestamp.replace(tzinfo=timezone.utc) \
-                    if last_reset_timestamp.tzinfo is None \
-                    else last_reset_timestamp.astimezone(timezone.utc)
-
-                is_new_billing_month = (
-                    last_reset_dt_utc.year < now_utc.year or
-                    (last_reset_dt_utc.year == now_utc.year and last_reset_dt_utc.month < now_utc.month)
+            except google_exceptions.AlreadyExists:
+                logger.info(
+                    "record_api_usage: Transaction ID %s already processed.", transaction_id,
+                    extra=log_fields("already_recorded", endpoint="record_api_usage", transactionId=transaction_id)
+                )
+                with TimingSpan("idempotency_read"):
+                    processed_data = processed_txn_ref.get().to_dict() or {}
+                recent_transaction_cache.put(key_hash, transaction_id, processed_data.get("recordedUsageCount", "N/A"))
+                return create_already_recorded_response(processed_data, req)
+            if sharded_result["limit_exceeded"]:
+                return create_error_response(
+                    internal_message=f"Usage limit exceeded for key {api_key_short_log} (sharded).",
+                    public_message="Usage limit exceeded.",
+                    status_code=429
+                )
+            final_usage_count = sharded_result["final_usage_count"]
+            usage_limit = sharded_result["usage_limit"]
+            recent_transaction_cache.put(key_hash, transaction_id, final_usage_count)
+            logger.info(
+                "record_api_usage: Successfully recorded sharded usage for key %s, txnId %s.", api_key_short_log, transaction_id,
+                extra=log_fields(
+                    "success", endpoint="record_api_usage", transactionId=transaction_id,
+                    mode="sharded", effectiveUsageCount=final_usage_count, usageLimit=usage_limit
+                )
+            )
+            return create_success_response(data={
+                "status": "success",
+                "message": "Usage recorded successfully.",
+                "newEffectiveUsageCount": final_usage_count,
+                "remainingUsages": max(0, usage_limit - final_usage_count),
+                "usageLimit": usage_limit,
+                "isApproximate": True
+            }, req=req)
+
+        if USAGE_LEASE_ENABLED:
+            # リースモード: インスタンスが予約済みの枠から消費し、冪等性レコードのみを書き込む
+            lease_result = usage_lease_manager.consume(key_doc_ref, units)
+            if lease_result["disabled"]:
+                api_key_cache.invalidate(hash_api_key(api_key))
+                return create_error_response(
+                    internal_message=f"API key disabled: {api_key_short_log}",
+                    public_message="API key disabled.",
+                    status_code=403
                 )
-                if is_new_billing_month:
-                    needs_reset = True
-
-            if needs_reset:
-                logger.info(f"record_api_usage (transaction): Resetting usage for {doc_ref.id}")
-                result_container["was_reset_in_txn"] = True
-                # リセットして、今回の使用分(1)をカウントする
-                update_data = {
-                    "usageCount": 1,
-                    "lastReset": firestore.SERVER_TIMESTAMP
-                }
-                transaction_obj.update(doc_ref, update_data)
-                result_container["final_usage_count"] = 1
-                logger.info(f"record_api_usage (transaction): Usage count reset and set to 1 for {doc_ref.id}.")
-            else:  # 月替わりリセットが不要な場合
-                if usage_count >= usage_limit:
-                    logger.warning(
-                        f"record_api_usage (transaction): Usage limit exceeded for {doc_ref.id}. "
-                        f"Count: {usage_count}, Limit: {usage_limit}"
+            if lease_result["consumed"]:
+                final_usage_count = lease_result["effective_usage_count"]
+                usage_limit = lease_result["usage_limit"]
+                try:
+                    with TimingSpan("idempotency_write"):
+                        processed_txn_ref.create(
+                            build_processed_transaction_data(
+                                api_key_short_log, key_doc_ref.id, final_usage_count,
+                                units=units, lease_id=lease_result["lease_id"]
+                            )
+                        )
+                except google_exceptions.AlreadyExists:
+                    usage_lease_manager.refund(key_doc_ref.id, units)
+                    logger.info(
+                        "record_api_usage: Transaction ID %s already processed.", transaction_id,
+                        extra=log_fields("already_recorded", endpoint="record_api_usage", transactionId=transaction_id)
                     )
-                    result_container["limit_exceeded_in_txn"] = True
-                    return
-
-                # 既存のカウントをインクリメント
-                update_data = {"usageCount": firestore.Increment(1)}
-                transaction_obj.update(doc_ref, update_data)
-
-                result_container["final_usage_count"] = usage_count + 1
+                    with TimingSpan("idempotency_read"):
+                        processed_data = processed_txn_ref.get().to_dict() or {}
+                    recent_transaction_cache.put(key_hash, transaction_id, processed_data.get("recordedUsageCount", "N/A"))
+                    return create_already_recorded_response(processed_data, req)
+                except Exception:
+                    usage_lease_manager.refund(key_doc_ref.id, units)
+                    raise
+                recent_transaction_cache.put(key_hash, transaction_id, final_usage_count)
                 logger.info(
-                    f"record_api_usage (transaction): Usage count incremented for {doc_ref.id}. "
-                    f"New effective count: {result_container['final_usage_count']}"
+                    "record_api_usage: Successfully recorded leased usage for key %s, txnId %s.", api_key_short_log, transaction_id,
+                    extra=log_fields(
+                        "success", endpoint="record_api_usage", transactionId=transaction_id,
+                        mode="leased", effectiveUsageCount=final_usage_count, usageLimit=usage_limit
+                    )
                 )
+                return create_success_response(data={
+                    "status": "success",
+                    "message": "Usage recorded successfully.",
+                    "newEffectiveUsageCount": final_usage_count,
+                    "remainingUsages": max(0, usage_limit - final_usage_count),
+                    "usageLimit": usage_limit
+                }, req=req)
+            # 残り枠が少なくリースを作れなかった場合は、通常のトランザクションで記録 (上限の判定) を行う
+            logger.debug("record_api_usage: No lease granted for %s; falling back to transaction.", api_key_short_log)
+
+        firestore_transaction: Transaction = db.transaction()
+        transaction_result_container = {
+            "final_usage_count": None,
+            "usage_limit": key_entry.usage_limit,
+            "already_processed_data": None,
+            "limit_exceeded_in_txn": False,
+            "disabled_in_txn": False
+        }
 
         try:
-            update_usage_in_transaction_logic(
-                firestore_transaction, key_doc_ref, transaction_result_container
-            )
+            with TimingSpan("txn"):
+                _record_usage_in_transaction(
+                    firestore_transaction, key_doc_ref, processed_txn_ref, units, api_key_short_log,
+                    transaction_result_container
+                )
         except google_exceptions.NotFound as doc_missing_err:
+            api_key_cache.invalidate(hash_api_key(api_key))
             return create_error_response(
                 internal_message=f"record_api_usage: Transaction aborted, key {api_key_short_log} disappeared: {doc_missing_err}",
                 public_message="Failed to update usage: API key may have been deleted.",
@@ -680,10 +3116,28 @@ def record_api_usage(req: https_fn.Request) -> https_fn.Response:
                 log_exception=True
             )
 
+        if transaction_result_container["already_processed_data"] is not None:
+            logger.info(
+                "record_api_usage: Transaction ID %s already processed.", transaction_id,
+                extra=log_fields("already_recorded", endpoint="record_api_usage", transactionId=transaction_id)
+            )
+            processed_data = transaction_result_container["already_processed_data"]
+            recent_transaction_cache.put(key_hash, transaction_id, processed_data.get("recordedUsageCount", "N/A"))
+            return create_already_recorded_response(processed_data, req)
+
+        if transaction_result_container["disabled_in_txn"]:
+            api_key_cache.invalidate(hash_api_key(api_key))
+            logger.warning("record_api_usage: API key is disabled: %s", api_key_short_log)
+            return create_error_response(
+                internal_message=f"API key disabled: {api_key_short_log}",
+                public_message="API key disabled.",
+                status_code=403
+            )
+
         if transaction_result_container["limit_exceeded_in_txn"]:
             logger.warning(
-                f"record_api_usage: Usage limit exceeded for key {api_key_short_log}, "
-                f"not recording transaction {transaction_id}."
+                "record_api_usage: Usage limit exceeded for key %s, not recording transaction %s.",
+                api_key_short_log, transaction_id
             )
             return create_error_response(
                 internal_message=f"Usage limit exceeded for key {api_key_short_log}.",
@@ -692,32 +3146,21 @@ def record_api_usage(req: https_fn.Request) -> https_fn.Response:
             )
 
         if transaction_result_container["final_usage_count"] is not None:
-            expires_at = datetime.now(timezone.utc) + timedelta(days=PROCESSED_TRANSACTION_TTL_DAYS)
-            processed_txn_ref.set({
-                "processedAt": firestore.SERVER_TIMESTAMP,
-                "apiKeyIdentifier": api_key_short_log,
-                "recordedUsageCount": transaction_result_container["final_usage_count"],
-                "apiKeyDocId": key_doc_ref.id,
-                "wasReset": transaction_result_container["was_reset_in_txn"],
-                "expiresAt": expires_at
-            })
-            
-            # --- ▼▼▼ ここから修正 ▼▼▼ ---
-            
-            # レスポンスに含める残り回数を計算する
-            # transaction_result_container から最新の値を取得
-            # key_data_outside_txn からは古い値しか取れないので注意
-            
+            # レスポンスに含める残り回数は、トランザクション内で読み取った最新の値から計算する
+            # (キャッシュのメタデータは古い可能性があるので使わない)
             final_usage_count = transaction_result_container["final_usage_count"]
-            # usageLimit はトランザクション外のデータから取得しても良い (通常は変更されないため)
-            usage_limit = key_data_outside_txn.get("usageLimit", DEFAULT_USAGE_LIMIT)
+            usage_limit = transaction_result_container["usage_limit"]
             remaining_usages = max(0, usage_limit - final_usage_count)
-            
+            recent_transaction_cache.put(key_hash, transaction_id, final_usage_count)
+
             logger.info(
-                f"record_api_usage: Successfully recorded usage for key {api_key_short_log}, "
-                f"txnId {transaction_id}. Effective count: {final_usage_count}, Remaining: {remaining_usages}"
+                "record_api_usage: Successfully recorded usage for key %s, txnId %s.", api_key_short_log, transaction_id,
+                extra=log_fields(
+                    "success", endpoint="record_api_usage", transactionId=transaction_id,
+                    effectiveUsageCount=final_usage_count, usageLimit=usage_limit
+                )
             )
-            
+
             # レスポンスに残り回数と上限値を追加する
             return create_success_response(data={
                 "status": "success",
@@ -725,23 +3168,11 @@ def record_api_usage(req: https_fn.Request) -> https_fn.Response:
                 "newEffectiveUsageCount": final_usage_count,
                 "remainingUsages": remaining_usages,
                 "usageLimit": usage_limit
-            })
-            
-            # --- ▲▲▲ ここまで修正 ▲▲▲ ---
-            ####
-            #logger.info(
-            #    f"record_api_usage: Successfully recorded usage for key {api_key_short_log}, "
-            #    f"txnId {transaction_id}. Effective count: {transaction_result_container['final_usage_count']}"
-            #)
-            #return create_success_response(data={
-            #    "status": "success",
-            #    "message": "Usage recorded successfully.",
-            #    "newEffectiveUsageCount": transaction_result_container["final_usage_count"]
-            #})
+            }, req=req)
         else:
             logger.error(
-                f"record_api_usage: Transaction for {api_key_short_log}, txnId {transaction_id} "
-                "finished unexpectedly."
+                "record_api_usage: Transaction for %s, txnId %s finished unexpectedly.",
+                api_key_short_log, transaction_id
             )
             return create_error_response(
                 internal_message=f"record_api_usage: Transaction for key {api_key_short_log}, txnId {transaction_id} "
@@ -766,7 +3197,391 @@ def record_api_usage(req: https_fn.Request) -> https_fn.Response:
         )
 
 
+def parse_usage_batch_items(request_body) -> list[dict]:
+    """
+    record_api_usage_batch のリクエストボディを検証し、[{"transactionId": str, "units": int}, ...] を返します。
+    受け付ける形式:
+      {"transactions": [{"transactionId": "a", "units": 3}, "b", ...]}
+      {"transactionIds": ["a", "b", ...]}
+    不正な場合は公開用メッセージを持つ ValueError を送出します。
+    """
+    if not isinstance(request_body, dict):
+        raise ValueError("Invalid request body format.")
+    raw_items = request_body.get("transactions", request_body.get("transactionIds"))
+    if not isinstance(raw_items, list) or not raw_items:
+        raise ValueError("Missing or invalid transactions.")
+    if len(raw_items) > USAGE_BATCH_MAX_ITEMS:
+        raise ValueError(f"Too many transactions (max {USAGE_BATCH_MAX_ITEMS}).")
+
+    items = []
+    for raw_item in raw_items:
+        if isinstance(raw_item, dict):
+            transaction_id = str(raw_item.get("transactionId", "")).strip()
+            units = raw_item.get("units", 1)
+        else:
+            transaction_id = str(raw_item).strip()
+            units = 1
+        if not transaction_id:
+            raise ValueError("transactionId cannot be empty.")
+        items.append({"transactionId": transaction_id, "units": parse_usage_units(units)})
+    return items
+
+
+def split_pending_usage_batch_items(items: list[dict], key_hash: str) -> tuple[dict[str, dict], list[dict]]:
+    """
+    リクエスト内の重複 (先に現れたものを採用) と、このインスタンスで記録済みのIDをトランザクションの対象から外します。
+    戻り値: (記録済みと判定した transactionId → 結果, 記録を試みる項目のリスト)
+    """
+    results_by_id: dict[str, dict] = {}
+    pending_items = []
+    seen_transaction_ids = set()
+    for item in items:
+        if item["transactionId"] in seen_transaction_ids:
+            continue
+        seen_transaction_ids.add(item["transactionId"])
+        recent_processed_data = recent_transaction_cache.get(key_hash, item["transactionId"])
+        if recent_processed_data is not None:
+            results_by_id[item["transactionId"]] = {
+                "transactionId": item["transactionId"],
+                "status": "already_recorded",
+                "recordedUsageCount": recent_processed_data.get("recordedUsageCount", "N/A"),
+            }
+        else:
+            pending_items.append(item)
+    return results_by_id, pending_items
+
+
+@firestore.transactional
+def _record_usage_batch_in_transaction(
+        transaction_obj: Transaction,
+        key_doc_ref: DocumentReference,
+        items: list[dict],
+        api_key_short_log: str
+) -> dict:
+    """
+    キードキュメントと全 transactionId の冪等性レコードを get_all で1往復で読み取り、
+    未処理のものだけを先頭から上限の範囲内で適用し、合計の加算と冪等性レコードの作成を1回でコミットします。
+    """
+    processed_refs = [db.collection("processedTransactions").document(item["transactionId"]) for item in items]
+    with TimingSpan("txn_read"):
+        snapshots = {
+            snap.reference.path: snap
+            for snap in transaction_obj.get_all([key_doc_ref] + processed_refs)
+        }
+
+    key_snapshot = snapshots.get(key_doc_ref.path)
+    if key_snapshot is None or not key_snapshot.exists:
+        raise google_exceptions.NotFound(f"API key document {key_doc_ref.id} disappeared during transaction.")
+    current_data = key_snapshot.to_dict() or {}
+    if not current_data.get("isEnabled", False):
+        return {"disabled": True}
+
+    usage_limit: int = current_data.get("usageLimit", DEFAULT_USAGE_LIMIT)
+    period = current_billing_period()
+    running_usage_count = get_period_usage(current_data, period)
+
+    results = []
+    applied_units = 0
+    for item, processed_ref in zip(items, processed_refs):
+        processed_snapshot = snapshots.get(processed_ref.path)
+        if processed_snapshot is not None and processed_snapshot.exists:
+            results.append({
+                "transactionId": item["transactionId"],
+                "status": "already_recorded",
+                "recordedUsageCount": (processed_snapshot.to_dict() or {}).get("recordedUsageCount", "N/A"),
+            })
+        elif running_usage_count + item["units"] > usage_limit:
+            results.append({"transactionId": item["transactionId"], "status": "limit_exceeded"})
+        else:
+            running_usage_count += item["units"]
+            applied_units += item["units"]
+            transaction_obj.create(processed_ref, build_processed_transaction_data(
+                api_key_short_log, key_doc_ref.id, running_usage_count, billing_period=period, units=item["units"]
+            ))
+            results.append({
+                "transactionId": item["transactionId"],
+                "status": "recorded",
+                "recordedUsageCount": running_usage_count,
+            })
+
+    if applied_units:
+        transaction_obj.update(key_doc_ref, build_period_usage_increment(current_data, period, applied_units))
+
+    return {
+        "disabled": False,
+        "results": results,
+        "usage_count": running_usage_count,
+        "usage_limit": usage_limit,
+    }
+
+
+def _record_sharded_usage_batch(
+        key_doc_ref: DocumentReference,
+        key_entry: ApiKeyCacheEntry,
+        items: list[dict],
+        api_key_short_log: str
+) -> dict:
+    """
+    シャードモードのキーについてバッチ記録を行います。
+    冪等性レコードを get_all でまとめて確認し、未処理分の合計を1シャードに加算する書き込みと
+    冪等性レコードの作成を1つのバッチでコミットします (同時に同じIDが記録された場合はバッチ全体が失敗します)。
+    """
+    processed_refs = [db.collection("processedTransactions").document(item["transactionId"]) for item in items]
+    processed_snapshots = {snap.reference.path: snap for snap in db.get_all(processed_refs)}
+
+    period = current_billing_period()
+    running_usage_count = get_sharded_usage_total(key_doc_ref, period)
+    results = []
+    applied_units = 0
+    batch = db.batch()
+    for item, processed_ref in zip(items, processed_refs):
+        processed_snapshot = processed_snapshots.get(processed_ref.path)
+        if processed_snapshot is not None and processed_snapshot.exists:
+            results.append({
+                "transactionId": item["transactionId"],
+                "status": "already_recorded",
+                "recordedUsageCount": (processed_snapshot.to_dict() or {}).get("recordedUsageCount", "N/A"),
+            })
+        elif running_usage_count + item["units"] > key_entry.usage_limit:
+            results.append({"transactionId": item["transactionId"], "status": "limit_exceeded"})
+        else:
+            running_usage_count += item["units"]
+            applied_units += item["units"]
+            batch.create(processed_ref, build_processed_transaction_data(
+                api_key_short_log, key_doc_ref.id, running_usage_count, units=item["units"]
+            ))
+            results.append({
+                "transactionId": item["transactionId"],
+                "status": "recorded",
+                "recordedUsageCount": running_usage_count,
+            })
+
+    if applied_units:
+        shard_ref = key_doc_ref.collection("usageShards").document(str(random.randrange(key_entry.usage_shard_count)))
+        batch.set(shard_ref, {"counts": {period: firestore.Increment(applied_units)}}, merge=True)
+        batch.commit()
+        sharded_usage_total_cache.add(key_doc_ref.id, period, applied_units)
+
+    return {
+        "disabled": False,
+        "results": results,
+        "usage_count": running_usage_count,
+        "usage_limit": key_entry.usage_limit,
+        "approximate": True,
+    }
+
+
+@https_fn.on_request()
+@with_server_timing
+def record_api_usage_batch(req: https_fn.Request) -> https_fn.Response:
+    """
+    1つのAPIキーについて、複数の transactionId の利用をまとめて記録します。冪等性対応済み。
+    ヘッダー: X-API-KEY (必須)
+    ボディ: {"transactions": [{"transactionId": "...", "units": 1}, ...]} (units は省略可、既定 1)
+    冪等性レコードの確認は get_all 1回、加算は1トランザクション (コミット1回) で行い、
+    transactionId ごとの結果 (recorded / already_recorded / limit_exceeded) を返します。
+    """
+    ensure_firebase_initialized()
+    if db is None:
+        return create_error_response(
+            internal_message="record_api_usage_batch: Firestore client not initialized.",
+            public_message="Server configuration error.",
+            status_code=500
+        )
+
+    api_key = req.headers.get("X-API-KEY")
+    if not api_key:
+        logger.warning("record_api_usage_batch: API key missing in header.")
+        return create_error_response(
+            internal_message="API key missing in header.",
+            public_message="API key missing.",
+            status_code=401
+        )
+
+    try:
+        items = parse_usage_batch_items(req.get_json(silent=True))
+    except ValueError as validation_error:
+        return create_error_response(
+            internal_message=f"record_api_usage_batch: Invalid request body: {validation_error}",
+            public_message=str(validation_error),
+            status_code=400
+        )
+
+    api_key_short_log = api_key[:len(API_KEY_PREFIX) + 3] + "..." if len(api_key) > (len(API_KEY_PREFIX) + 3) else api_key
+    logger.info(
+        "record_api_usage_batch: Attempting %s transactions for key %s", len(items), api_key_short_log,
+        extra=log_fields("request", endpoint="record_api_usage_batch", items=len(items))
+    )
+
+    try:
+        key_entry, _ = lookup_api_key(api_key)
+        if key_entry is None:
+            logger.warning("record_api_usage_batch: API key not found: %s", api_key_short_log)
+            return create_error_response(
+                internal_message=f"API key not found: {api_key_short_log}",
+                public_message="Invalid API key.",
+                status_code=403
+            )
+        if not key_entry.is_enabled:
+            return create_error_response(
+                internal_message=f"API key disabled: {api_key_short_log}",
+                public_message="API key disabled.",
+                status_code=403
+            )
+
+        key_hash = hash_api_key(api_key)
+        results_by_id, pending_items = split_pending_usage_batch_items(items, key_hash)
+
+        key_doc_ref: DocumentReference = db.collection("apiKeys").document(key_entry.doc_id)
+        batch_result = {"disabled": False, "results": [], "usage_count": None, "usage_limit": key_entry.usage_limit}
+        if pending_items:
+            try:
+                if key_entry.usage_shard_count > 1:
+                    batch_result = _record_sharded_usage_batch(key_doc_ref, key_entry, pending_items, api_key_short_log)
+                else:
+                    with TimingSpan("txn"):
+                        batch_result = _record_usage_batch_in_transaction(
+                            db.transaction(), key_doc_ref, pending_items, api_key_short_log
+                        )
+            except google_exceptions.NotFound as doc_missing_err:
+                api_key_cache.invalidate(key_hash)
+                return create_error_response(
+                    internal_message=f"record_api_usage_batch: Key {api_key_short_log} disappeared: {doc_missing_err}",
+                    public_message="Failed to update usage: API key may have been deleted.",
+                    status_code=500,
+                    log_exception=True
+                )
+            except google_exceptions.AlreadyExists as conflict_err:
+                # シャードモードで同じIDが同時に記録された場合。何もコミットされていないので再試行で解決する
+                return create_error_response(
+                    internal_message=f"record_api_usage_batch: Concurrent duplicate for key {api_key_short_log}: {conflict_err}",
+                    public_message="A conflicting request was processed concurrently. Please retry.",
+                    status_code=409
+                )
+
+        if batch_result["disabled"]:
+            api_key_cache.invalidate(key_hash)
+            return create_error_response(
+                internal_message=f"API key disabled: {api_key_short_log}",
+                public_message="API key disabled.",
+                status_code=403
+            )
+
+        for item_result in batch_result["results"]:
+            results_by_id[item_result["transactionId"]] = item_result
+            if item_result["status"] != "limit_exceeded":
+                recent_transaction_cache.put(key_hash, item_result["transactionId"], item_result["recordedUsageCount"])
+
+        results = [results_by_id[item["transactionId"]] for item in items]
+        recorded_count = sum(1 for item_result in batch_result["results"] if item_result["status"] == "recorded")
+        logger.info(
+            "record_api_usage_batch: Recorded %s/%s transactions for key %s.", recorded_count, len(items), api_key_short_log,
+            extra=log_fields("success", endpoint="record_api_usage_batch", recorded=recorded_count, items=len(items))
+        )
+
+        response_data = {
+            "status": "success",
+            "recorded": recorded_count,
+            "results": results,
+            "usageLimit": batch_result["usage_limit"],
+        }
+        if batch_result["usage_count"] is not None:
+            response_data["newEffectiveUsageCount"] = batch_result["usage_count"]
+            response_data["remainingUsages"] = max(0, batch_result["usage_limit"] - batch_result["usage_count"])
+        if batch_result.get("approximate"):
+            response_data["isApproximate"] = True
+        return create_success_response(data=response_data, req=req)
+
+    except google_exceptions.RetryError as e:
+        return create_error_response(
+            internal_message=f"record_api_usage_batch: Firestore transient error for {api_key_short_log}: {e}",
+            public_message="A transient database error occurred. Please try again.",
+            status_code=503,
+            log_exception=True
+        )
+    except Exception as e:
+        return create_error_response(
+            internal_message=f"record_api_usage_batch: Unexpected error for {api_key_short_log}: {e}",
+            public_message="Internal Server Error.",
+            status_code=500,
+            log_exception=True
+        )
+
+
+# === ユーザー → 有効なキーのポインタ (users/{uid}.activeKeyId) ===
+# generate_or_fetch_api_key は users/{uid} の activeKeyId が指すキーを直接取得するため、
+# 通常は複合インデックスを使うクエリを実行しません。ポインタの読み取りとキーの作成を同じトランザクションで
+# 行うため、初回ログインが同時に2回届いてもキーは1つしか作成されません (後のトランザクションは競合して再試行され、
+# 先に作成されたキーを返します)。ポインタがない (移行前のユーザー) か、指すキーが無効・削除済みの場合のみ
+# 従来のクエリで有効なキーを探し、ポインタを書き込みます。キーの作成はこの関数のみが行い (firestore.rules で
+# クライアントからの作成を禁止)、有効なポインタより新しいキーが別の経路で作られることはありません。
+
+@firestore.transactional
+def _get_or_create_active_api_key_in_transaction(
+        transaction_obj: Transaction,
+        user_ref: DocumentReference,
+        uid: str,
+        email: str
+) -> dict:
+    """
+    ユーザーの有効なAPIキーを返し、なければ作成します。
+    戻り値: {"api_key": str | None, "doc_id": str, "created": bool, "pointer_updated": bool}
+    (api_key が None の場合はキードキュメントの key フィールドが欠けている。
+    pointer_updated はこのトランザクションで activeKeyId を書き込んだ (作成・修復した) 場合に True)
+    """
+    keys_collection_ref = db.collection("apiKeys")
+    with TimingSpan("txn_read"):
+        user_snapshot = user_ref.get(transaction=transaction_obj)
+    active_key_id = (user_snapshot.to_dict() or {}).get("activeKeyId") if user_snapshot.exists else None
+
+    if active_key_id:
+        key_snapshot = keys_collection_ref.document(active_key_id).get(transaction=transaction_obj)
+        key_data = (key_snapshot.to_dict() or {}) if key_snapshot.exists else {}
+        if key_data.get("isEnabled", False) and key_data.get("user_uid") == uid:
+            return {"api_key": key_data.get("key"), "doc_id": active_key_id, "created": False, "pointer_updated": False}
+
+    # ポインタがない・古い場合のみ、従来のクエリで有効なキーを探す
+    query = keys_collection_ref.where(
+        filter=FieldFilter("user_uid", "==", uid)
+    ).where(
+        filter=FieldFilter("isEnabled", "==", True)
+    ).order_by(
+        "created_at", direction=firestore.Query.DESCENDING
+    ).limit(1)
+    active_key_docs = list(transaction_obj.get(query))
+    user_pointer_data = {"activeKeyId": None, "updatedAt": firestore.SERVER_TIMESTAMP}
+
+    if active_key_docs:
+        user_pointer_data["activeKeyId"] = active_key_docs[0].id
+        transaction_obj.set(user_ref, user_pointer_data, merge=True)
+        return {
+            "api_key": (active_key_docs[0].to_dict() or {}).get("key"),
+            "doc_id": active_key_docs[0].id,
+            "created": False,
+            "pointer_updated": True,
+        }
+
+    new_api_key_str = generate_api_key_string()
+    current_server_timestamp = firestore.SERVER_TIMESTAMP
+    # ドキュメントIDをキーのハッシュにすることで、検証時はクエリなしの直接取得で解決できる
+    new_doc_ref = keys_collection_ref.document(hash_api_key(new_api_key_str))
+    transaction_obj.create(new_doc_ref, {
+        "key": new_api_key_str,
+        "user_uid": uid,
+        "isEnabled": True,
+        "usageCount": 0,
+        "usageLimit": DEFAULT_USAGE_LIMIT,
+        "lastReset": current_server_timestamp,
+        "created_at": current_server_timestamp,
+        "ownerEmail": email or "",
+    })
+    user_pointer_data["activeKeyId"] = new_doc_ref.id
+    transaction_obj.set(user_ref, user_pointer_data, merge=True)
+    return {"api_key": new_api_key_str, "doc_id": new_doc_ref.id, "created": True, "pointer_updated": True}
+
+
 @https_fn.on_request(cors=generate_api_key_cors_policy)
+@with_server_timing
 def generate_or_fetch_api_key(req: https_fn.Request) -> https_fn.Response:
     """
     IDトークンでユーザーを認証し、有効なAPIキーを返します。
@@ -797,7 +3612,8 @@ def generate_or_fetch_api_key(req: https_fn.Request) -> https_fn.Response:
 
     try:
         try:
-            decoded_token = auth.verify_id_token(id_token)
+            with TimingSpan("token_verify"):
+                decoded_token = verify_id_token_cached(id_token)
         except auth.RevokedIdTokenError:
             logger.warning("generate_or_fetch_api_key: ID token has been revoked.")
             return create_error_response(
@@ -813,12 +3629,18 @@ def generate_or_fetch_api_key(req: https_fn.Request) -> https_fn.Response:
                 status_code=401
             )
         except auth.InvalidIdTokenError as token_error:
-            logger.warning(f"generate_or_fetch_api_key: Invalid ID token: {token_error}")
+            logger.warning("generate_or_fetch_api_key: Invalid ID token: %s", token_error)
             return create_error_response(
                 internal_message=f"Invalid ID token: {token_error}",
                 public_message="Unauthorized: Invalid token.",
                 status_code=401
             )
+        except auth.CertificateFetchError as cert_error:
+            return create_error_response(
+                internal_message=f"generate_or_fetch_api_key: ID token certificates unavailable: {cert_error}",
+                public_message="Token verification is temporarily unavailable. Please try again.",
+                status_code=503
+            )
         except Exception as auth_verify_error:
             return create_error_response(
                 internal_message=f"generate_or_fetch_api_key: Token verification failed with unexpected auth error: {auth_verify_error}",
@@ -838,86 +3660,63 @@ def generate_or_fetch_api_key(req: https_fn.Request) -> https_fn.Response:
                 status_code=401
             )
 
-        logger.info(f"generate_or_fetch_api_key: Verified user. UID='{uid}', Email='{email}'")
+        logger.info("generate_or_fetch_api_key: Verified user. UID='%s', Email='%s'", uid, email)
 
-        keys_collection_ref = db.collection("apiKeys")
-        query = keys_collection_ref.where(
-            filter=FieldFilter("user_uid", "==", uid)
-        ).where(
-            filter=FieldFilter("isEnabled", "==", True)
-        ).order_by(
-            "created_at", direction=firestore.Query.DESCENDING
-        ).limit(1)
-
-        active_key_docs = list(query.stream())
+        user_ref = db.collection("users").document(uid)
+        try:
+            with TimingSpan("txn"):
+                key_result = _get_or_create_active_api_key_in_transaction(db.transaction(), user_ref, uid, email)
+        except Exception as db_txn_err:
+            return create_error_response(
+                internal_message=f"generate_or_fetch_api_key: Failed to get or create API key for user {uid}: {db_txn_err}",
+                public_message="Internal Server Error: Could not save new API key.",
+                status_code=500,
+                log_exception=True
+            )
 
-        if active_key_docs:
-            existing_key_data = active_key_docs[0].to_dict()
-            if existing_key_data is None:
-                logger.error(f"generate_or_fetch_api_key: Existing key document {active_key_docs[0].id} has no data.")
-                return create_error_response(
-                    internal_message=f"Existing key document {active_key_docs[0].id} has no data.",
-                    public_message="Internal Server Error: Key data inconsistency.",
-                    status_code=500
-                )
+        api_key_value = key_result["api_key"]
+        doc_id = key_result["doc_id"]
 
-            api_key_value = existing_key_data.get("key")
-            doc_id = active_key_docs[0].id
+        if not api_key_value:
+            logger.error(
+                "generate_or_fetch_api_key: Data inconsistency - Doc %s for user %s is missing 'key' field.",
+                doc_id, uid
+            )
+            return create_error_response(
+                internal_message=f"Data inconsistency for API key document {doc_id}.",
+                public_message="Internal Server Error: Key data inconsistency.",
+                status_code=500
+            )
 
-            if not api_key_value:
-                logger.error(
-                    f"generate_or_fetch_api_key: Data inconsistency - Doc {doc_id} "
-                    f"for user {uid} is missing 'key' field."
-                )
-                return create_error_response(
-                    internal_message=f"Data inconsistency for API key document {doc_id}.",
-                    public_message="Internal Server Error: Key data inconsistency.",
-                    status_code=500
-                )
+        api_key_short_log = api_key_value[:len(API_KEY_PREFIX) + 3] + "..."
 
-            api_key_short_log = api_key_value[:len(API_KEY_PREFIX) + 3] + "..."
-            logger.info(f"generate_or_fetch_api_key: Found existing active API key for user {uid}: {api_key_short_log}")
+        if key_result["created"]:
+            register_new_api_key(api_key_value)
+            logger.info(
+                "generate_or_fetch_api_key: Successfully saved new API key for user %s: %s (Doc ID: %s)",
+                uid, api_key_short_log, doc_id
+            )
             return create_success_response(
                 data=api_key_value,
-                status_code=200,
+                status_code=201,  # 201 Created
                 content_type="text/plain"
             )
-        else:
-            logger.info(f"generate_or_fetch_api_key: No active API key found for user {uid}. Generating new one.")
-            new_api_key_str = generate_api_key_string()
-            api_key_short_log = new_api_key_str[:len(API_KEY_PREFIX) + 3] + "..."
-            current_server_timestamp = firestore.SERVER_TIMESTAMP
-
-            new_key_document_data = {
-                "key": new_api_key_str,
-                "user_uid": uid,
-                "isEnabled": True,
-                "usageCount": 0,
-                "usageLimit": DEFAULT_USAGE_LIMIT,
-                "lastReset": current_server_timestamp,
-                "created_at": current_server_timestamp,
-                "ownerEmail": email or "",
-            }
 
+        logger.info("generate_or_fetch_api_key: Found existing active API key for user %s: %s", uid, api_key_short_log)
+        if key_result["pointer_updated"]:
+            # ポインタを作成・修復したときだけ、旧方式 (自動ID) のキーの索引を同期する。
+            # ポインタが有効な2回目以降の取得では索引は書き込み済みのため書き込まない
+            # (書き込みに失敗していた場合も、検証時の遅延バックフィルで補われる)
             try:
-                new_doc_ref = keys_collection_ref.document()
-                new_doc_ref.set(new_key_document_data)
-                logger.info(
-                    f"generate_or_fetch_api_key: Successfully saved new API key for user {uid}: "
-                    f"{api_key_short_log} (Doc ID: {new_doc_ref.id})"
-                )
-                return create_success_response(
-                    data=new_api_key_str,
-                    status_code=201,  # 201 Created
-                    content_type="text/plain"
-                )
-            except Exception as db_write_err:
-                return create_error_response(
-                    internal_message=f"generate_or_fetch_api_key: Failed to save new API key to Firestore for user {uid}: {db_write_err}",
-                    public_message="Internal Server Error: Could not save new API key.",
-                    status_code=500,
-                    log_exception=True
-                )
+                with TimingSpan("index_write"):
+                    write_api_key_index(api_key_value, doc_id, uid)
+            except Exception as index_err:
+                logger.warning("generate_or_fetch_api_key: Failed to sync apiKeyIndex for doc %s: %s", doc_id, index_err)
+        return create_success_response(
+            data=api_key_value,
+            status_code=200,
+            content_type="text/plain"
+        )
 
     except google_exceptions.RetryError as e:
         return create_error_response(
@@ -932,4 +3731,74 @@ def generate_or_fetch_api_key(req: https_fn.Request) -> https_fn.Response:
             public_message="Internal Server Error.",
             status_code=500,
             log_exception=True
-        )
\ No newline at end of file
+        )
+
+
+# === 単一エントリポイント (api) ===
+# 1つの Cloud Run サービスで全エンドポイントを提供し、Firestore クライアント・gRPC チャネル・
+# インスタンス内キャッシュ・コールドスタートを共有するためのルーターです。
+# /api/verify_api_key のように、パスの最後の要素を従来の関数名として振り分けます。
+# 各ハンドラはデコレート済みの関数をそのまま呼び出すため、CORS などの関数ごとの設定も維持されます。
+
+API_ROUTES = {
+    "helloWorld": helloWorld,
+    "verify_api_key": verify_api_key,
+    "check_api_key_status": check_api_key_status,
+    "record_api_usage": record_api_usage,
+    "record_api_usage_batch": record_api_usage_batch,
+    "generate_or_fetch_api_key": generate_or_fetch_api_key,
+}
+
+
+def route_api_request(req: https_fn.Request) -> https_fn.Response:
+    """リクエストのパスに対応するエンドポイントのハンドラを呼び出します。"""
+    route = req.path.rstrip("/").rsplit("/", 1)[-1]
+    handler = API_ROUTES.get(route)
+    if handler is None:
+        return create_error_response(
+            internal_message=f"api: No route for path {req.path}",
+            public_message="Not Found.",
+            status_code=404
+        )
+    return handler(req)
+
+
+if API_ROUTER_ENABLED:
+    # デプロイされる関数名 (エントリポイント) は関数の __name__ になるため、api という名前で定義する
+    @https_fn.on_request()
+    def api(req: https_fn.Request) -> https_fn.Response:
+        """全エンドポイントをパスで振り分ける単一エントリポイント (route_api_request を呼び出します)。"""
+        return route_api_request(req)
+
+
+@scheduler_fn.on_schedule(schedule="every day 03:00", timezone=scheduler_fn.Timezone("Etc/UTC"))
+def compact_usage_periods(event: scheduler_fn.ScheduledEvent) -> None:
+    """保持期間を過ぎた請求期間の利用回数を usageHistory へ移動する定期ジョブ (1日1回)。"""
+    logger.info("compact_usage_periods: Triggered at %s", event.schedule_time)
+    compact_old_usage_periods()
+
+
+if API_KEY_BLOOM_ENABLED:
+    # 各インスタンスはこのジョブが保存したフィルタを読み込むため、API_KEY_BLOOM_ENABLED の場合のみデプロイする
+    @scheduler_fn.on_schedule(schedule="every 6 hours", timezone=scheduler_fn.Timezone("Etc/UTC"), timeout_sec=540)
+    def build_api_key_bloom_filter_job(event: scheduler_fn.ScheduledEvent) -> None:
+        """apiKeys 全件から Bloom フィルタを再構築して保存する定期ジョブ (6時間ごと)。"""
+        logger.info("build_api_key_bloom_filter_job: Triggered at %s", event.schedule_time)
+        build_api_key_bloom_filter()
+
+
+# === 管理用コマンド ===
+# 例: python main.py backfill-api-key-index
+if __name__ == "__main__":
+    import sys
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "backfill-api-key-index":
+        print(json.dumps(backfill_api_key_index()))
+    elif command == "build-api-key-bloom-filter":
+        print(json.dumps(build_api_key_bloom_filter()))
+    elif command == "compact-usage-periods":
+        print(json.dumps(compact_old_usage_periods()))
+    else:
+        print("usage: python main.py [backfill-api-key-index | build-api-key-bloom-filter | compact-usage-periods]")
+        sys.exit(2)
@@ -0,0 +1,17 @@
+# functions/tests/conftest.py
+"""
+functions/tests の共通設定。テストから `import main` できるよう、functions ディレクトリを import パスに追加します。
+firebase_admin / google-cloud-firestore がインストールされていない環境では、テストを収集しません。
+
+使い方 (functions ディレクトリで実行):
+    python -m pytest -q tests
+"""
+
+import importlib.util
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if importlib.util.find_spec("firebase_admin") is None or importlib.util.find_spec("google.cloud.firestore") is None:
+    collect_ignore_glob = ["test_*.py"]
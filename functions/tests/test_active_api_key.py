@@ -0,0 +1,153 @@
+# functions/tests/test_active_api_key.py
+"""
+generate_or_fetch_api_key のキー解決 (_get_or_create_active_api_key_in_transaction) のテスト。
+Firestore には接続せず、トランザクションと apiKeys コレクションを偽の実装に差し替えて確認します。
+"""
+
+from datetime import datetime, timezone
+
+import pytest
+
+import main
+
+UID = "user-1"
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data: dict | None):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeDocRef:
+    def __init__(self, store: dict, doc_id: str):
+        self.store = store
+        self.id = doc_id
+
+    def get(self, transaction=None):
+        return FakeSnapshot(self.id, self.store.get(self.id))
+
+
+class FakeQuery:
+    def __init__(self, store: dict, filters: tuple = ()):
+        self.store = store
+        self.filters = filters
+
+    def where(self, filter):
+        return FakeQuery(self.store, self.filters + (filter,))
+
+    def order_by(self, field, direction=None):
+        assert (field, direction) == ("created_at", main.firestore.Query.DESCENDING)
+        return self
+
+    def limit(self, count):
+        assert count == 1
+        return self
+
+    def results(self) -> list[FakeSnapshot]:
+        matches = [
+            FakeSnapshot(doc_id, data) for doc_id, data in self.store.items()
+            if all(f.op_string == "==" and data.get(f.field_path) == f.value for f in self.filters)
+        ]
+        matches.sort(key=lambda snapshot: snapshot.to_dict()["created_at"], reverse=True)
+        return matches[:1]
+
+
+class FakeKeysCollection(FakeQuery):
+    def document(self, doc_id):
+        return FakeDocRef(self.store, doc_id)
+
+
+class FakeDb:
+    def __init__(self, keys: dict):
+        self.keys = FakeKeysCollection(keys)
+
+    def collection(self, name):
+        assert name == "apiKeys"
+        return self.keys
+
+
+class FakeTransaction:
+    def __init__(self):
+        self.queries = 0
+        self.sets = []
+        self.creates = []
+
+    def get(self, query):
+        self.queries += 1
+        return query.results()
+
+    def set(self, doc_ref, data, merge=False):
+        self.sets.append((doc_ref, data))
+
+    def create(self, doc_ref, data):
+        self.creates.append((doc_ref, data))
+
+
+def key_doc(key: str, created_day: int, enabled: bool = True) -> dict:
+    return {
+        "key": key,
+        "user_uid": UID,
+        "isEnabled": enabled,
+        "created_at": datetime(2026, 10, created_day, tzinfo=timezone.utc),
+    }
+
+
+def resolve(monkeypatch, keys: dict, user_data: dict | None) -> tuple[dict, FakeTransaction]:
+    monkeypatch.setattr(main, "db", FakeDb(keys))
+    user_ref = FakeDocRef({UID: user_data} if user_data is not None else {}, UID)
+    transaction_obj = FakeTransaction()
+    result = main._get_or_create_active_api_key_in_transaction.to_wrap(transaction_obj, user_ref, UID, "a@example.com")
+    return result, transaction_obj
+
+
+def test_pointer_to_enabled_key_is_returned_without_query(monkeypatch):
+    keys = {"old": key_doc("sk_old", 1), "current": key_doc("sk_current", 2)}
+
+    result, transaction_obj = resolve(monkeypatch, keys, {"activeKeyId": "current"})
+
+    assert result == {"api_key": "sk_current", "doc_id": "current", "created": False, "pointer_updated": False}
+    assert (transaction_obj.queries, transaction_obj.sets, transaction_obj.creates) == (0, [], [])
+
+
+@pytest.mark.parametrize("user_data", [None, {}, {"activeKeyId": "disabled"}, {"activeKeyId": "deleted"}])
+def test_missing_or_stale_pointer_falls_back_to_newest_enabled_key(monkeypatch, user_data):
+    keys = {
+        "older": key_doc("sk_older", 1),
+        "newest": key_doc("sk_newest", 3),
+        "disabled": key_doc("sk_disabled", 4, enabled=False),
+        "other-user": dict(key_doc("sk_other", 5), user_uid="user-2"),
+    }
+
+    result, transaction_obj = resolve(monkeypatch, keys, user_data)
+
+    assert result == {"api_key": "sk_newest", "doc_id": "newest", "created": False, "pointer_updated": True}
+    assert transaction_obj.queries == 1 and transaction_obj.creates == []
+    [(user_ref, pointer)] = transaction_obj.sets
+    assert user_ref.id == UID and pointer["activeKeyId"] == "newest"
+
+
+def test_pointer_to_another_users_key_is_not_trusted(monkeypatch):
+    keys = {"mine": key_doc("sk_mine", 1), "theirs": dict(key_doc("sk_theirs", 2), user_uid="user-2")}
+
+    result, _ = resolve(monkeypatch, keys, {"activeKeyId": "theirs"})
+
+    assert (result["doc_id"], result["pointer_updated"]) == ("mine", True)
+
+
+def test_key_is_created_with_hashed_doc_id_when_none_is_enabled(monkeypatch):
+    keys = {"disabled": key_doc("sk_disabled", 1, enabled=False)}
+
+    result, transaction_obj = resolve(monkeypatch, keys, {"activeKeyId": "disabled"})
+
+    assert result["created"] is True and result["pointer_updated"] is True
+    assert result["doc_id"] == main.hash_api_key(result["api_key"])
+    [(key_ref, data)] = transaction_obj.creates
+    assert key_ref.id == result["doc_id"]
+    assert (data["user_uid"], data["isEnabled"], data["key"]) == (UID, True, result["api_key"])
+    [(_, pointer)] = transaction_obj.sets
+    assert pointer["activeKeyId"] == result["doc_id"]
@@ -0,0 +1,131 @@
+# functions/tests/test_api_key_bloom_filter.py
+"""
+無効なAPIキーの早期拒否 (ApiKeyBloomFilter / ApiKeyNegativeCache) のテスト。
+Bloom フィルタのサイズ計算・偽陰性がないこと・偽陽性率・保存と読み込み・古いフィルタでのフェイルオープンを確認します。
+"""
+
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import main
+
+
+def key_hashes(prefix: str, count: int) -> list[str]:
+    return [main.hash_api_key(f"sk_{prefix}{index}") for index in range(count)]
+
+
+def make_ready_filter(capacity: int = 1000, false_positive_rate: float = 0.01) -> main.ApiKeyBloomFilter:
+    bloom_filter = main.ApiKeyBloomFilter(capacity=capacity, false_positive_rate=false_positive_rate)
+    bloom_filter.ready = True
+    bloom_filter.last_refreshed_at = time.monotonic()
+    return bloom_filter
+
+
+def test_sizing_follows_capacity_and_false_positive_rate():
+    bloom_filter = main.ApiKeyBloomFilter(capacity=1000, false_positive_rate=0.01)
+    # m = -n ln(p) / (ln 2)^2, k = m / n ln 2
+    assert bloom_filter.num_bits == 9586
+    assert bloom_filter.num_hashes == 7
+    assert bloom_filter.stats()["memoryBytes"] == 1199
+
+
+def test_added_keys_are_never_rejected():
+    bloom_filter = make_ready_filter()
+    present = key_hashes("present", 1000)
+    for key_hash in present:
+        bloom_filter.add(key_hash)
+
+    assert not any(bloom_filter.definitely_absent(key_hash) for key_hash in present)
+    assert bloom_filter.count == 1000
+
+
+def test_false_positive_rate_stays_near_configured_rate_at_capacity():
+    bloom_filter = make_ready_filter(capacity=1000, false_positive_rate=0.01)
+    for key_hash in key_hashes("present", 1000):
+        bloom_filter.add(key_hash)
+
+    absent = key_hashes("absent", 20000)
+    false_positives = sum(1 for key_hash in absent if bloom_filter.might_contain(key_hash))
+    assert false_positives / len(absent) < 0.02
+    assert bloom_filter.rejections == 0  # might_contain は拒否件数に数えない
+
+
+def test_absent_key_is_rejected_and_counted():
+    bloom_filter = make_ready_filter()
+    bloom_filter.add(main.hash_api_key("sk_present"))
+
+    assert bloom_filter.definitely_absent(main.hash_api_key("sk_absent"))
+    assert bloom_filter.rejections == 1
+
+
+def test_filter_fails_open_until_loaded_and_when_stale(monkeypatch):
+    bloom_filter = main.ApiKeyBloomFilter(capacity=1000, false_positive_rate=0.01)
+    absent_hash = main.hash_api_key("sk_absent")
+    assert not bloom_filter.definitely_absent(absent_hash)  # 未読み込み
+
+    bloom_filter.ready = True
+    stale_after = main.API_KEY_BLOOM_REFRESH_SECONDS * main.API_KEY_BLOOM_MAX_STALE_INTERVALS
+    bloom_filter.last_refreshed_at = time.monotonic() - stale_after - 1
+    assert not bloom_filter.definitely_absent(absent_hash)  # 更新が長時間止まっている
+
+    bloom_filter.last_refreshed_at = time.monotonic()
+    assert bloom_filter.definitely_absent(absent_hash)
+
+
+def test_stored_document_round_trips_with_its_own_sizing():
+    created_at = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    built = main.ApiKeyBloomFilter(capacity=500, false_positive_rate=0.001)
+    built.add_key_data({"key": "sk_present", "created_at": created_at})
+    built.add_key_data({"created_at": datetime(2026, 9, 1, tzinfo=timezone.utc)})  # key のないドキュメント
+    document = built.to_document()
+
+    # インスタンス側の設定値とは異なるサイズでも、保存時のサイズで判定する
+    loaded = main.ApiKeyBloomFilter(capacity=10, false_positive_rate=0.1)
+    loaded.load_document(dict(document, builtAt=created_at))
+
+    assert (loaded.num_bits, loaded.num_hashes, loaded.count) == (built.num_bits, built.num_hashes, 1)
+    assert loaded._created_at_watermark == created_at
+    assert not loaded.definitely_absent(main.hash_api_key("sk_present"))
+    assert loaded.definitely_absent(main.hash_api_key("sk_absent"))
+
+
+def test_load_document_rejects_truncated_bits():
+    document = main.ApiKeyBloomFilter(capacity=100, false_positive_rate=0.01).to_document()
+    with pytest.raises(ValueError):
+        main.ApiKeyBloomFilter(capacity=100, false_positive_rate=0.01).load_document(
+            dict(document, bits=document["bits"][:-1])
+        )
+
+
+def test_lookup_rejects_without_firestore_and_skips_negative_cache(monkeypatch):
+    bloom_filter = make_ready_filter()
+    negative_cache = main.ApiKeyNegativeCache(maxsize=8, ttl=60)
+    monkeypatch.setattr(main, "api_key_cache", main.ApiKeyMetadataCache(maxsize=8, ttl=60))
+    monkeypatch.setattr(main, "api_key_negative_cache", negative_cache)
+    monkeypatch.setattr(main, "api_key_bloom_filter", bloom_filter)
+    lookups = []
+    monkeypatch.setattr(main, "find_api_key_snapshot", lambda api_key, **_: lookups.append(api_key))
+
+    assert main.lookup_api_key("sk_unknown") == (None, None)
+    assert lookups == []
+    assert negative_cache.stats()["size"] == 0  # 新規キーが取り込まれ次第受け付けるため、記憶しない
+
+
+def test_negative_cache_remembers_missing_keys_until_discarded(monkeypatch):
+    negative_cache = main.ApiKeyNegativeCache(maxsize=8, ttl=60)
+    monkeypatch.setattr(main, "api_key_cache", main.ApiKeyMetadataCache(maxsize=8, ttl=60))
+    monkeypatch.setattr(main, "api_key_negative_cache", negative_cache)
+    monkeypatch.setattr(main, "api_key_bloom_filter", None)
+    lookups = []
+    monkeypatch.setattr(main, "find_api_key_snapshot", lambda api_key, **_: lookups.append(api_key))
+
+    main.lookup_api_key("sk_missing")
+    main.lookup_api_key("sk_missing")
+    assert lookups == ["sk_missing"]
+    assert negative_cache.stats()["hits"] == 1
+
+    main.register_new_api_key("sk_missing")  # このインスタンスで作成されたキーは即座に受け付ける
+    main.lookup_api_key("sk_missing")
+    assert lookups == ["sk_missing", "sk_missing"]
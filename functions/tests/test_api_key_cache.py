@@ -0,0 +1,169 @@
+# functions/tests/test_api_key_cache.py
+"""
+APIキーメタデータキャッシュ (ApiKeyMetadataCache) と lookup_api_key のテスト。
+Firestore には接続せず、find_api_key_snapshot を偽の実装に差し替えて確認します。
+"""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def make_entry(doc_id: str = "doc-1", **overrides) -> main.ApiKeyCacheEntry:
+    fields = {"doc_id": doc_id, "is_enabled": True, "usage_limit": 100, "user_uid": "uid-1"}
+    fields.update(overrides)
+    return main.ApiKeyCacheEntry(**fields)
+
+
+class FakeKeySnapshot:
+    def __init__(self, doc_id: str, data: dict):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+@pytest.fixture
+def fresh_caches(monkeypatch):
+    """モジュールのキャッシュをテストごとに新しいものに差し替えます。"""
+    monkeypatch.setattr(main, "api_key_cache", main.ApiKeyMetadataCache(maxsize=8, ttl=60))
+    monkeypatch.setattr(main, "api_key_negative_cache", main.ApiKeyNegativeCache(maxsize=8, ttl=60))
+    monkeypatch.setattr(main, "api_key_bloom_filter", None)
+
+
+def test_get_counts_hits_and_misses():
+    cache = main.ApiKeyMetadataCache(maxsize=8, ttl=60)
+    assert cache.get("hash-1") is None
+    cache.put("hash-1", make_entry())
+
+    assert cache.get("hash-1") == make_entry()
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hitRate"]) == (1, 1, 0.5)
+
+
+def test_entries_expire_after_ttl():
+    cache = main.ApiKeyMetadataCache(maxsize=8, ttl=0.05)
+    cache.put("hash-1", make_entry())
+    time.sleep(0.1)
+
+    assert cache.get("hash-1") is None
+    cache.put("hash-2", make_entry("doc-2"))  # 失効したエントリは次の書き込み時に取り除かれ、件数に数えられる
+    assert cache.stats()["expirations"] == 1
+    assert cache.doc_ids() == {"doc-2"}
+
+
+def test_least_recently_used_entry_is_evicted_when_full():
+    cache = main.ApiKeyMetadataCache(maxsize=2, ttl=60)
+    cache.put("hash-1", make_entry("doc-1"))
+    cache.put("hash-2", make_entry("doc-2"))
+    cache.get("hash-1")  # hash-2 が最も長く使われていないエントリになる
+    cache.put("hash-3", make_entry("doc-3"))
+
+    assert cache.get("hash-2") is None
+    assert cache.get("hash-1") is not None and cache.get("hash-3") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_apply_document_change_updates_metadata():
+    api_key = "sk_test-key"
+    key_hash = main.hash_api_key(api_key)
+    cache = main.ApiKeyMetadataCache(maxsize=8, ttl=60)
+    cache.put(key_hash, make_entry())
+
+    applied = cache.apply_document_change("doc-1", {"key": api_key, "isEnabled": False, "usageLimit": 5})
+
+    assert applied == 1
+    assert cache.get(key_hash) == make_entry(is_enabled=False, usage_limit=5, user_uid=None)
+
+
+def test_apply_document_change_drops_deleted_or_rekeyed_documents():
+    cache = main.ApiKeyMetadataCache(maxsize=8, ttl=60)
+    cache.put(main.hash_api_key("sk_a"), make_entry("doc-a"))
+    cache.put(main.hash_api_key("sk_b"), make_entry("doc-b"))
+
+    assert cache.apply_document_change("doc-a", None) == 1
+    assert cache.apply_document_change("doc-b", {"key": "sk_other", "isEnabled": True}) == 1
+    assert cache.doc_ids() == set()
+
+
+def test_lookup_api_key_serves_cache_hits_without_firestore(fresh_caches, monkeypatch):
+    calls = []
+    snapshot = FakeKeySnapshot("doc-1", {"key": "sk_test", "isEnabled": True, "usageLimit": 10, "user_uid": "uid-1"})
+    monkeypatch.setattr(main, "find_api_key_snapshot", lambda api_key, **_: calls.append(api_key) or snapshot)
+
+    first_entry, first_snapshot = main.lookup_api_key("sk_test")
+    second_entry, second_snapshot = main.lookup_api_key("sk_test")
+
+    assert calls == ["sk_test"]
+    assert first_snapshot is snapshot and second_snapshot is None
+    assert first_entry == second_entry == make_entry(usage_limit=10)
+
+
+def test_build_api_key_cache_entry_reads_shard_count():
+    snapshot = FakeKeySnapshot("doc-1", {"isEnabled": True, "usageShardCount": 4})
+    entry = main.build_api_key_cache_entry(snapshot)
+    assert entry == make_entry(usage_limit=main.DEFAULT_USAGE_LIMIT, user_uid=None, usage_shard_count=4)
+
+
+def test_lookup_api_key_prefetches_through_find_api_key_snapshot(fresh_caches, monkeypatch):
+    captured = {}
+
+    def fake_find(api_key, prefetch_refs=None, prefetched=None):
+        captured["prefetch_refs"] = prefetch_refs
+        prefetched["processedTransactions/txn"] = "prefetched"
+        return None
+
+    monkeypatch.setattr(main, "find_api_key_snapshot", fake_find)
+    prefetched = {}
+    ref = SimpleNamespace(path="processedTransactions/txn")
+
+    assert main.lookup_api_key("sk_missing", prefetch_refs=[ref], prefetched=prefetched) == (None, None)
+    assert captured["prefetch_refs"] == [ref]
+    assert prefetched == {"processedTransactions/txn": "prefetched"}
+
+
+class FakeChange:
+    def __init__(self, change_type: str, doc_id: str, data: dict | None):
+        self.type = SimpleNamespace(name=change_type)
+        self.document = SimpleNamespace(id=doc_id, to_dict=lambda: data)
+
+
+def test_watcher_ignores_usage_only_changes(fresh_caches, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(main.api_key_status_cache, "invalidate_doc", invalidated.append)
+    key_hash = main.hash_api_key("sk_test")
+    main.api_key_cache.put(key_hash, make_entry(usage_limit=10))
+    watcher = main.ApiKeyCacheWatcher(sync_interval=60, chunk_size=30)
+    key_data = {"key": "sk_test", "isEnabled": True, "usageLimit": 10, "user_uid": "uid-1", "usage": {"2026-10": 3}}
+
+    watcher._on_snapshot([], [FakeChange("MODIFIED", "doc-1", key_data)], None)
+    assert (watcher.applied_changes, watcher.skipped_changes, invalidated) == (0, 1, [])
+
+    watcher._on_snapshot([], [FakeChange("MODIFIED", "doc-1", dict(key_data, usageLimit=20))], None)
+    assert (watcher.applied_changes, watcher.skipped_changes, invalidated) == (1, 1, ["doc-1"])
+    assert main.api_key_cache.get(key_hash).usage_limit == 20
+
+
+def test_all_cache_stats_are_logged_every_interval(monkeypatch):
+    monkeypatch.setattr(main, "API_KEY_CACHE_STATS_LOG_INTERVAL", 2)
+    reasons = []
+    monkeypatch.setattr(main, "log_api_key_cache_stats", reasons.append)
+    cache = main.ApiKeyMetadataCache(maxsize=8, ttl=60)
+
+    for _ in range(5):
+        cache.get("hash-1")
+
+    assert reasons == ["periodic", "periodic"]
+
+
+def test_cache_stats_log_record_carries_the_combined_stats(caplog):
+    with caplog.at_level("INFO", logger=main.logger.name):
+        main.log_api_key_cache_stats("shutdown")
+
+    [record] = [record for record in caplog.records if getattr(record, "event", None) == "cache_stats"]
+    assert record.fields["reason"] == "shutdown"
+    assert {"hits", "negativeCache", "idTokens", "logging"} <= set(record.fields["stats"])
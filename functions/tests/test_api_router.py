@@ -0,0 +1,58 @@
+# functions/tests/test_api_router.py
+"""
+単一エントリポイントのルーター (route_api_request) のテスト。
+各エンドポイントのハンドラは呼び出しを記録する偽の実装に差し替えて確認します。
+"""
+
+import json
+
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+import main
+
+
+def make_request(path: str, method: str = "POST") -> Request:
+    return Request(EnvironBuilder(method=method, path=path).get_environ())
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    for route in main.API_ROUTES:
+        def handler(req, route=route):
+            calls.append((route, req.method))
+            return main.create_success_response(data={"route": route})
+        monkeypatch.setitem(main.API_ROUTES, route, handler)
+    return calls
+
+
+def test_routes_cover_every_http_endpoint():
+    assert set(main.API_ROUTES) == {
+        "helloWorld", "verify_api_key", "check_api_key_status", "record_api_usage",
+        "record_api_usage_batch", "generate_or_fetch_api_key",
+    }
+
+
+@pytest.mark.parametrize("path, method, route", [
+    ("/api/verify_api_key", "POST", "verify_api_key"),
+    ("/api/check_api_key_status", "GET", "check_api_key_status"),
+    ("/api/record_api_usage/", "POST", "record_api_usage"),
+    ("/record_api_usage_batch", "POST", "record_api_usage_batch"),
+    ("/api/generate_or_fetch_api_key", "OPTIONS", "generate_or_fetch_api_key"),
+])
+def test_last_path_segment_selects_the_handler(calls, path, method, route):
+    response = main.route_api_request(make_request(path, method))
+
+    assert calls == [(route, method)]
+    assert json.loads(response.get_data()) == {"route": route}
+
+
+@pytest.mark.parametrize("path", ["/api/unknown", "/api", "/", "/api/verify_api_key/extra"])
+def test_unknown_route_returns_404_without_calling_a_handler(calls, path):
+    response = main.route_api_request(make_request(path))
+
+    assert response.status_code == 404
+    assert response.get_data() == main.STATIC_ERROR_BODIES["Not Found."]
+    assert calls == []
@@ -0,0 +1,57 @@
+# functions/tests/test_billing_period.py
+"""
+請求期間キー ('YYYY-MM', UTC) の計算と、旧形式 (usageCount/lastReset) からの引き継ぎのテスト。
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("period, months, expected", [
+    ("2026-10", 0, "2026-10"),
+    ("2026-10", 2, "2026-12"),
+    ("2026-12", 1, "2027-01"),
+    ("2026-01", -1, "2025-12"),
+    ("2026-03", -15, "2024-12"),
+])
+def test_shift_billing_period(period, months, expected):
+    assert main.shift_billing_period(period, months) == expected
+
+
+def test_billing_period_start_is_first_instant_in_utc():
+    assert main.billing_period_start("2026-02") == datetime(2026, 2, 1, tzinfo=timezone.utc)
+
+
+def test_current_billing_period_uses_utc():
+    jst = timezone(timedelta(hours=9))
+    # 日本時間の 11/1 08:00 は UTC では 10/31
+    assert main.current_billing_period(datetime(2026, 11, 1, 8, tzinfo=jst).astimezone(timezone.utc)) == "2026-10"
+
+
+def test_period_usage_prefers_usage_map():
+    key_data = {"usage": {"2026-10": 7}, "usageCount": 99, "lastReset": datetime(2026, 10, 1, tzinfo=timezone.utc)}
+    assert main.get_period_usage(key_data, "2026-10") == 7
+
+
+def test_legacy_usage_count_carries_over_only_within_its_period():
+    key_data = {"usageCount": 12, "lastReset": datetime(2026, 10, 5, tzinfo=timezone.utc)}
+
+    assert main.get_period_usage(key_data, "2026-10") == 12
+    assert main.get_period_usage(key_data, "2026-11") == 0
+    assert main.get_period_usage({"usageCount": 12}, "2026-10") == 0
+
+
+def test_legacy_last_reset_without_timezone_is_treated_as_utc():
+    key_data = {"usageCount": 4, "lastReset": datetime(2026, 10, 31, 23, 30)}
+    assert main.get_period_usage(key_data, "2026-10") == 4
+
+
+def test_first_increment_carries_over_legacy_count():
+    key_data = {"usageCount": 12, "lastReset": datetime(2026, 10, 5, tzinfo=timezone.utc)}
+    path = main.usage_field_path("2026-10")
+
+    assert main.build_period_usage_increment(key_data, "2026-10", 3)[path].value == 15
+    assert main.build_period_usage_increment(dict(key_data, usage={"2026-10": 15}), "2026-10", 3)[path].value == 3
@@ -0,0 +1,41 @@
+# functions/tests/test_error_responses.py
+"""
+JSON のエンコード (encode_json) と、import 時にエンコードしておく固定のエラーボディ (STATIC_ERROR_BODIES) のテスト。
+"""
+
+import json
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("message", main.STATIC_ERROR_MESSAGES)
+def test_static_error_body_is_byte_identical_to_per_request_encoding(message):
+    response = main.create_error_response(internal_message="test", public_message=message, status_code=400)
+
+    assert response.get_data() == main.STATIC_ERROR_BODIES[message] == main.encode_json({"error": message})
+    assert response.status_code == 400 and response.mimetype == "application/json"
+
+
+def test_message_without_static_body_is_encoded_per_request():
+    message = "Unexpected error: details"
+    assert message not in main.STATIC_ERROR_BODIES
+
+    response = main.create_error_response(internal_message="test", public_message=message, status_code=500)
+
+    assert response.get_data() == main.encode_json({"error": message})
+    assert json.loads(response.get_data()) == {"error": message}
+
+
+def test_encode_json_falls_back_to_the_standard_library(monkeypatch):
+    data = {"status": "success", "remainingUsages": 7, "note": "日本語"}
+    monkeypatch.setattr(main, "orjson", None)
+
+    assert main.encode_json(data) == json.dumps(data).encode("utf-8")
+
+
+def test_encode_json_falls_back_for_values_orjson_cannot_encode():
+    data = {"count": 2 ** 70}  # orjson は 64 ビットを超える整数を扱えない
+
+    assert json.loads(main.encode_json(data)) == data
@@ -0,0 +1,160 @@
+# functions/tests/test_find_api_key_snapshot.py
+"""
+APIキーの解決順序 (find_api_key_snapshot と lookup_api_key のネガティブキャッシュ) のテスト。
+ハッシュID → apiKeyIndex → 従来のクエリ (遅延索引付き) → ネガティブキャッシュ の順に解決されることを、
+Firestore の代わりに読み取りを記録する偽の実装で確認します。
+"""
+
+import pytest
+
+import main
+
+HASHED_KEY = "sk_hashed"
+LEGACY_KEY = "sk_legacy"
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeDocRef:
+    def __init__(self, db, collection: str, doc_id: str):
+        self.db = db
+        self.id = doc_id
+        self.path = f"{collection}/{doc_id}"
+
+    def get(self):
+        self.db.calls.append(("get", self.path))
+        return FakeSnapshot(self, self.db.docs.get(self.path))
+
+    def set(self, data):
+        self.db.calls.append(("set", self.path))
+        self.db.docs[self.path] = data
+
+
+class FakeQuery:
+    def __init__(self, db, collection: str, filter=None):
+        self.db = db
+        self.collection = collection
+        self.filter = filter
+
+    def where(self, filter):
+        return FakeQuery(self.db, self.collection, filter)
+
+    def limit(self, count):
+        return self
+
+    def stream(self):
+        self.db.calls.append(("query", self.filter.field_path))
+        prefix = f"{self.collection}/"
+        return [
+            FakeSnapshot(FakeDocRef(self.db, self.collection, path[len(prefix):]), data)
+            for path, data in self.db.docs.items()
+            if path.startswith(prefix) and data.get(self.filter.field_path) == self.filter.value
+        ][:1]
+
+
+class FakeCollection(FakeQuery):
+    def document(self, doc_id):
+        return FakeDocRef(self.db, self.collection, doc_id)
+
+
+class FakeDb:
+    def __init__(self, docs: dict):
+        self.docs = docs
+        self.calls = []
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def get_all(self, refs):
+        self.calls.append(("get_all", tuple(ref.path for ref in refs)))
+        return [FakeSnapshot(ref, self.docs.get(ref.path)) for ref in refs]
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    docs = {
+        f"apiKeys/{main.hash_api_key(HASHED_KEY)}": {"key": HASHED_KEY, "isEnabled": True, "user_uid": "u1"},
+        "apiKeys/legacy-auto-id": {"key": LEGACY_KEY, "isEnabled": True, "user_uid": "u2"},
+    }
+    db = FakeDb(docs)
+    monkeypatch.setattr(main, "db", db)
+    monkeypatch.setattr(main, "API_KEY_LEGACY_QUERY_FALLBACK", True)
+    return db
+
+
+def first_read(key: str) -> tuple:
+    key_hash = main.hash_api_key(key)
+    return ("get_all", (f"apiKeys/{key_hash}", f"apiKeyIndex/{key_hash}"))
+
+
+def test_hashed_document_is_resolved_in_one_round_trip(fake_db):
+    snapshot = main.find_api_key_snapshot(HASHED_KEY)
+
+    assert snapshot.id == main.hash_api_key(HASHED_KEY)
+    assert fake_db.calls == [first_read(HASHED_KEY)]
+
+
+def test_hashed_document_with_another_key_is_rejected_without_fallback(fake_db):
+    fake_db.docs[f"apiKeys/{main.hash_api_key('sk_other')}"] = {"key": "sk_mismatch"}
+
+    assert main.find_api_key_snapshot("sk_other") is None
+    assert fake_db.calls == [first_read("sk_other")]
+
+
+def test_index_entry_is_used_before_the_legacy_query(fake_db):
+    fake_db.docs[f"apiKeyIndex/{main.hash_api_key(LEGACY_KEY)}"] = {"apiKeyDocId": "legacy-auto-id"}
+
+    snapshot = main.find_api_key_snapshot(LEGACY_KEY)
+
+    assert snapshot.id == "legacy-auto-id"
+    assert fake_db.calls == [first_read(LEGACY_KEY), ("get", "apiKeys/legacy-auto-id")]
+
+
+def test_legacy_query_resolves_unindexed_key_and_writes_the_index(fake_db):
+    snapshot = main.find_api_key_snapshot(LEGACY_KEY)
+
+    index_path = f"apiKeyIndex/{main.hash_api_key(LEGACY_KEY)}"
+    assert snapshot.id == "legacy-auto-id"
+    assert fake_db.calls == [first_read(LEGACY_KEY), ("query", "key"), ("set", index_path)]
+    assert fake_db.docs[index_path]["apiKeyDocId"] == "legacy-auto-id"
+
+    # 次回は索引から解決され、クエリは実行されない
+    fake_db.calls.clear()
+    assert main.find_api_key_snapshot(LEGACY_KEY).id == "legacy-auto-id"
+    assert fake_db.calls == [first_read(LEGACY_KEY), ("get", "apiKeys/legacy-auto-id")]
+
+
+def test_stale_index_entry_falls_through_to_the_legacy_query(fake_db):
+    fake_db.docs[f"apiKeyIndex/{main.hash_api_key(LEGACY_KEY)}"] = {"apiKeyDocId": "deleted-doc"}
+
+    assert main.find_api_key_snapshot(LEGACY_KEY).id == "legacy-auto-id"
+    assert [call[0] for call in fake_db.calls] == ["get_all", "get", "query", "set"]
+
+
+def test_legacy_query_is_skipped_when_fallback_is_disabled(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "API_KEY_LEGACY_QUERY_FALLBACK", False)
+
+    assert main.find_api_key_snapshot(LEGACY_KEY) is None
+    assert fake_db.calls == [first_read(LEGACY_KEY)]
+
+
+def test_unresolved_key_is_negative_cached_after_all_lookups(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "api_key_cache", main.ApiKeyMetadataCache(maxsize=8, ttl=60))
+    monkeypatch.setattr(main, "api_key_negative_cache", main.ApiKeyNegativeCache(maxsize=8, ttl=60))
+    monkeypatch.setattr(main, "api_key_bloom_filter", None)
+
+    assert main.lookup_api_key("sk_missing") == (None, None)
+    assert fake_db.calls == [first_read("sk_missing"), ("query", "key")]
+
+    fake_db.calls.clear()
+    assert main.lookup_api_key("sk_missing") == (None, None)
+    assert fake_db.calls == []
@@ -0,0 +1,37 @@
+# functions/tests/test_function_options.py
+"""
+関数の全体オプション (FUNCTIONS_CPU / FUNCTIONS_CONCURRENCY) の解釈のテスト。
+"""
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("raw_cpu, expected", [
+    ("1", 1),
+    ("2.0", 2),
+    ("0.5", 0.5),
+    (" 0.083 ", 0.083),
+    ("gcf_gen1", "gcf_gen1"),
+])
+def test_parse_functions_cpu(raw_cpu, expected):
+    cpu = main.parse_functions_cpu(raw_cpu)
+    assert cpu == expected and type(cpu) is type(expected)
+
+
+@pytest.mark.parametrize("raw_cpu", ["", "0", "-1", "nan", "one"])
+def test_parse_functions_cpu_rejects_invalid_values(raw_cpu):
+    with pytest.raises(ValueError):
+        main.parse_functions_cpu(raw_cpu)
+
+
+@pytest.mark.parametrize("concurrency, cpu, expected", [
+    (80, 1, 80),
+    (80, 2, 80),
+    (80, 0.5, 1),
+    (80, "gcf_gen1", 1),
+    (1, 0.5, 1),
+])
+def test_concurrency_requires_a_full_vcpu(concurrency, cpu, expected):
+    assert main.resolve_functions_concurrency(concurrency, cpu) == expected
@@ -0,0 +1,97 @@
+# functions/tests/test_id_token_cache.py
+"""
+検証済み ID トークンのキャッシュ (IdTokenCache / verify_id_token_cached) のテスト。
+トークンの検証は偽の実装に差し替え、キャッシュの失効時刻の計算のみを確認します。
+"""
+
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def no_expiry_margin(monkeypatch):
+    monkeypatch.setattr(main, "ID_TOKEN_CACHE_EXPIRY_MARGIN_SECONDS", 0)
+
+
+def test_claims_are_cached_until_exp():
+    cache = main.IdTokenCache(maxsize=8)
+    claims = {"uid": "uid-1", "exp": time.time() + 0.1}
+    cache.put("token-1", claims)
+
+    assert cache.get("token-1") == claims
+    time.sleep(0.15)
+    assert cache.get("token-1") is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_expired_or_exp_less_tokens_are_not_cached():
+    cache = main.IdTokenCache(maxsize=8)
+    cache.put("expired", {"uid": "uid-1", "exp": time.time() - 1})
+    cache.put("no-exp", {"uid": "uid-1"})
+
+    assert cache.stats()["size"] == 0
+
+
+def test_expiry_margin_shortens_the_entry_lifetime(monkeypatch):
+    monkeypatch.setattr(main, "ID_TOKEN_CACHE_EXPIRY_MARGIN_SECONDS", 60)
+    cache = main.IdTokenCache(maxsize=8)
+    cache.put("token-1", {"uid": "uid-1", "exp": time.time() + 30})
+
+    assert cache.get("token-1") is None
+
+
+def test_max_ttl_caps_the_entry_lifetime():
+    cache = main.IdTokenCache(maxsize=8)
+    cache.put("token-1", {"uid": "uid-1", "exp": time.time() + 3600}, max_ttl=0.05)
+
+    assert cache.get("token-1") is not None
+    time.sleep(0.1)
+    assert cache.get("token-1") is None
+
+
+def test_verify_id_token_cached_skips_verification_on_hit(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "id_token_cache", main.IdTokenCache(maxsize=8))
+    monkeypatch.setattr(main, "ID_TOKEN_CHECK_REVOKED", False)
+    monkeypatch.setattr(
+        main, "verify_firebase_id_token",
+        lambda id_token, check_revoked: calls.append(id_token) or {"uid": "uid-1", "exp": time.time() + 3600}
+    )
+
+    main.verify_id_token_cached("token-1")
+    main.verify_id_token_cached("token-1")
+
+    assert calls == ["token-1"]
+
+
+def test_verification_failures_are_not_cached(monkeypatch):
+    calls = []
+
+    def failing_verify(id_token, check_revoked):
+        calls.append(id_token)
+        raise main.auth.InvalidIdTokenError("bad token")
+
+    monkeypatch.setattr(main, "id_token_cache", main.IdTokenCache(maxsize=8))
+    monkeypatch.setattr(main, "verify_firebase_id_token", failing_verify)
+    for _ in range(2):
+        with pytest.raises(main.auth.InvalidIdTokenError):
+            main.verify_id_token_cached("token-1")
+
+    assert calls == ["token-1", "token-1"]
+
+
+def test_revocation_checks_use_the_short_ttl(monkeypatch):
+    monkeypatch.setattr(main, "id_token_cache", main.IdTokenCache(maxsize=8))
+    monkeypatch.setattr(main, "ID_TOKEN_CHECK_REVOKED", True)
+    monkeypatch.setattr(main, "ID_TOKEN_CACHE_REVOKED_TTL_SECONDS", 0.05)
+    monkeypatch.setattr(
+        main, "verify_firebase_id_token",
+        lambda id_token, check_revoked: {"uid": "uid-1", "exp": time.time() + 3600, "checked": check_revoked}
+    )
+
+    assert main.verify_id_token_cached("token-1")["checked"] is True
+    time.sleep(0.1)
+    assert main.id_token_cache.get("token-1") is None
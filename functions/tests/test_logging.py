@@ -0,0 +1,103 @@
+# functions/tests/test_logging.py
+"""
+非同期ログ出力 (DeferredQueueHandler) のテスト。ルートロガーは変更せず、ハンドラーを直接使って確認します。
+"""
+
+import logging
+import queue
+
+import main
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_record(message: str, level: int = logging.INFO) -> logging.LogRecord:
+    return logging.LogRecord("test", level, __file__, 0, message, None, None)
+
+
+def test_listener_starts_on_first_record_and_stop_flushes():
+    collected = CollectingHandler()
+    handler = main.DeferredQueueHandler(queue.Queue(maxsize=100), collected)
+    assert handler._listener is None  # 生成しただけではスレッドを起動しない
+
+    handler.handle(make_record("first"))
+    assert handler._listener is not None
+    handler.stop()
+
+    assert [record.getMessage() for record in collected.records] == ["first"]
+
+
+def test_records_after_stop_are_written_directly():
+    collected = CollectingHandler()
+    handler = main.DeferredQueueHandler(queue.Queue(maxsize=100), collected)
+    handler.stop()
+    handler.stop()  # 2回目は何もしない
+
+    handler.handle(make_record("late"))
+
+    assert handler._listener is None
+    assert [record.getMessage() for record in collected.records] == ["late"]
+
+
+def test_dropped_records_are_counted_and_reported_once_there_is_room():
+    collected = CollectingHandler()
+    handler = main.DeferredQueueHandler(queue.Queue(maxsize=2), collected)
+    handler._start_listener = lambda: None  # キューを消費させずに溢れさせる
+
+    for index in range(5):
+        handler.handle(make_record(f"record-{index}"))
+    assert handler.dropped == 3
+
+    handler.queue.get_nowait()
+    handler.queue.get_nowait()
+    handler.handle(make_record("after-drain"))
+    handler.stop()
+
+    messages = [record.getMessage() for record in collected.records]
+    assert messages[0] == "after-drain"
+    assert messages[1].startswith("DeferredQueueHandler: Dropped 3 log records")
+    assert collected.records[1].levelno == logging.WARNING
+    assert handler.dropped == 3
+
+
+def test_drop_report_is_retried_when_the_queue_is_still_full():
+    collected = CollectingHandler()
+    handler = main.DeferredQueueHandler(queue.Queue(maxsize=1), collected)
+    handler._start_listener = lambda: None
+
+    handler.handle(make_record("kept"))
+    handler.handle(make_record("dropped"))
+    handler.queue.get_nowait()
+    handler.handle(make_record("fills-the-queue"))  # 空きは1件のみで、破棄件数のログは積めない
+    assert handler._unreported_drops == 1
+
+    handler.stop()
+    messages = [record.getMessage() for record in collected.records]
+    assert messages[0] == "fills-the-queue"
+    assert messages[1].startswith("DeferredQueueHandler: Dropped 1 log records")
+
+
+def test_mutable_args_are_written_with_their_value_at_log_time():
+    collected = CollectingHandler()
+    handler = main.DeferredQueueHandler(queue.Queue(maxsize=100), collected)
+    summary = {"scanned": 1}
+    pages = ["a"]
+
+    # 引数が1つの dict の場合、LogRecord は args をその dict 自体にする
+    handler.handle(logging.LogRecord("test", logging.INFO, __file__, 0, "Progress %s", (summary,), None))
+    handler.handle(logging.LogRecord("test", logging.INFO, __file__, 0, "Progress %s %s (%s)", (summary, pages, "last"), None))
+    summary["scanned"] = 2
+    pages.append("b")
+    handler.stop()
+
+    assert [record.getMessage() for record in collected.records] == [
+        "Progress {'scanned': 1}",
+        "Progress {'scanned': 1} ['a'] (last)",
+    ]
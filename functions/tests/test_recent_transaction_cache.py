@@ -0,0 +1,45 @@
+# functions/tests/test_recent_transaction_cache.py
+"""
+処理済み transactionId の短期キャッシュ (RecentTransactionCache) のテスト。
+"""
+
+import time
+
+import main
+
+
+def test_hit_returns_recorded_usage_count():
+    cache = main.RecentTransactionCache(maxsize=8, ttl=60)
+    cache.put("hash-1", "txn-1", 42)
+
+    assert cache.get("hash-1", "txn-1") == {"recordedUsageCount": 42}
+    assert cache.stats()["hits"] == 1
+
+
+def test_same_transaction_id_from_another_key_is_a_miss():
+    cache = main.RecentTransactionCache(maxsize=8, ttl=60)
+    cache.put("hash-1", "txn-1", 42)
+
+    assert cache.get("hash-2", "txn-1") is None
+    assert cache.stats()["hits"] == 0
+
+
+def test_entries_expire_after_ttl():
+    cache = main.RecentTransactionCache(maxsize=8, ttl=0.05)
+    cache.put("hash-1", "txn-1", 42)
+    time.sleep(0.1)
+
+    assert cache.get("hash-1", "txn-1") is None
+    cache.put("hash-1", "txn-2", 43)  # 失効したエントリは次の書き込み時に取り除かれる
+    assert cache.stats()["size"] == 1
+
+
+def test_least_recently_used_entry_is_evicted_when_full():
+    cache = main.RecentTransactionCache(maxsize=2, ttl=60)
+    cache.put("hash-1", "txn-1", 1)
+    cache.put("hash-1", "txn-2", 2)
+    cache.get("hash-1", "txn-1")
+    cache.put("hash-1", "txn-3", 3)
+
+    assert cache.get("hash-1", "txn-2") is None
+    assert cache.get("hash-1", "txn-1") is not None
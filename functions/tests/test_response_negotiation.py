@@ -0,0 +1,50 @@
+# functions/tests/test_response_negotiation.py
+"""
+Accept ヘッダーによるレスポンス形式 (JSON / MessagePack) の判定 (negotiate_response_mimetype) のテスト。
+"""
+
+import json
+
+import msgpack
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+import main
+
+
+def make_request(accept: str | None) -> Request:
+    headers = {"Accept": accept} if accept is not None else {}
+    return Request(EnvironBuilder(method="POST", path="/", headers=headers).get_environ())
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, "application/json"),
+    ("", "application/json"),
+    ("*/*", "application/json"),
+    ("application/json", "application/json"),
+    ("text/html, */*;q=0.8", "application/json"),
+    ("application/msgpack", "application/msgpack"),
+    ("application/x-msgpack", "application/msgpack"),
+    ("application/json, application/msgpack;q=0.5", "application/json"),
+    ("application/json;q=0.5, application/msgpack", "application/msgpack"),
+    ("application/msgpack;q=0, application/json", "application/json"),
+    ("application/msgpack;q=0", "application/json"),
+])
+def test_negotiate_response_mimetype(accept, expected):
+    assert main.negotiate_response_mimetype(make_request(accept)) == expected
+
+
+def test_negotiation_without_request_defaults_to_json():
+    assert main.negotiate_response_mimetype(None) == "application/json"
+
+
+def test_success_response_body_follows_negotiated_type():
+    data = {"status": "success", "remainingUsages": 7}
+
+    json_response = main.create_success_response(data=data, req=make_request("application/json"))
+    msgpack_response = main.create_success_response(data=data, req=make_request("application/msgpack"))
+
+    assert json_response.mimetype == "application/json" and json.loads(json_response.get_data()) == data
+    assert msgpack_response.mimetype == "application/msgpack" and msgpack.unpackb(msgpack_response.get_data()) == data
+    assert json_response.headers["Vary"] == msgpack_response.headers["Vary"] == "Accept"
@@ -0,0 +1,98 @@
+# functions/tests/test_server_timing.py
+"""
+リクエストごとの処理時間の内訳 (with_server_timing / RequestTimings / TimingSpan) のテスト。
+"""
+
+import re
+
+import pytest
+
+import main
+
+METRIC_PATTERN = re.compile(r'^[a-z_]+;dur=\d+\.\d(;desc="x\d+")?$')
+
+
+def span_handler(*span_names):
+    """指定した名前の TimingSpan を順に記録するハンドラを返します。"""
+    @main.with_server_timing
+    def handler(req):
+        for name in span_names:
+            with main.TimingSpan(name):
+                pass
+        return main.create_success_response(data={"status": "success"})
+    return handler
+
+
+def metric_names(header: str) -> list[str]:
+    return [metric.split(";", 1)[0] for metric in header.split(", ")]
+
+
+@pytest.fixture
+def sampled(monkeypatch):
+    monkeypatch.setattr(main, "SERVER_TIMING_SAMPLE_RATE", 1.0)
+
+
+def test_header_lists_spans_with_counts_and_total_last(sampled):
+    response = span_handler("firestore_read", "txn", "firestore_read")(None)
+
+    header = response.headers["Server-Timing"]
+    metrics = header.split(", ")
+    assert all(METRIC_PATTERN.match(metric) for metric in metrics), header
+    assert metric_names(header) == ["firestore_read", "txn", "total"]
+    assert metrics[0].endswith(';desc="x2"') and ";desc=" not in metrics[1]
+
+
+def test_server_timing_header_formats_durations():
+    timings = main.RequestTimings()
+    timings.add("txn", 1.26)
+    timings.add("firestore_read", 2.0)
+    timings.add("firestore_read", 0.5)
+
+    assert timings.server_timing_header(12.34) == 'txn;dur=1.3, firestore_read;dur=2.5;desc="x2", total;dur=12.3'
+
+
+def test_spans_do_not_leak_between_requests(sampled):
+    span_handler("firestore_read", "txn")(None)
+    assert main._request_timings.get() is None
+
+    response = span_handler("cache")(None)
+
+    assert metric_names(response.headers["Server-Timing"]) == ["cache", "total"]
+    assert main._request_timings.get() is None
+
+
+def test_context_is_reset_when_the_handler_raises(sampled):
+    @main.with_server_timing
+    def failing(req):
+        with main.TimingSpan("txn"):
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        failing(None)
+
+    assert main._request_timings.get() is None
+
+
+def test_nested_handler_is_included_in_the_callers_timing(sampled):
+    inner = span_handler("txn")
+
+    @main.with_server_timing
+    def outer(req):
+        with main.TimingSpan("firestore_read"):
+            pass
+        response = inner(req)
+        assert "Server-Timing" not in response.headers
+        return response
+
+    response = outer(None)
+
+    assert metric_names(response.headers["Server-Timing"]) == ["firestore_read", "txn", "total"]
+
+
+def test_unsampled_request_has_no_header_and_spans_are_ignored(monkeypatch):
+    monkeypatch.setattr(main, "SERVER_TIMING_SAMPLE_RATE", 0.0)
+
+    response = span_handler("txn")(None)
+
+    assert "Server-Timing" not in response.headers
+    assert main._request_timings.get() is None
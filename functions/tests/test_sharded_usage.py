@@ -0,0 +1,85 @@
+# functions/tests/test_sharded_usage.py
+"""
+シャードモードの利用回数記録 (record_sharded_usage) と、シャード合計の短期キャッシュのテスト。
+Firestore には接続せず、キードキュメント参照とバッチを偽の実装に差し替えて確認します。
+"""
+
+import time
+
+import pytest
+
+import main
+
+
+class FakeBatch:
+    def __init__(self):
+        self.commits = 0
+
+    def set(self, *_args, **_kwargs):
+        pass
+
+    def create(self, *_args, **_kwargs):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeKeyDocRef:
+    id = "doc-1"
+
+    def collection(self, _name):
+        return self
+
+    def document(self, _doc_id):
+        return self
+
+
+@pytest.fixture
+def sharded(monkeypatch):
+    """シャード合計の読み取り回数を数えつつ、Firestore 呼び出しを偽の実装に差し替えます。"""
+    reads = []
+    batch = FakeBatch()
+    monkeypatch.setattr(main, "sharded_usage_total_cache", main.ShardedUsageTotalCache(maxsize=8, ttl=60))
+    monkeypatch.setattr(main, "read_sharded_usage", lambda ref, period: reads.append(period) or 5)
+    monkeypatch.setattr(main, "db", type("FakeDb", (), {"batch": lambda self: batch})())
+    return reads, batch
+
+
+def test_record_sharded_usage_reads_totals_once_within_ttl(sharded):
+    reads, batch = sharded
+    key_doc_ref = FakeKeyDocRef()
+
+    first = main.record_sharded_usage(key_doc_ref, shard_count=4, usage_limit=10, units=2)
+    second = main.record_sharded_usage(key_doc_ref, shard_count=4, usage_limit=10, units=2)
+
+    assert len(reads) == 1 and batch.commits == 2
+    assert (first["final_usage_count"], second["final_usage_count"]) == (7, 9)
+
+
+def test_record_sharded_usage_checks_limit_against_cached_total(sharded):
+    reads, batch = sharded
+    key_doc_ref = FakeKeyDocRef()
+    main.record_sharded_usage(key_doc_ref, shard_count=4, usage_limit=10, units=4)
+
+    result = main.record_sharded_usage(key_doc_ref, shard_count=4, usage_limit=10, units=2)
+
+    assert result["limit_exceeded"] is True
+    assert len(reads) == 1 and batch.commits == 1
+
+
+def test_cached_total_add_keeps_original_expiry():
+    cache = main.ShardedUsageTotalCache(maxsize=8, ttl=0.05)
+    cache.put("doc-1", "2026-10", 5)
+    cache.add("doc-1", "2026-10", 1)
+    assert cache.get("doc-1", "2026-10") == 6
+
+    time.sleep(0.1)
+    cache.add("doc-1", "2026-10", 1)
+    assert cache.get("doc-1", "2026-10") is None
+
+
+def test_cache_is_bypassed_when_ttl_is_zero():
+    cache = main.ShardedUsageTotalCache(maxsize=8, ttl=0)
+    cache.put("doc-1", "2026-10", 5)
+    assert cache.get("doc-1", "2026-10") is None
@@ -0,0 +1,78 @@
+# functions/tests/test_status_response.py
+"""
+check_api_key_status の条件付き GET (create_status_response / build_status_etag) のテスト。
+"""
+
+import json
+from datetime import datetime, timezone
+
+import msgpack
+import pytest
+from flask import Request
+from werkzeug.test import EnvironBuilder
+
+import main
+
+RESPONSE_DATA = {"usageCount": 3, "usageLimit": 100, "lastReset": "2026-10-01T00:00:00+00:00", "isEnabled": True}
+UPDATE_TIME = datetime(2026, 10, 16, 12, 0, tzinfo=timezone.utc)
+
+
+def make_request(headers: dict | None = None) -> Request:
+    return Request(EnvironBuilder(method="GET", path="/", headers=dict({"X-API-KEY": "sk_test"}, **(headers or {}))).get_environ())
+
+
+def test_etag_changes_with_usage_and_update_time():
+    etag = main.build_status_etag("doc-1", UPDATE_TIME, RESPONSE_DATA)
+
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == main.build_status_etag("doc-1", UPDATE_TIME, dict(RESPONSE_DATA))
+    assert etag != main.build_status_etag("doc-1", UPDATE_TIME, dict(RESPONSE_DATA, usageCount=4))
+    assert etag != main.build_status_etag("doc-1", None, RESPONSE_DATA)
+
+
+def test_full_response_carries_etag_and_cache_headers():
+    etag = main.build_status_etag("doc-1", UPDATE_TIME, RESPONSE_DATA)
+    response = main.create_status_response(make_request(), etag, RESPONSE_DATA)
+
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == RESPONSE_DATA
+    assert response.headers["ETag"] == etag
+    assert response.headers["Cache-Control"] == f"private, max-age={main.STATUS_CACHE_MAX_AGE_SECONDS}"
+    assert response.headers["Vary"] == "X-API-KEY, Accept"
+
+
+@pytest.mark.parametrize("if_none_match", ["{etag}", "W/{etag}", '"other", {etag}', "*"])
+def test_matching_if_none_match_returns_304_without_body(if_none_match):
+    etag = main.build_status_etag("doc-1", UPDATE_TIME, RESPONSE_DATA)
+    response = main.create_status_response(make_request({"If-None-Match": if_none_match.format(etag=etag)}), etag, RESPONSE_DATA)
+
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert response.headers["ETag"] == etag
+    assert response.headers["Vary"] == "X-API-KEY, Accept"
+
+
+def test_stale_if_none_match_returns_full_response():
+    etag = main.build_status_etag("doc-1", UPDATE_TIME, RESPONSE_DATA)
+    response = main.create_status_response(make_request({"If-None-Match": '"stale"'}), etag, RESPONSE_DATA)
+    assert response.status_code == 200
+
+
+def test_msgpack_representation_has_its_own_etag():
+    etag = main.build_status_etag("doc-1", UPDATE_TIME, RESPONSE_DATA)
+    msgpack_request = make_request({"Accept": "application/msgpack", "If-None-Match": etag})
+
+    response = main.create_status_response(msgpack_request, etag, RESPONSE_DATA)
+
+    # JSON の ETag では MessagePack の表現に 304 を返さない
+    assert response.status_code == 200
+    assert response.mimetype == "application/msgpack"
+    assert msgpack.unpackb(response.get_data()) == RESPONSE_DATA
+    msgpack_etag = response.headers["ETag"]
+    assert msgpack_etag != etag
+
+    revalidated = main.create_status_response(
+        make_request({"Accept": "application/msgpack", "If-None-Match": msgpack_etag}), etag, RESPONSE_DATA
+    )
+    assert revalidated.status_code == 304
+    assert revalidated.headers["Vary"] == "X-API-KEY, Accept"
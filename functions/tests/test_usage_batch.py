@@ -0,0 +1,59 @@
+# functions/tests/test_usage_batch.py
+"""
+record_api_usage_batch のリクエスト検証 (parse_usage_batch_items) と重複除去のテスト。
+"""
+
+import pytest
+
+import main
+
+
+def test_accepts_both_body_formats():
+    assert main.parse_usage_batch_items({"transactionIds": ["a", " b "]}) == [
+        {"transactionId": "a", "units": 1},
+        {"transactionId": "b", "units": 1},
+    ]
+    assert main.parse_usage_batch_items({"transactions": [{"transactionId": "a", "units": 3}, "b"]}) == [
+        {"transactionId": "a", "units": 3},
+        {"transactionId": "b", "units": 1},
+    ]
+
+
+@pytest.mark.parametrize("request_body", [
+    None,
+    [],
+    {},
+    {"transactions": []},
+    {"transactions": "a"},
+    {"transactions": [{"units": 1}]},
+    {"transactionIds": ["  "]},
+])
+def test_rejects_malformed_bodies(request_body):
+    with pytest.raises(ValueError):
+        main.parse_usage_batch_items(request_body)
+
+
+def test_item_count_is_limited():
+    main.parse_usage_batch_items({"transactionIds": [str(i) for i in range(main.USAGE_BATCH_MAX_ITEMS)]})
+    with pytest.raises(ValueError, match="Too many transactions"):
+        main.parse_usage_batch_items({"transactionIds": [str(i) for i in range(main.USAGE_BATCH_MAX_ITEMS + 1)]})
+
+
+@pytest.mark.parametrize("units", [0, -1, True, 1.5, "abc", main.MAX_USAGE_UNITS_PER_ITEM + 1])
+def test_units_are_validated_per_item(units):
+    with pytest.raises(ValueError, match="units must be an integer"):
+        main.parse_usage_batch_items({"transactions": [{"transactionId": "a", "units": units}]})
+
+
+def test_duplicates_and_recent_transactions_are_not_recorded_again(monkeypatch):
+    recent = main.RecentTransactionCache(maxsize=8, ttl=60)
+    recent.put("hash-1", "b", 7)
+    monkeypatch.setattr(main, "recent_transaction_cache", recent)
+    items = main.parse_usage_batch_items({"transactions": [
+        {"transactionId": "a", "units": 2}, {"transactionId": "a", "units": 5}, "b", "c",
+    ]})
+
+    results_by_id, pending_items = main.split_pending_usage_batch_items(items, "hash-1")
+
+    assert pending_items == [{"transactionId": "a", "units": 2}, {"transactionId": "c", "units": 1}]
+    assert results_by_id == {"b": {"transactionId": "b", "status": "already_recorded", "recordedUsageCount": 7}}
@@ -0,0 +1,161 @@
+# functions/tests/test_usage_compaction.py
+"""
+古い請求期間の圧縮 (compact_old_usage_periods) のテスト。
+Firestore には接続せず、apiKeys / usageShards のページングと WriteBatch を偽の実装に差し替え、
+どの期間キーが usageHistory へ移動され、どれが残るかを確認します。
+"""
+
+import pytest
+
+import main
+
+CURRENT = "2026-10"  # 保持期間3か月のとき、2026-07 より前が圧縮対象になる
+
+
+class FakeDocRef:
+    def __init__(self, path: str):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        # コレクションの参照もパスだけで表す (parent.parent で親ドキュメントに戻れる)
+        return FakeDocRef(self.path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return FakeDocRef(f"{self.path}/{name}")
+
+    def document(self, doc_id):
+        return FakeDocRef(f"{self.path}/{doc_id}")
+
+
+class FakeSnapshot:
+    def __init__(self, path: str, data: dict):
+        self.reference = FakeDocRef(path)
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeQuery:
+    def __init__(self, docs: dict, matches, page_size=None, after=None):
+        self.docs = docs
+        self.matches = matches
+        self.page_size = page_size
+        self.after = after
+
+    def select(self, fields):
+        return self
+
+    def order_by(self, field):
+        assert field == "__name__"
+        return self
+
+    def limit(self, count):
+        return FakeQuery(self.docs, self.matches, count, self.after)
+
+    def start_after(self, snapshot):
+        return FakeQuery(self.docs, self.matches, self.page_size, snapshot.reference.path)
+
+    def stream(self):
+        paths = sorted(path for path in self.docs if self.matches(path) and (self.after is None or path > self.after))
+        return [FakeSnapshot(path, self.docs[path]) for path in paths[:self.page_size]]
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes.append(("set", doc_ref.path, data))
+
+    def update(self, doc_ref, updates):
+        self.writes.append(("update", doc_ref.path, updates))
+
+    def commit(self):
+        self.db.committed.append(self.writes)
+
+
+class FakeDb:
+    def __init__(self, docs: dict):
+        self.docs = docs
+        self.committed = []
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, name):
+        return FakeQuery(self.docs, lambda path: path.count("/") == 1 and path.startswith(f"{name}/"))
+
+    def collection_group(self, name):
+        return FakeQuery(self.docs, lambda path: path.split("/")[-2] == name)
+
+    def writes(self) -> list[tuple]:
+        return [write for batch in self.committed for write in batch]
+
+
+@pytest.fixture
+def compact(monkeypatch):
+    monkeypatch.setattr(main, "ensure_firebase_initialized", lambda: None)
+    monkeypatch.setattr(main, "current_billing_period", lambda now_utc=None: CURRENT)
+
+    def run(docs: dict, **kwargs) -> tuple[dict, FakeDb]:
+        fake_db = FakeDb(docs)
+        monkeypatch.setattr(main, "db", fake_db)
+        return main.compact_old_usage_periods(**kwargs), fake_db
+
+    return run
+
+
+def deleted_fields(fake_db: FakeDb, path: str) -> list[str]:
+    return [
+        field for operation, write_path, data in fake_db.writes() if operation == "update" and write_path == path
+        for field, value in data.items() if value is main.firestore.DELETE_FIELD
+    ]
+
+
+def test_only_periods_before_the_retention_window_are_moved(compact):
+    docs = {"apiKeys/k1": {"usage": {"2026-05": 4, "2026-06": 5, "2026-07": 6, "2026-10": 7}}}
+
+    summary, fake_db = compact(docs, retention_months=3)
+
+    assert summary == {"cutoffPeriod": "2026-07", "keysScanned": 1, "shardsScanned": 0, "periodsCompacted": 2}
+    assert deleted_fields(fake_db, "apiKeys/k1") == [main.usage_field_path("2026-05"), main.usage_field_path("2026-06")]
+    history = {path: data for operation, path, data in fake_db.writes() if operation == "set"}
+    assert sorted(history) == ["apiKeys/k1/usageHistory/2026-05", "apiKeys/k1/usageHistory/2026-06"]
+    assert history["apiKeys/k1/usageHistory/2026-05"]["count"].value == 4
+
+
+def test_shard_counts_are_moved_to_the_parent_keys_history(compact):
+    docs = {
+        "apiKeys/k1": {"usage": {"2026-10": 1}},
+        "apiKeys/k1/usageShards/3": {"counts": {"2026-01": 2, "2026-09": 3}},
+    }
+
+    summary, fake_db = compact(docs, retention_months=3)
+
+    assert (summary["keysScanned"], summary["shardsScanned"], summary["periodsCompacted"]) == (1, 1, 1)
+    assert deleted_fields(fake_db, "apiKeys/k1") == []
+    assert deleted_fields(fake_db, "apiKeys/k1/usageShards/3") == [
+        main.FieldPath("counts", "2026-01").to_api_repr()
+    ]
+    assert [path for operation, path, _ in fake_db.writes() if operation == "set"] == ["apiKeys/k1/usageHistory/2026-01"]
+
+
+def test_every_page_is_scanned_and_recent_keys_write_nothing(compact):
+    docs = {f"apiKeys/k{i}": {"usage": {"2026-08": i}} for i in range(5)}
+    docs["apiKeys/k2"]["usage"]["2025-12"] = 9
+
+    summary, fake_db = compact(docs, retention_months=3, page_size=2)
+
+    assert (summary["keysScanned"], summary["periodsCompacted"]) == (5, 1)
+    assert [path for _, path, _ in fake_db.writes()] == ["apiKeys/k2/usageHistory/2025-12", "apiKeys/k2"]
+
+
+def test_nothing_is_committed_when_no_period_is_old_enough(compact):
+    summary, fake_db = compact({"apiKeys/k1": {"usage": {"2026-07": 1}}, "apiKeys/k2": {}}, retention_months=3)
+
+    assert summary["periodsCompacted"] == 0
+    assert fake_db.committed == []
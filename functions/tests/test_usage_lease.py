@@ -0,0 +1,171 @@
+# functions/tests/test_usage_lease.py
+"""
+利用枠のリース (UsageLeaseManager と取得・差し戻しのトランザクション) のテスト。
+Firestore には接続せず、トランザクションとドキュメント参照を偽の実装に差し替えて確認します。
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import main
+
+
+class FakeSnapshot:
+    def __init__(self, data: dict | None):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeDocRef:
+    def __init__(self, data: dict | None, doc_id: str = "doc-1"):
+        self.id = doc_id
+        self.data = data
+        self.updates = []
+
+    def get(self, transaction=None):
+        return FakeSnapshot(self.data)
+
+    def update(self, updates):
+        self.updates.append(updates)
+
+
+class FakeTransaction:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, doc_ref, updates):
+        self.updates.append(updates)
+
+
+def key_data(usage_count: int, usage_limit: int = 1000, **extra) -> dict:
+    return dict({"isEnabled": True, "usageLimit": usage_limit, "usage": {main.current_billing_period(): usage_count}}, **extra)
+
+
+def acquire(doc_ref: FakeDocRef, units: int = 1) -> tuple[dict, FakeTransaction]:
+    transaction_obj = FakeTransaction()
+    return main._acquire_usage_lease_in_transaction.to_wrap(transaction_obj, doc_ref, units), transaction_obj
+
+
+def settle(doc_ref: FakeDocRef, lease_id: str, used: int) -> tuple[int | None, FakeTransaction]:
+    transaction_obj = FakeTransaction()
+    return main._settle_usage_lease_in_transaction.to_wrap(transaction_obj, doc_ref, lease_id, used), transaction_obj
+
+
+def test_grant_is_capped_by_block_size(monkeypatch):
+    monkeypatch.setattr(main, "USAGE_LEASE_BLOCK_SIZE", 50)
+    monkeypatch.setattr(main, "USAGE_LEASE_EXPECTED_HOLDERS", 4)
+
+    acquired, transaction_obj = acquire(FakeDocRef(key_data(usage_count=100)))
+
+    assert (acquired["granted"], acquired["base_usage_count"]) == (50, 100)
+    [updates] = transaction_obj.updates
+    assert updates[main.usage_field_path(main.current_billing_period())].value == 50
+    assert updates[main.usage_lease_field_path(acquired["lease_id"])]["units"] == 50
+
+
+def test_grant_shares_remaining_quota_between_expected_holders(monkeypatch):
+    monkeypatch.setattr(main, "USAGE_LEASE_BLOCK_SIZE", 50)
+    monkeypatch.setattr(main, "USAGE_LEASE_EXPECTED_HOLDERS", 4)
+
+    acquired, _ = acquire(FakeDocRef(key_data(usage_count=960)))
+    assert acquired["granted"] == 10
+
+    not_granted, transaction_obj = acquire(FakeDocRef(key_data(usage_count=998)))
+    assert not_granted["not_granted"] is True and transaction_obj.updates == []
+
+
+def test_acquire_reports_expired_leases_for_reclaim():
+    now = datetime.now(timezone.utc)
+    leases = {
+        "lost": {"units": 10, "period": main.current_billing_period(), "expiresAt": now - timedelta(seconds=1)},
+        "live": {"units": 10, "period": main.current_billing_period(), "expiresAt": now + timedelta(seconds=60)},
+    }
+    acquired, _ = acquire(FakeDocRef(key_data(usage_count=0, usageLeases=leases)))
+    assert acquired["expired_lease_ids"] == ["lost"]
+
+
+def test_settle_returns_unused_units_once():
+    period = main.current_billing_period()
+    doc_ref = FakeDocRef(key_data(usage_count=50, usageLeases={"lease-1": {"units": 20, "period": period}}))
+
+    returned, transaction_obj = settle(doc_ref, "lease-1", used=5)
+
+    assert returned == 15
+    [updates] = transaction_obj.updates
+    assert updates[main.usage_field_path(period)].value == -15
+    assert updates[main.usage_lease_field_path("lease-1")] is main.firestore.DELETE_FIELD
+
+    doc_ref.data = key_data(usage_count=35)  # 差し戻し済み (エントリが削除された) 状態
+    returned_again, second_transaction = settle(doc_ref, "lease-1", used=5)
+    assert returned_again is None and second_transaction.updates == []
+
+
+class FakeDb:
+    def transaction(self):
+        return None
+
+    def collection(self, _name):
+        return self
+
+    def document(self, doc_id):
+        return FakeDocRef(None, doc_id)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """取得のトランザクションを偽の実装に差し替えた UsageLeaseManager を返します。"""
+    grants = []
+
+    def fake_acquire(_transaction_obj, doc_ref, units):
+        grants.append(units)
+        return {
+            "granted": 10, "lease_id": f"lease-{len(grants)}", "base_usage_count": 40,
+            "usage_limit": 100, "period": main.current_billing_period(), "expired_lease_ids": ["lost"],
+        }
+
+    monkeypatch.setattr(main, "_acquire_usage_lease_in_transaction", fake_acquire)
+    monkeypatch.setattr(main, "db", FakeDb())
+    lease_manager = main.UsageLeaseManager()
+    monkeypatch.setattr(lease_manager, "_ensure_sweeper", lambda: None)
+    return lease_manager, grants
+
+
+def test_effective_usage_count_grows_with_local_consumption(manager):
+    lease_manager, grants = manager
+    doc_ref = FakeDocRef(None)
+
+    first = lease_manager.consume(doc_ref, units=2)
+    second = lease_manager.consume(doc_ref, units=3)
+
+    assert len(grants) == 1
+    assert (first["effective_usage_count"], second["effective_usage_count"]) == (42, 45)
+    assert first["lease_id"] == second["lease_id"] == "lease-1"
+    assert lease_manager.stats()["pendingReclaims"] == 1
+
+
+def test_refund_restores_lease_capacity(manager):
+    lease_manager, grants = manager
+    doc_ref = FakeDocRef(None)
+    for _ in range(10):
+        lease_manager.consume(doc_ref)
+    lease_manager.refund(doc_ref.id, 3)
+
+    assert lease_manager.consume(doc_ref, units=3)["effective_usage_count"] == 50
+    assert len(grants) == 1
+
+
+def test_release_returns_remaining_units(manager, monkeypatch):
+    lease_manager, _ = manager
+    returned = []
+    monkeypatch.setattr(main, "_return_usage_lease", lambda _doc_ref, lease: returned.append((lease.lease_id, lease.remaining)))
+    doc_ref = FakeDocRef(None)
+    lease_manager.consume(doc_ref, units=4)
+
+    lease_manager.release(doc_ref.id)
+
+    assert returned == [("lease-1", 6)]
+    assert lease_manager.stats()["activeLeases"] == 0
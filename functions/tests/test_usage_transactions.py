@@ -0,0 +1,194 @@
+# functions/tests/test_usage_transactions.py
+"""
+利用回数を記録するトランザクション (_record_usage_in_transaction / _record_usage_batch_in_transaction) のテスト。
+Firestore には接続せず、トランザクションを偽の実装に差し替え、書き込みをコミット時にメモリ上のドキュメントへ反映して確認します。
+"""
+
+import pytest
+
+import main
+
+KEY_PATH = "apiKeys/key-doc"
+PERIOD = main.current_billing_period()
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeDocRef:
+    def __init__(self, path: str):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+
+class FakeDb:
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return FakeDocRef(f"processedTransactions/{doc_id}")
+
+
+class FakeTransaction:
+    """読み取りは docs から行い、書き込みは commit() まで保留します。"""
+
+    def __init__(self, docs: dict):
+        self.docs = docs
+        self.writes = []
+
+    def get_all(self, refs):
+        return [FakeSnapshot(ref, self.docs.get(ref.path)) for ref in refs]
+
+    def update(self, doc_ref, updates):
+        self.writes.append(("update", doc_ref.path, updates))
+
+    def create(self, doc_ref, data):
+        self.writes.append(("create", doc_ref.path, data))
+
+    def commit(self):
+        for operation, path, data in self.writes:
+            if operation == "create":
+                assert path not in self.docs, f"{path} already exists"
+                self.docs[path] = data
+                continue
+            for field_path, increment in data.items():
+                assert field_path == main.usage_field_path(PERIOD)
+                usage = self.docs[path].setdefault("usage", {})
+                usage[PERIOD] = usage.get(PERIOD, 0) + increment.value
+
+
+@pytest.fixture
+def docs(monkeypatch):
+    monkeypatch.setattr(main, "db", FakeDb())
+    return {KEY_PATH: {"isEnabled": True, "usageLimit": 100, "usage": {PERIOD: 10}}}
+
+
+def record(docs: dict, transaction_id: str, units: int = 1) -> tuple[dict, FakeTransaction]:
+    result_container = {
+        "final_usage_count": None,
+        "usage_limit": None,
+        "already_processed_data": None,
+        "limit_exceeded_in_txn": False,
+        "disabled_in_txn": False,
+    }
+    transaction_obj = FakeTransaction(docs)
+    main._record_usage_in_transaction.to_wrap(
+        transaction_obj, FakeDocRef(KEY_PATH), FakeDocRef(f"processedTransactions/{transaction_id}"),
+        units, "sk_test...", result_container
+    )
+    transaction_obj.commit()
+    return result_container, transaction_obj
+
+
+def test_usage_increment_and_processed_record_are_written_together(docs):
+    result, transaction_obj = record(docs, "txn-1", units=3)
+
+    assert result["final_usage_count"] == 13 and result["usage_limit"] == 100
+    assert [(operation, path) for operation, path, _ in transaction_obj.writes] == [
+        ("update", KEY_PATH), ("create", "processedTransactions/txn-1"),
+    ]
+    processed = docs["processedTransactions/txn-1"]
+    assert (processed["recordedUsageCount"], processed["units"], processed["billingPeriod"]) == (13, 3, PERIOD)
+    assert docs[KEY_PATH]["usage"][PERIOD] == 13
+
+
+def test_replayed_transaction_id_is_not_counted_twice(docs):
+    record(docs, "txn-1")
+
+    replay, transaction_obj = record(docs, "txn-1")
+
+    assert transaction_obj.writes == []
+    assert replay["final_usage_count"] is None
+    assert replay["already_processed_data"]["recordedUsageCount"] == 11
+    assert docs[KEY_PATH]["usage"][PERIOD] == 11
+
+
+def test_request_over_the_limit_writes_nothing(docs):
+    docs[KEY_PATH]["usage"][PERIOD] = 99
+
+    result, transaction_obj = record(docs, "txn-over", units=2)
+
+    assert result["limit_exceeded_in_txn"] is True
+    assert transaction_obj.writes == []
+    assert "processedTransactions/txn-over" not in docs
+    assert docs[KEY_PATH]["usage"][PERIOD] == 99
+
+    # 上限ちょうどまでは記録できる
+    result, _ = record(docs, "txn-last", units=1)
+    assert result["final_usage_count"] == 100
+
+
+def test_key_disabled_since_it_was_cached_writes_nothing(docs):
+    docs[KEY_PATH]["isEnabled"] = False
+
+    result, transaction_obj = record(docs, "txn-1")
+
+    assert result["disabled_in_txn"] is True and transaction_obj.writes == []
+
+
+def test_deleted_key_document_aborts_the_transaction(docs):
+    del docs[KEY_PATH]
+
+    with pytest.raises(main.google_exceptions.NotFound):
+        record(docs, "txn-1")
+
+
+def record_batch(docs: dict, items: list[tuple[str, int]]) -> tuple[dict, FakeTransaction]:
+    transaction_obj = FakeTransaction(docs)
+    result = main._record_usage_batch_in_transaction.to_wrap(
+        transaction_obj, FakeDocRef(KEY_PATH),
+        [{"transactionId": transaction_id, "units": units} for transaction_id, units in items], "sk_test..."
+    )
+    transaction_obj.commit()
+    return result, transaction_obj
+
+
+def test_batch_applies_new_items_with_one_summed_increment(docs):
+    docs["processedTransactions/done"] = {"recordedUsageCount": 7}
+
+    result, transaction_obj = record_batch(docs, [("a", 1), ("done", 5), ("b", 2), ("c", 3)])
+
+    assert [(item["transactionId"], item["status"], item.get("recordedUsageCount")) for item in result["results"]] == [
+        ("a", "recorded", 11), ("done", "already_recorded", 7), ("b", "recorded", 13), ("c", "recorded", 16),
+    ]
+    assert (result["usage_count"], result["usage_limit"]) == (16, 100)
+    updates = [data for operation, _, data in transaction_obj.writes if operation == "update"]
+    assert len(updates) == 1 and updates[0][main.usage_field_path(PERIOD)].value == 6
+    assert docs[KEY_PATH]["usage"][PERIOD] == 16
+    assert docs["processedTransactions/done"] == {"recordedUsageCount": 7}
+
+
+def test_batch_skips_items_over_the_limit_and_keeps_applying_smaller_ones(docs):
+    docs[KEY_PATH]["usage"][PERIOD] = 95
+
+    result, _ = record_batch(docs, [("a", 3), ("b", 3), ("c", 2)])
+
+    assert [item["status"] for item in result["results"]] == ["recorded", "limit_exceeded", "recorded"]
+    assert "processedTransactions/b" not in docs
+    assert docs[KEY_PATH]["usage"][PERIOD] == 100
+
+
+def test_batch_without_applicable_items_writes_nothing(docs):
+    docs[KEY_PATH]["usage"][PERIOD] = 100
+    docs["processedTransactions/done"] = {"recordedUsageCount": 100}
+
+    result, transaction_obj = record_batch(docs, [("done", 1), ("new", 1)])
+
+    assert [item["status"] for item in result["results"]] == ["already_recorded", "limit_exceeded"]
+    assert transaction_obj.writes == []
+
+
+def test_batch_for_a_disabled_key_writes_nothing(docs):
+    docs[KEY_PATH]["isEnabled"] = False
+
+    result, transaction_obj = record_batch(docs, [("a", 1)])
+
+    assert result == {"disabled": True} and transaction_obj.writes == []
@@ -0,0 +1,267 @@
+# functions/tests/test_verify_id_token.py
+"""
+ID トークンのローカル検証 (verify_firebase_id_token) のテスト。
+自己署名の証明書と RS256 で署名したトークンを生成し、証明書の取得は行わずに確認します。
+"""
+
+import base64
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("cryptography")
+
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import rsa  # noqa: E402
+from cryptography.x509.oid import NameOID  # noqa: E402
+from google.auth import crypt  # noqa: E402
+from google.auth import jwt as google_jwt  # noqa: E402
+
+import main  # noqa: E402
+
+PROJECT_ID = "demo-project"
+KEY_ID = "test-kid"
+
+
+@pytest.fixture(scope="module")
+def signing_key():
+    """署名用の秘密鍵 (PEM) と、対応する自己署名証明書 (PEM) を返します。"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "securetoken-test")])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1))
+        .sign(private_key, hashes.SHA256())
+    )
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("utf-8")
+    return private_pem, certificate.public_bytes(serialization.Encoding.PEM).decode("utf-8")
+
+
+@pytest.fixture
+def cert_manager(signing_key, monkeypatch):
+    """証明書を取得済みの状態の IdTokenCertificateManager に差し替えます (バックグラウンドスレッドは起動しない)。"""
+    manager = main.IdTokenCertificateManager("http://127.0.0.1:9/certs")
+    manager._certs = {KEY_ID: signing_key[1]}
+    manager._expires_at = time.time() + 3600
+    monkeypatch.setattr(manager, "start", lambda: None)
+    monkeypatch.setattr(main, "id_token_cert_manager", manager)
+    monkeypatch.setattr(main, "get_app", lambda: SimpleNamespace(project_id=PROJECT_ID))
+    monkeypatch.delenv("FIREBASE_AUTH_EMULATOR_HOST", raising=False)
+    return manager
+
+
+def make_token(signing_key, key_id: str = KEY_ID, **claim_overrides) -> str:
+    now = int(time.time())
+    claims = {
+        "iss": f"https://securetoken.google.com/{PROJECT_ID}",
+        "aud": PROJECT_ID,
+        "sub": "uid-1",
+        "iat": now - 10,
+        "exp": now + 3600,
+    }
+    claims.update(claim_overrides)
+    signer = crypt.RSASigner.from_string(signing_key[0], key_id=key_id)
+    return google_jwt.encode(signer, claims).decode("utf-8")
+
+
+def replace_header(token: str, header: dict) -> str:
+    encoded = base64.urlsafe_b64encode(json.dumps(header).encode("utf-8")).rstrip(b"=").decode("ascii")
+    return ".".join([encoded] + token.split(".")[1:])
+
+
+def test_valid_token_returns_claims_with_uid(signing_key, cert_manager):
+    claims = main.verify_firebase_id_token(make_token(signing_key))
+    assert claims["uid"] == claims["sub"] == "uid-1"
+
+
+def test_unexpected_algorithm_is_rejected(signing_key, cert_manager):
+    token = replace_header(make_token(signing_key), {"alg": "HS256", "kid": KEY_ID, "typ": "JWT"})
+    with pytest.raises(main.auth.InvalidIdTokenError, match="algorithm"):
+        main.verify_firebase_id_token(token)
+
+
+@pytest.mark.parametrize("claim_overrides", [
+    {"aud": "other-project"},
+    {"iss": "https://securetoken.google.com/other-project"},
+    {"iss": "https://accounts.google.com"},
+])
+def test_wrong_audience_or_issuer_is_rejected(signing_key, cert_manager, claim_overrides):
+    with pytest.raises(main.auth.InvalidIdTokenError):
+        main.verify_firebase_id_token(make_token(signing_key, **claim_overrides))
+
+
+@pytest.mark.parametrize("subject", ["", "x" * 129, 123])
+def test_invalid_subject_is_rejected(signing_key, cert_manager, subject):
+    with pytest.raises(main.auth.InvalidIdTokenError, match="subject"):
+        main.verify_firebase_id_token(make_token(signing_key, sub=subject))
+
+
+def test_expired_token_raises_expired_error(signing_key, cert_manager):
+    now = int(time.time())
+    with pytest.raises(main.auth.ExpiredIdTokenError):
+        main.verify_firebase_id_token(make_token(signing_key, iat=now - 7200, exp=now - 3600))
+
+
+def test_tampered_signature_is_rejected(signing_key, cert_manager):
+    header, payload, signature = make_token(signing_key).split(".")
+    forged_payload = base64.urlsafe_b64encode(json.dumps({
+        "iss": f"https://securetoken.google.com/{PROJECT_ID}", "aud": PROJECT_ID, "sub": "admin",
+        "iat": int(time.time()), "exp": int(time.time()) + 3600,
+    }).encode("utf-8")).rstrip(b"=").decode("ascii")
+    with pytest.raises(main.auth.InvalidIdTokenError):
+        main.verify_firebase_id_token(".".join([header, forged_payload, signature]))
+
+
+@pytest.fixture
+def fetching_manager(signing_key, monkeypatch):
+    """
+    証明書をまだ持たず、バックグラウンドスレッドで取得する IdTokenCertificateManager に差し替えます。
+    取得する証明書と所要時間は返り値の fetched["certs"] / fetched["delay"] で変更できます (certs が None の場合は取得に失敗します)。
+    auth.verify_id_token へのフォールバック (ネットワークからの取得) は行われないことも確認します。
+    """
+    manager = main.IdTokenCertificateManager("http://127.0.0.1:9/certs")
+    fetched = {"certs": {KEY_ID: signing_key[1]}, "delay": 0.0}
+
+    def fake_refresh():
+        time.sleep(fetched["delay"])
+        if fetched["certs"] is None:
+            raise OSError("certificate endpoint unavailable")
+        with manager._lock:
+            manager._certs = dict(fetched["certs"])
+            manager.refreshes += 1
+
+    def verify_with_network(*args, **kwargs):
+        raise AssertionError("auth.verify_id_token must not be used as a fallback")
+
+    monkeypatch.setattr(manager, "refresh", fake_refresh)
+    monkeypatch.setattr(main, "id_token_cert_manager", manager)
+    monkeypatch.setattr(main, "get_app", lambda: SimpleNamespace(project_id=PROJECT_ID))
+    monkeypatch.setattr(main.auth, "verify_id_token", verify_with_network)
+    monkeypatch.delenv("FIREBASE_AUTH_EMULATOR_HOST", raising=False)
+    yield manager, fetched
+    manager.stop()
+
+
+def test_cold_cache_waits_for_the_in_flight_fetch(signing_key, fetching_manager):
+    manager, fetched = fetching_manager
+    fetched["delay"] = 0.1
+    manager.start()
+
+    assert main.verify_firebase_id_token(make_token(signing_key))["uid"] == "uid-1"
+
+
+def test_cold_cache_starts_the_fetch_when_it_was_not_prefetched(signing_key, fetching_manager):
+    assert main.verify_firebase_id_token(make_token(signing_key))["uid"] == "uid-1"
+
+
+def test_cold_cache_wait_is_bounded_when_the_fetch_does_not_finish(signing_key, fetching_manager, monkeypatch):
+    manager, fetched = fetching_manager
+    fetched["delay"] = 2
+    monkeypatch.setattr(main, "ID_TOKEN_CERT_WAIT_SECONDS", 0.05)
+
+    started = time.monotonic()
+    with pytest.raises(main.auth.CertificateFetchError):
+        main.verify_firebase_id_token(make_token(signing_key))
+    assert time.monotonic() - started < 1
+
+
+def test_cold_cache_fetch_failure_raises_certificate_fetch_error(signing_key, fetching_manager):
+    manager, fetched = fetching_manager
+    fetched["certs"] = None
+
+    with pytest.raises(main.auth.CertificateFetchError):
+        main.verify_firebase_id_token(make_token(signing_key))
+    assert manager.stats()["failures"] == 1
+
+
+def test_unknown_kid_is_accepted_after_waiting_for_the_refresh(signing_key, fetching_manager):
+    manager, fetched = fetching_manager
+    manager.start()
+    assert manager.wait_for_certs(2)
+
+    # 鍵のローテーション: 次の取得で新しい kid の証明書が返るようになる
+    fetched["certs"] = {KEY_ID: signing_key[1], "rotated-kid": signing_key[1]}
+    fetched["delay"] = 0.05
+
+    claims = main.verify_firebase_id_token(make_token(signing_key, key_id="rotated-kid"))
+
+    assert claims["uid"] == "uid-1"
+    assert manager.stats()["requestedRefreshes"] == 1
+
+
+def test_unknown_kid_is_rejected_after_one_refresh(signing_key, fetching_manager):
+    manager, _ = fetching_manager
+    manager.start()
+    assert manager.wait_for_certs(2)
+    token = make_token(signing_key, key_id="unknown-kid")
+
+    for _ in range(3):
+        started = time.monotonic()
+        with pytest.raises(main.auth.InvalidIdTokenError, match="key id"):
+            main.verify_firebase_id_token(token)
+        assert time.monotonic() - started < 1
+
+    # 再取得の依頼は ID_TOKEN_CERT_UNKNOWN_KID_REFRESH_SECONDS に1回までで、取得済みの依頼は待たない
+    assert manager.stats()["requestedRefreshes"] == 1
+
+
+def test_unknown_kid_wait_is_bounded(signing_key, cert_manager, monkeypatch):
+    monkeypatch.setattr(main, "ID_TOKEN_CERT_WAIT_SECONDS", 0.05)  # cert_manager のスレッドは起動せず、取得は終わらない
+
+    started = time.monotonic()
+    with pytest.raises(main.auth.InvalidIdTokenError, match="key id"):
+        main.verify_firebase_id_token(make_token(signing_key, key_id="rotated-kid"))
+    assert time.monotonic() - started < 1
+
+
+@pytest.mark.parametrize("function_target, started", [
+    ("generate_or_fetch_api_key", True),
+    ("api", True),
+    ("record_api_usage", False),
+    (None, False),
+])
+def test_prefetch_starts_only_for_functions_that_verify_tokens(monkeypatch, function_target, started):
+    calls = []
+    monkeypatch.setattr(main, "id_token_cert_manager", SimpleNamespace(start=lambda: calls.append("start")))
+    if function_target is None:
+        monkeypatch.delenv("FUNCTION_TARGET", raising=False)
+    else:
+        monkeypatch.setenv("FUNCTION_TARGET", function_target)
+
+    main.start_id_token_cert_manager()
+
+    assert calls == (["start"] if started else [])
+
+
+def test_unknown_kid_refresh_can_be_requested_again_after_the_interval(cert_manager, monkeypatch):
+    monkeypatch.setattr(main, "ID_TOKEN_CERT_UNKNOWN_KID_REFRESH_SECONDS", 0)
+    assert cert_manager.request_refresh() is True
+    assert cert_manager.request_refresh() is True
+    assert cert_manager.stats()["requestedRefreshes"] == 2
+
+
+def test_requested_refresh_wakes_the_background_thread(monkeypatch):
+    manager = main.IdTokenCertificateManager("http://127.0.0.1:9/certs")
+    refreshed = []
+    monkeypatch.setattr(manager, "refresh", lambda: refreshed.append(time.monotonic()))
+    manager.start()
+    try:
+        deadline = time.monotonic() + 2
+        while len(refreshed) < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert manager.request_refresh() is True
+        while len(refreshed) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(refreshed) == 2
+    finally:
+        manager.stop()